@@ -1,14 +1,19 @@
-from flask import Flask, render_template, request, url_for, redirect, flash
+from flask import Flask, render_template, request, url_for, redirect, flash, jsonify
 from flask_login import login_user, current_user, logout_user, login_required, LoginManager
 from flask_nav import Nav
 from flask_nav.elements import Navbar, Subgroup, View, Link, Text, Separator
 from sqlalchemy.exc import IntegrityError
-from datetime import datetime, timedelta
+from pymongo.errors import ServerSelectionTimeoutError
 from src.forms import LoginForm, RegistrationForm
 from src.service import MapService, ScheduleService, UserService, TripService
 from src.repository import MapRepository, ScheduleRepository, UserRepository
 from src.models import User, Schedule, Trip, SubwayStation, TrainLine
-from src import app
+from src.cache import RouteCache
+from src.timetable import parse_minutes, format_minutes, MINUTES_PER_DAY
+from datetime import datetime
+from src import app, require_mysql
+
+require_mysql()
 
 nav = Nav(app)
 nav.register_element('navbar',
@@ -26,6 +31,32 @@ schedule_service = ScheduleService()
 user_service = UserService()
 trip_service = TripService()
 
+# Size the route cache for peak hour
+MapService.route_cache = RouteCache(max_bytes=app.config['ROUTE_CACHE_MAX_BYTES'], ttl=app.config['ROUTE_CACHE_TTL'])
+
+# Pick up the station status changes made by other workers
+MapService.graph_version_interval = app.config['GRAPH_VERSION_INTERVAL']
+
+# Load the timetable into memory so that trips can be planned without querying MongoDB. Workers map the same
+# snapshot file, so they share its pages and start without reading the schedules.
+ScheduleService.snapshot_path = app.config['TIMETABLE_SNAPSHOT']
+schedule_service.load_timetable()
+# Keep the delays current with the ones written by other workers
+schedule_service.follow_delays(app.config['DELAY_POLL_INTERVAL'])
+# Make sure the schedule queries are covered by their indexes
+try:
+    schedule_service.repository.ensure_indexes()
+except ServerSelectionTimeoutError:
+    print("MongoDB is unavailable, trips are planned from the timetable snapshot")
+# Make sure the graph lookups are covered by their indexes
+missing = map_service.repository.ensure_indexes()
+if len(missing) > 0:
+    print("The graph was missing the indexes {}, they have been created".format(", ".join(missing)))
+# Make sure the GDS projection used for shortest paths exists
+map_service.repository.ensure_projection()
+# Snapshot the graph and compute the all-pairs stop and transfer matrices
+map_service.get_graph_snapshot().compute_distance_matrices()
+
 
 @app.route("/", methods=["GET"])
 @login_required
@@ -96,13 +127,23 @@ def plan_trip():
         end = map_service.get_station_by_name_and_entrance(station_name=end_name,
                                                            entrance=end_entrance)
 
+        # Stations with no path between them can't be planned
+        if not map_service.are_connected(start, end):
+            return "Could not find a path!"
+
         # Get the shortest path
         shortest_path, times = map_service.get_shortest_path(start_station=start, stop_station=end)
         if shortest_path is None or len(times) == 0:
             return "Could not find a path!"
         else:
+            # Other trips worth taking if the user leaves later or wants fewer transfers
+            window = request.args.get("window", default=60, type=int)
+            alternatives = [train_lines for train_lines, times in
+                            map_service.get_alternative_paths(start_station=start, stop_station=end, window=window)]
             return render_template("shortest_path.html",
-                                   train_lines=shortest_path)
+                                   train_lines=shortest_path,
+                                   alternatives=alternatives,
+                                   window=window)
     else:
         return redirect(url_for("login"))
 
@@ -141,15 +182,20 @@ def schedules():
     if line is None or direction is None:
         return "Invalid query string. Could not get the desired schedule."
     else:
-        stations, schedules = schedule_service.get_schedules_by_line_direction(line, direction)
+        stations, schedules, trips = schedule_service.get_schedules_by_line_direction(line, direction)
         return render_template("schedule.html",
                                stations=stations,
                                schedules=schedules,
+                               trips=trips,
                                line=line,
                                direction=direction,
                                is_admin=current_user.is_admin)
 
 
+# Shown when a trip id from a page doesn't match a train, e.g. because the schedules were reloaded since it was shown
+MISSING_TRAIN = "That train no longer exists, the schedules may have been reloaded. Please try again."
+
+
 @app.route("/delay-train", methods=["POST"])
 @login_required
 def delay_train():
@@ -160,38 +206,71 @@ def delay_train():
         form = request.form
         station_name = form["station"]
         delay = form["delay"]
-        starting_station = form["starting_station"]
-        time = datetime.strptime(form["time"], "%H:%M")
         direction = form["direction"]
         line = form["line"]
 
-
-        schedule = schedule_service.get_train_by_line_direction_station_and_start_time(line, direction,
-                                                                                       starting_station, time)
-        schedule_service.delay_train(schedule, station_name, timedelta(minutes=int(delay)))
+        schedule = schedule_service.get_train(form["trip"])
+        if schedule is None:
+            flash(MISSING_TRAIN, "danger")
+            return redirect(url_for("schedules", line=line, direction=direction))
+        schedule_service.delay_train(schedule, station_name, int(delay))
 
         return redirect(url_for("schedules", line=line, direction=direction))
 
 
-@app.route("/remove-delay/<line>/<direction>/<time>/<starting_station>")
+@app.route("/remove-delay/<trip>")
 @login_required
-def remove_delay(line, direction, time, starting_station):
+def remove_delay(trip):
     if not current_user.is_admin:
         flash("Only admins can do this action.", "danger")
         return redirect(url_for("lines"))
     else:
-        time = datetime.strptime(time, "%H:%M")
-
-
         # Get the schedule with the delay
-        schedule = schedule_service.get_train_by_line_direction_station_and_start_time(line=line,
-                                                                                       direction=direction,
-                                                                                       starting_station=starting_station,
-                                                                                       time=time)
+        schedule = schedule_service.get_train(trip)
+        if schedule is None:
+            flash(MISSING_TRAIN, "danger")
+            return redirect(url_for("delays"))
         schedule_service.remove_delay(schedule)
         return redirect(url_for("delays"))
 
 
+def _segment_arguments(form) -> dict:
+    return {
+        "line": form["line"],
+        "direction": form["direction"],
+        "from_station": form["from_station"],
+        "to_station": form["to_station"],
+        "start": parse_minutes(form["start"]),
+        "end": parse_minutes(form["end"])
+    }
+
+
+@app.route("/delay-segment", methods=["POST"])
+@login_required
+def delay_segment():
+    if not current_user.is_admin:
+        return jsonify({"error": "Only admins can do this action."}), 403
+    form = request.get_json(silent=True) or request.form
+    try:
+        count = schedule_service.delay_trains(delay=int(form["delay"]), **_segment_arguments(form))
+    except (KeyError, ValueError) as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify({"trains": count})
+
+
+@app.route("/remove-segment-delays", methods=["POST"])
+@login_required
+def remove_segment_delays():
+    if not current_user.is_admin:
+        return jsonify({"error": "Only admins can do this action."}), 403
+    form = request.get_json(silent=True) or request.form
+    try:
+        count = schedule_service.remove_delays(**_segment_arguments(form))
+    except (KeyError, ValueError) as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify({"trains": count})
+
+
 @app.route("/delays", methods=["GET"])
 @login_required
 def delays():
@@ -207,7 +286,7 @@ def delays():
 @app.route('/log-trip/<start_name>/<start_entrance>/<stop_name>/<stop_entrance>/<start_time>/<stop_time>', methods=["GET"])
 @login_required
 def log_trip(start_name, start_entrance, stop_name, stop_entrance, start_time, stop_time):
-    time = (datetime.strptime(stop_time, "%H:%M") - datetime.strptime(start_time, "%H:%M")).seconds//60
+    time = (parse_minutes(stop_time) - parse_minutes(start_time)) % MINUTES_PER_DAY
     trip = Trip(user_id=current_user.user_id, start="{}, {}".format(start_name, start_entrance),
                 stop="{}, {}".format(stop_name, stop_entrance), time=time)
     trip_service.add_trip(trip=trip)
@@ -226,6 +305,39 @@ def trips():
         return render_template('trips.html', trips=trips)
 
 
+@app.route('/route-cache', methods=["GET"])
+@login_required
+def route_cache():
+    if not current_user.is_admin:
+        flash("Only admins can do this action.", "danger")
+        return redirect(url_for("index"))
+    return jsonify(MapService.route_cache.stats())
+
+
+# Most departures a departure board can ask for at once
+MAX_DEPARTURES = 50
+
+
+def _minutes_now() -> int:
+    now = datetime.now()
+    return now.hour * 60 + now.minute
+
+
+@app.route('/departures', methods=["GET"])
+def departures():
+    # Polled by platform screens, so this is served from memory and doesn't need a login
+    station = request.args.get("station", "")
+    try:
+        time = parse_minutes(request.args["time"]) if "time" in request.args else _minutes_now()
+        count = min(max(int(request.args.get("count", 10)), 1), MAX_DEPARTURES)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    result = schedule_service.get_next_departures(station, time, count)
+    if result is None:
+        return jsonify({"error": "No train stops at {}".format(station)}), 404
+    return jsonify({"station": station, "time": format_minutes(time), "departures": result})
+
+
 @app.route('/change-status/<line>/<station_name>/<entrance>')
 @login_required
 def change_station_status(line, station_name, entrance):
@@ -8,6 +8,19 @@ from neo4j import GraphDatabase
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = '5791628bb0b13ce0c676dfde280ba245'
+# Memory cap (bytes) and time to live (seconds) of the cache of planned routes
+app.config['ROUTE_CACHE_MAX_BYTES'] = 64 * 1024 * 1024
+app.config['ROUTE_CACHE_TTL'] = 300
+# Binary timetable snapshot that every worker maps at startup, built with python -m src.snapshot
+app.config['TIMETABLE_SNAPSHOT'] = 'timetable.snapshot'
+# Compiled subway map that the graph is loaded from, built with python -m src.network
+app.config['NETWORK_ARTIFACT'] = 'network.json'
+# Seconds between polls of the delays when MongoDB runs standalone and change streams aren't available
+app.config['DELAY_POLL_INTERVAL'] = 5
+# Seconds between checks of the graph version for changes made by other workers
+app.config['GRAPH_VERSION_INTERVAL'] = 1
+# Milliseconds to wait for MongoDB before a query fails, so that a worker starts quickly when it is down
+app.config['MONGO_SERVER_SELECTION_TIMEOUT_MS'] = 5000
 login_manager = LoginManager(app)
 login_manager.login_view = 'login'
 login_manager.login_message_category = 'info'
@@ -16,14 +29,20 @@ login_manager.login_message_category = 'info'
 mysql_user = "root"
 mysql_password = "123456"
 
-# Database connections
-try:
-    mysql_engine = create_engine('mysql+pymysql://{}:{}@localhost/ece464_final'.format(mysql_user, mysql_password))
-    mysql_engine.connect()
-except OperationalError:
-    print("Create MySQL database ece464_final")
-    exit(0)
+# Database connections. The clients connect on first use, so importing the package doesn't need the databases
+mysql_engine = create_engine('mysql+pymysql://{}:{}@localhost/ece464_final'.format(mysql_user, mysql_password))
 neo4j_driver = GraphDatabase.driver("bolt://localhost:7687", auth=("neo4j", "root"))
-mongo_client = MongoClient('mongodb://localhost:27017/')
+mongo_client = MongoClient('mongodb://localhost:27017/',
+                           serverSelectionTimeoutMS=app.config['MONGO_SERVER_SELECTION_TIMEOUT_MS'])
 
 
+def require_mysql():
+    """
+    Exits with a message if the MySQL database doesn't exist. Called by the entry points that use it
+    :return: None
+    """
+    try:
+        mysql_engine.connect().close()
+    except OperationalError:
+        print("Create MySQL database ece464_final")
+        exit(0)
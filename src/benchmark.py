@@ -0,0 +1,226 @@
+import argparse
+import os
+import random
+import tempfile
+import time
+import numpy as np
+import requests
+
+from src.ingest import schedule_files, parse_schedule_file, parse_schedule_file_iterrows, parse_schedule_files
+from src.scraper import Fetcher, yieldLineLinks, scrape_pages, save, WORKERS
+from src.fixture_server import FixtureServer
+
+
+"""
+Benchmarks for the routing and loading code. Run with
+python -m src.benchmark <benchmark> [--pairs N] [--seed S]
+"""
+
+
+def _report(name, timings):
+    """
+    Prints the mean, median and 95th percentile of a list of timings
+    :param name: the name of the measurement
+    :param timings: list of timings in seconds
+    :return: None
+    """
+    timings = np.array(timings) * 1000
+    print("{:<40} mean {:8.2f} ms   p50 {:8.2f} ms   p95 {:8.2f} ms".format(
+        name, timings.mean(), np.percentile(timings, 50), np.percentile(timings, 95)))
+
+
+def _random_pairs(stations, pairs, seed):
+    random.seed(seed)
+    return [random.sample(stations, 2) for i in range(0, pairs)]
+
+
+def benchmark_projection(pairs, seed):
+    """
+    Compares shortest paths that project the graph on every call against shortest paths that reuse the named
+    GDS projection, over random origin/destination pairs on the full network
+    :param pairs: the number of origin/destination pairs
+    :param seed: the random seed
+    :return: None
+    """
+    # Imported here so that the scrape and parse benchmarks run without the graph dependencies
+    from src.repository import MapRepository
+    from src.service import MapService
+
+    map_service = MapService()
+    map_repository = MapRepository()
+    stations = map_service.get_all_active_stations()
+
+    start = time.perf_counter()
+    map_repository.refresh_projection()
+    print("Created projection in {:.2f} ms".format((time.perf_counter() - start) * 1000))
+
+    per_call = []
+    reused = []
+    for start_station, stop_station in _random_pairs(stations, pairs, seed):
+        start = time.perf_counter()
+        map_repository.shortest_path_with_cypher_projection(start_station, stop_station)
+        per_call.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        map_repository.shortest_path(start_station, stop_station)
+        reused.append(time.perf_counter() - start)
+
+    _report("projection per call", per_call)
+    _report("reused named projection", reused)
+
+
+def benchmark_astar(pairs, seed):
+    """
+    Compares A* with the geographic heuristic against uniform-cost search on the in-memory snapshot, over random
+    origin/destination pairs and over pairs going from the Bronx to Brooklyn
+    :param pairs: the number of origin/destination pairs
+    :param seed: the random seed
+    :return: None
+    """
+    from src.service import MapService
+
+    snapshot = MapService().get_graph_snapshot()
+    active = [i for i in range(0, len(snapshot.stations)) if snapshot.active[i]]
+    bronx = [i for i in active if snapshot.stations[i].borough == "The Bronx"]
+    brooklyn = [i for i in active if snapshot.stations[i].borough == "Brooklyn"]
+    random.seed(seed)
+    samples = {
+        "random pairs": [random.sample(active, 2) for i in range(0, pairs)],
+        "Bronx to Brooklyn": [[random.choice(bronx), random.choice(brooklyn)] for i in range(0, pairs)]
+    }
+
+    for name, sample in samples.items():
+        print(name)
+        for label, use_heuristic in [("A*", True), ("uniform-cost", False)]:
+            timings = []
+            expanded = []
+            for start, stop in sample:
+                begin = time.perf_counter()
+                path, count = snapshot.search(start, stop, use_heuristic=use_heuristic)
+                timings.append(time.perf_counter() - begin)
+                expanded.append(count)
+            _report("  {} ({:.1f} nodes expanded)".format(label, np.mean(expanded)), timings)
+
+
+# Number of copies of every train in the synthetic schedules
+SYNTHETIC_SCALE = 100
+
+
+def _write_synthetic_schedules(directory, scale):
+    """
+    Writes a copy of every schedule file with each train repeated 'scale' times
+    :param directory: the directory to write to
+    :param scale: the number of copies of every train
+    :return: list of paths
+    """
+    filenames = []
+    for filename in schedule_files():
+        with open(filename) as f:
+            header = f.readline()
+            rows = f.read()
+        if not rows.endswith("\n"):
+            rows += "\n"
+        filenames.append(os.path.join(directory, os.path.basename(filename)))
+        with open(filenames[-1], "w") as f:
+            f.write(header + rows * scale)
+    return filenames
+
+
+def benchmark_parse(pairs, seed):
+    """
+    Compares the rows per second of the original row-by-row schedule loader with the vectorized loader, on its own
+    and in a process pool, on the bundled schedules and on a synthetic copy with every train repeated
+    SYNTHETIC_SCALE times. Only parsing is measured, nothing is written to MongoDB.
+    :param pairs: unused
+    :param seed: unused
+    :return: None
+    """
+    loaders = [
+        ("row by row", lambda filenames: sum(len(parse_schedule_file_iterrows(f)) for f in filenames)),
+        ("vectorized", lambda filenames: sum(len(parse_schedule_file(f)) for f in filenames)),
+        ("vectorized, {} processes".format(os.cpu_count()),
+         lambda filenames: sum(len(chunk) for chunk in parse_schedule_files(filenames)))
+    ]
+    with tempfile.TemporaryDirectory() as directory:
+        datasets = [("bundled", schedule_files()),
+                    ("synthetic x{}".format(SYNTHETIC_SCALE), _write_synthetic_schedules(directory, SYNTHETIC_SCALE))]
+        for name, filenames in datasets:
+            print(name)
+            for label, loader in loaders:
+                start = time.perf_counter()
+                rows = loader(filenames)
+                elapsed = time.perf_counter() - start
+                print("  {:<36} {:>9} rows {:8.2f} s {:>12,.0f} rows/s".format(label, rows, elapsed, rows / elapsed))
+
+
+# Seconds the fixture server waits before every response, standing in for the round trip to the real site
+SCRAPE_LATENCY = 0.05
+
+
+def _scrape_sequentially(links, directory):
+    """
+    Fetches the pages the way the scraper used to, one at a time with a bare requests.get for each
+    :param links: list of [line, url] pairs
+    :param directory: the directory to save the pages to
+    :return: the number of pages fetched
+    """
+    fetched = 0
+    for line, url in links:
+        resp = requests.get(url)
+        if resp.ok:
+            save(line, resp.content, directory)
+            fetched += 1
+    return fetched
+
+
+def benchmark_scrape(pairs, seed):
+    """
+    Compares the pages per second of fetching the line pages one at a time with a new connection for each, one at a
+    time over the pooled session, and with the thread pool, against the local fixture server serving html_pages
+    with SCRAPE_LATENCY seconds of latency. Also times resuming a finished scrape, and a scrape where the first
+    request for every page fails and is retried.
+    :param pairs: unused
+    :param seed: unused
+    :return: None
+    """
+    with FixtureServer(latency=SCRAPE_LATENCY) as server, tempfile.TemporaryDirectory() as directory:
+        links = yieldLineLinks(Fetcher(), server.url, directory)
+        runs = [
+            ("requests.get, one at a time", lambda: {"fetched": _scrape_sequentially(links, directory)}),
+            ("pooled session, one at a time", lambda: scrape_pages(links, Fetcher(), directory, 1, resume=False)),
+            ("pooled session, {} threads".format(WORKERS),
+             lambda: scrape_pages(links, Fetcher(), directory, WORKERS, resume=False)),
+            ("resumed", lambda: scrape_pages(links, Fetcher(), directory, WORKERS))
+        ]
+        for label, run in runs:
+            start = time.perf_counter()
+            counts = run()
+            elapsed = time.perf_counter() - start
+            pages = counts["fetched"] + counts.get("skipped", 0)
+            print("  {:<36} {:>4} pages {:8.2f} s {:>10,.1f} pages/s".format(label, pages, elapsed, pages / elapsed))
+
+    with FixtureServer(latency=SCRAPE_LATENCY, failures=1) as server, tempfile.TemporaryDirectory() as directory:
+        fetcher = Fetcher(backoff=SCRAPE_LATENCY)
+        start = time.perf_counter()
+        counts = scrape_pages(yieldLineLinks(fetcher, server.url, directory), fetcher, directory, WORKERS)
+        elapsed = time.perf_counter() - start
+        print("  {:<36} {:>4} pages {:8.2f} s {:>10,.1f} pages/s, {} retries".format(
+            "first request of every page fails", counts["fetched"], elapsed, counts["fetched"] / elapsed,
+            fetcher.retried))
+
+
+BENCHMARKS = {
+    "projection": benchmark_projection,
+    "astar": benchmark_astar,
+    "parse": benchmark_parse,
+    "scrape": benchmark_scrape
+}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("benchmark", choices=sorted(BENCHMARKS.keys()))
+    parser.add_argument("--pairs", type=int, default=100)
+    parser.add_argument("--seed", type=int, default=464)
+    args = parser.parse_args()
+    BENCHMARKS[args.benchmark](args.pairs, args.seed)
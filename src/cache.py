@@ -0,0 +1,95 @@
+from __future__ import annotations
+import pickle
+import threading
+import time
+from collections import OrderedDict
+
+
+class RouteCache:
+    """
+    Least-recently-used cache with a time to live and a cap on the memory used by the cached values. The size of a
+    value is estimated by the length of its pickled form.
+    """
+    def __init__(self, max_bytes: int = 16 * 1024 * 1024, ttl: float = 300):
+        """
+        :param max_bytes: the maximum number of bytes the cached values can take up
+        :param ttl: the number of seconds an entry stays valid
+        """
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Gets the value cached for a key
+        :param key: the key
+        :return: the value, or None if the key isn't cached or has expired
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            expires, size, value = entry
+            if expires < time.monotonic():
+                self._remove(key)
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        """
+        Caches a value, evicting the least recently used entries until it fits
+        :param key: the key
+        :param value: the value
+        :return: None
+        """
+        size = len(pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL))
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            while self.size + size > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+            self._entries[key] = (time.monotonic() + self.ttl, size, value)
+            self.size += size
+
+    def clear(self):
+        """
+        Removes every entry
+        :return: None
+        """
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def _remove(self, key):
+        expires, size, value = self._entries.pop(key)
+        self.size -= size
+
+    def stats(self) -> dict:
+        """
+        Gets the counters of the cache
+        :return: dictionary of the hits, misses, evictions, expirations, number of entries and bytes used
+        """
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "entries": len(self._entries),
+                "bytes": self.size,
+                "max_bytes": self.max_bytes
+            }
@@ -2,6 +2,7 @@ import sys
 
 from src.models import User
 from src.service import UserService
+from src import require_mysql
 
 
 """
@@ -13,6 +14,7 @@ argv = sys.argv
 if "-e" not in argv or "-p" not in sys.argv:
     print("Invalid arguments")
 else:
+    require_mysql()
     user = User(email=argv[argv.index("-e")+1], password=argv[argv.index("-p")+1], is_admin=True)
     user_service = UserService()
     user_service.add_user(user)
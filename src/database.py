@@ -1,8 +1,11 @@
+import argparse
+import sys
 import pandas as pd
 import os
 import pymongo
 from pymongo import MongoClient
 import re
+import time
 import numpy as np
 from os import walk
 from os import listdir
@@ -16,160 +19,127 @@ from sqlalchemy.exc import OperationalError
 from src.models import SubwayStation, TrainLine, Schedule
 from src.service import MapService, ScheduleService
 from src.repository import ScheduleRepository, MapRepository, metadata
+from src.ingest import parse_schedule_files, schedule_files, file_hash, line_direction, intern_schedule_stations
+from src.snapshot import write_snapshot, build_from_mongo
+from src.network import load_network
+from src import app, require_mysql
 
 
 def init_map_db():
     """
-    Initializes the graph database
-    :return: None
+    Initializes the graph database from the compiled network artifact, compiling it first if the map files or the
+    alias table changed. The stations and connections are written with a few UNWIND queries.
+    :return: tuple of the number of nodes and relationships created
     """
-
-    # Initialize MapService to add the SubwayStations and CONNECTS relationships
     map_repo = MapRepository()
     map_repo.clear_db()
-    map_service = MapService()
-
-    total_nodes = 0
-    total_relationships = 0
-
-    directory = "data"
-    csvs = ['{}/{}'.format(directory, csv) for csv in os.listdir(directory)]
-    for csv in csvs:
-        line = csv.split('/')[1].split('.')[0]
-
-        df = pd.read_csv(csv)
-        df.fillna('Not Found', inplace=True)
-
-        for index in range(0, len(df)):
-            row = df.loc[index]
-            subway_station = SubwayStation.from_csv_row(row)
-            subway_station.lines = [line for line in subway_station.lines if line != ""]
-            if subway_station.station_name == "World Trade Center":
-                subway_station.lines = "1,2,3,A,C,E,N,Q,R,W".split(",")
-            elif subway_station.station_name == "Bleecker St":
-                subway_station.lines = "4,6,6X,B,D,F,M".split(",")
-            elif subway_station.station_name == "45 St":
-                subway_station.lines = "N,R".split(",")
-            elif subway_station.station_name == "Whitehall St":
-                subway_station.lines = "N,Q,R,W".split(",")
-            station_res = map_service.create_station(subway_station)
-            if index > 0:
-                prev_row = df.loc[index - 1]
-                prev_subway_station = SubwayStation.from_csv_row(prev_row)
-                train_line = TrainLine(start=prev_subway_station, stop=subway_station, line=line)
-                train_line_res = map_service.create_connection(train_line)
-                total_relationships += 1
-            total_nodes += 1
-
-
-def init_schedule_db():
-    schedule_repository = ScheduleRepository()
-    schedule_repository.clear_db()
-
-    onlyfiles = ['{}/{}'.format('Trains', f) for f in listdir('Trains') if isfile(join('Trains', f))]
-    filtered = list(filter(lambda k: 'csv' in k, onlyfiles))
-
-    for i in range(len(filtered)):
-        filename = str(filtered[i])
-        df = pd.read_csv(filename)
-        df.dropna(inplace=True)
-        stations_lines = df.columns.values.tolist()
-        stations = [' '.join(station.rstrip().split(" ")[:-1]) for station in stations_lines]
-        lines = [lines.rstrip().split(" ")[-1][1:-1] for lines in stations_lines]
-        stations = fix_schedule_exceptions(stations, lines)
-        split_file_name = filename.split('/')[1].split('-')
-
-        line = str(split_file_name[0])
-        direction = str(split_file_name[-2])
-        direction = direction + '-bound'
-
-        documents_array = []
-
-        for index, row in df.iterrows():
-            values = row.values
-            good_indices = [i for i in range(0, len(values)) if values[i] != "—" and values[i] != np.nan
-                            and values[i] != "-"]
-            try:
-                times = [values[i].rstrip() \
-                             .replace("#", '') \
-                             .replace("*", "") \
-                             .replace("+", "") \
-                             .replace("^", "") \
-                             .lstrip() \
-                             .rstrip() for i in good_indices]
-            except (IndexError, ValueError) as e:
-                print(e)
-            curr_stations = [stations[i] for i in good_indices]
-            try:
-                new_times = [datetime.strptime(time, "%H:%M") for time in times]
-                prev_time = new_times[0]
-                for j in range(1, len(new_times)):
-                    if new_times[j] < prev_time:
-                        new_times[j] = new_times[j].replace(year=1900, month=1, day=2)
-                        prev_time = new_times[j]
-
-                res = {curr_stations[j]: new_times[j] for j in range(len(curr_stations))}
-            except ValueError:
-                continue
-            train = {
-                "Line": line,
-                "Direction": direction,
-                "Schedule": res
-            }
-
-            documents_array.append(train)
-
-        schedule_repository.bulk_insert_schedules(documents_array)
-
-
-def fix_schedule_exceptions(stations, lines):
+    created = map_repo.ensure_indexes()
+    if len(created) > 0:
+        print("Created the graph indexes {}".format(", ".join(created)))
+
+    start = time.perf_counter()
+    network = load_network(app.config['NETWORK_ARTIFACT'])
+    if len(network.problems) > 0:
+        print("The network has {} problems, see python -m src.network".format(len(network.problems)))
+    ids = map_repo.create_stations(network.stations)
+    total_relationships = map_repo.create_connections([(ids[a], ids[b], line) for a, b, line in network.edges])
+    total_nodes = len(ids)
+    print("Created {} stations and {} connections in {:.2f} s".format(total_nodes, total_relationships,
+                                                                        time.perf_counter() - start))
+
+    # Project the new graph for shortest path queries, and have running workers rebuild their snapshots
+    map_repo.refresh_projection()
+    map_repo.bump_graph_version()
+    return total_nodes, total_relationships
+
+
+def print_storage(schedule_repo: ScheduleRepository):
+    """
+    Prints the storage used by every schedule collection
+    :param schedule_repo: the ScheduleRepository
+    :return: None
+    """
+    for name, stats in schedule_repo.storage_stats().items():
+        print("{:<20} {:>8} documents {:>10,.0f} KB data {:>10,.0f} KB on disk {:>10,.0f} KB indexes".format(
+            name, stats["count"], stats["size"] / 1024, stats["storageSize"] / 1024, stats["totalIndexSize"] / 1024))
+
+
+def profile_map_queries(map_repo: MapRepository) -> bool:
+    """
+    Prints the operators of the plans of the station and connection lookups
+    :param map_repo: the MapRepository
+    :return: True if all of them start from an index seek instead of a scan
     """
-    Fixes errors in station names and lines for the Schedule Collection
-    :param stations: list of stations
-    :param lines: list of lines
-    :return:
+    ok = True
+    for name, operators in map_repo.profile_hot_queries().items():
+        uses_index = any("IndexSeek" in operator for operator in operators) and \
+            not any(operator.endswith("Scan") for operator in operators)
+        ok = ok and uses_index
+        print("{:<35} {:<6} {}".format(name, "OK" if uses_index else "FAIL", " <- ".join(operators)))
+    return ok
+
+
+def init_schedule_db(workers: int = None, chunk_size: int = 1000, full: bool = False):
     """
-    for i in range(0, len(stations)):
-        station = stations[i]
-        if station == "Wtc - Cortlandt" or station == "Park Place Station" or station == "World Trade Center":
-            stations[i] = "World Trade Center"
-            lines[i] = "1,2,3,A,C,E,N,Q,R,W"
-        if station == "51 St" or station == "Lexington Av/53 St":
-            stations[i] = "Lexington Av/53 St"
-            lines[i] = "4,6,6X,E,M"
-        if station == "Lexington Av/63 St" or station == "Lexington Av / 59 St":
-            stations[i] = "Lexington Av / 59 St"
-            lines[i] = "4,5,6,F,N,Q,R"
-        if station == "Broadway-Lafayette St" or station == "Bleecker St":
-            stations[i] = "Bleecker St"
-            lines[i] = "4,6,6X,B,D,F,M"
-        if station == "E 180th":
-            lines[i] = "2,5"
-        if station == "61 St":
-            stations[i] = "New Utrecht Av"
-            lines[i] = "D,N,W"
-        if station == "Canal St" and "6" in lines[i]:
-            lines[i] = "N,Q,R,J,Z,4,6"
-        if station == "East 174 Street Station Subway":
-            lines[i] = "2,5"
-        if station == "Jay St - Metrotech":
-            lines[i] = "A,C,F,N,Q,R"
-        if station == "45 St":
-            lines[i] = "N,R"
-        if station == "Court St":
-            lines[i] = "N,Q,R"
-        if station == "Rector St" and lines[i] == "N,R":
-            lines[i] = "N,Q,R"
-        if station == "City Hall":
-            lines[i] = "N,Q,R"
-        if station == "Whitehall St":
-            lines[i] = "N,Q,R,W"
-        if station == "45 St":
-            lines[i] = "N,R"
-
-    stations = ["{} [{}]".format(station, ','.join(sorted(line.split(','))).upper()) for station, line in
-                zip(stations, lines)]
-    return stations
+    Loads the schedules in Trains/*.csv into the Schedule collection. A manifest of the content hash of every file
+    is kept, and only the (Line, Direction) pairs whose files changed, were added or were removed since the last load
+    are reloaded. The files are parsed in a process pool. The compressed Timetable collection is compiled again for
+    the pairs that were reloaded, and the timetable snapshot is rewritten.
+    :param workers: the number of worker processes, defaults to the number of CPUs
+    :param chunk_size: the maximum number of documents per insert
+    :param full: if True, ignore the manifest and reload every file
+    :return: None
+    """
+    schedule_repository = ScheduleRepository()
+    filenames = schedule_files('Trains')
+    # The workers look the station ids up, so they are all interned before parsing starts
+    intern_schedule_stations('Trains')
+    entries = {}
+    for filename in filenames:
+        line, direction = line_direction(filename)
+        entries[os.path.basename(filename)] = {"_id": os.path.basename(filename),
+                                               "Line": line,
+                                               "Direction": direction,
+                                               "hash": file_hash(filename)}
+    manifest = {} if full else schedule_repository.get_manifest()
+
+    if len(manifest) == 0:
+        # Nothing to compare against, so build the whole collection and swap it in
+        count = schedule_repository.load_all_schedules(parse_schedule_files(filenames, workers=workers,
+                                                                            chunk_size=chunk_size))
+        schedule_repository.save_manifest(list(entries.values()), replace=True)
+        timetable = ScheduleService().compile_timetable()
+        write_snapshot(timetable, app.config['TIMETABLE_SNAPSHOT'], source="mongo")
+        print("Loaded {} schedules from {} files, compressed to {} runs and {} exceptions".format(
+            count, len(filenames), sum(len(line.runs) for line in timetable.lines.values()),
+            sum(len(line.exceptions) for line in timetable.lines.values())))
+        return
+
+    changed = [name for name, entry in entries.items()
+               if name not in manifest or manifest[name]["hash"] != entry["hash"]]
+    removed = [name for name in manifest if name not in entries]
+    line_directions = set([(entries[name]["Line"], entries[name]["Direction"]) for name in changed] +
+                          [(manifest[name]["Line"], manifest[name]["Direction"]) for name in removed])
+    if len(line_directions) == 0:
+        print("Schedules are up to date")
+        return
+
+    # Every file of a changed pair is parsed again, since the pair is replaced as a whole
+    documents_by_line_direction = {pair: [] for pair in line_directions}
+    changed_files = [filename for filename in filenames if line_direction(filename) in line_directions]
+    for documents in parse_schedule_files(changed_files, workers=workers, chunk_size=chunk_size):
+        for document in documents:
+            documents_by_line_direction[(document["Line"], document["Direction"])].append(document)
+    schedule_repository.replace_schedules(documents_by_line_direction)
+    schedule_repository.ensure_indexes()
+    schedule_service = ScheduleService()
+    for line, direction in line_directions:
+        schedule_service.compile_line_direction(line, direction)
+    write_snapshot(build_from_mongo(), app.config['TIMETABLE_SNAPSHOT'], source="mongo")
+
+    schedule_repository.save_manifest([entries[name] for name in changed])
+    schedule_repository.remove_manifest_entries(removed)
+    print("Reloaded {} of {} schedule files".format(len(changed_files), len(filenames)))
 
 
 def init_user_and_trip_db():
@@ -196,6 +166,25 @@ def init_user_and_trip_db():
 
 
 if __name__ == "__main__":
-    init_map_db()
-    init_schedule_db()
-    init_user_and_trip_db()
\ No newline at end of file
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--schedules-only", action="store_true", help="only reload the changed schedules")
+    parser.add_argument("--full", action="store_true", help="reload every schedule file")
+    parser.add_argument("--profile-map", action="store_true",
+                        help="only check that the graph lookups use their indexes")
+    parser.add_argument("--storage", action="store_true", help="only print the storage used by the schedules")
+    args = parser.parse_args()
+
+    if not (args.storage or args.profile_map or args.schedules_only):
+        require_mysql()
+    if args.storage:
+        print_storage(ScheduleRepository())
+    elif args.profile_map:
+        if not profile_map_queries(MapRepository()):
+            sys.exit(1)
+    elif args.schedules_only:
+        init_schedule_db(full=args.full)
+    else:
+        init_map_db()
+        profile_map_queries(MapRepository())
+        init_schedule_db(full=args.full)
+        init_user_and_trip_db()
\ No newline at end of file
@@ -0,0 +1,113 @@
+from __future__ import annotations
+import threading
+from typing import List
+
+from src.models import Schedule
+from src.timetable import format_minutes
+
+
+class DelayRegistry:
+    """
+    The delayed trains, kept in memory so that the delays page doesn't query MongoDB. The rows of the page are sorted
+    the first time they are read after the delays change, and reused until the next change.
+    """
+    def __init__(self):
+        self.version = 0
+        self._delays = {}
+        self._rows = None
+        self._lock = threading.Lock()
+
+    def load(self, schedules: List[Schedule]):
+        """
+        Replaces every delay
+        :param schedules: the delayed Schedules, without their delay applied
+        :return: None
+        """
+        with self._lock:
+            self._delays = {schedule.trip: schedule for schedule in schedules}
+            self._changed()
+
+    def put(self, schedule: Schedule) -> bool:
+        """
+        Adds the delay of a train, or replaces the delay it already has
+        :param schedule: the Schedule, without its delay applied, with its delay
+        :return: False if the train already had the same delay, otherwise True
+        """
+        with self._lock:
+            current = self._delays.get(schedule.trip)
+            if current is not None and current.delay == schedule.delay:
+                return False
+            self._delays[schedule.trip] = schedule
+            self._changed()
+            return True
+
+    def remove(self, trip: str) -> Schedule:
+        """
+        Removes the delay of a train
+        :param trip: the trip id
+        :return: the Schedule of the train, or None if it wasn't delayed
+        """
+        with self._lock:
+            schedule = self._delays.pop(trip, None)
+            if schedule is not None:
+                self._changed()
+            return schedule
+
+    def get(self, trip: str) -> Schedule:
+        """
+        Gets a delayed train
+        :param trip: the trip id
+        :return: the Schedule, or None if the train isn't delayed
+        """
+        return self._delays.get(trip)
+
+    def delays(self) -> dict:
+        """
+        Gets the delay of every delayed train
+        :return: dictionary of the trip id to the delay, as {"start": station, "time": minutes}
+        """
+        with self._lock:
+            return {trip: schedule.delay for trip, schedule in self._delays.items()}
+
+    def schedules(self, line: str = None, direction: str = None) -> List[Schedule]:
+        """
+        Gets the delayed trains, optionally only those of a line and direction
+        :param line: the line
+        :param direction: the direction
+        :return: List[Schedule] without their delays applied
+        """
+        with self._lock:
+            return [schedule for schedule in self._delays.values()
+                    if line is None or (schedule.line == line and schedule.direction == direction)]
+
+    def rows(self) -> List[dict]:
+        """
+        Gets the delays for the delays page, sorted by line and departure time
+        :return: list of dictionaries of the Line, Direction, Time, Starting Station, Trip and Delay
+        """
+        with self._lock:
+            if self._rows is None:
+                self._rows = self._sorted_rows()
+            return self._rows
+
+    def __len__(self):
+        return len(self._delays)
+
+    def _changed(self):
+        self._rows = None
+        self.version += 1
+
+    def _sorted_rows(self) -> List[dict]:
+        rows = []
+        for schedule in self._delays.values():
+            departure = min(schedule.schedule.values())
+            rows.append((schedule.line, departure, {
+                "Line": schedule.line,
+                "Direction": schedule.direction,
+                "Time": format_minutes(departure),
+                "Starting Station": schedule.delay["start"],
+                "Trip": schedule.trip,
+                "Delay": schedule.delay["time"]
+            }))
+        rows.sort(key=lambda row: row[:2])
+        return [row[2] for row in rows]
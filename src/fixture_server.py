@@ -0,0 +1,151 @@
+import argparse
+import ast
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+from src.moovit import INDEX, PAGE_DIRECTORY, line_name
+
+
+"""
+Local HTTP server that serves the saved pages in html_pages in place of the Moovit site, so that the scraper can be
+run and benchmarked offline. The index of the lines is served from content.html and the page of a line from
+<line>.html, under any path. Run with
+python -m src.fixture_server [--port PORT] [--latency SECONDS] [--failures N]
+and scrape it with python -m src.scraper --fetch --site <the url it prints>
+"""
+
+
+class FixtureServer:
+    """
+    Serves the pages of a directory from a background thread. Every response can be delayed by 'latency' seconds to
+    stand in for the round trip to the real site, and the first 'failures' requests for every page are answered with
+    503 so that the retries of the scraper are exercised.
+    """
+    def __init__(self, directory: str = PAGE_DIRECTORY, latency: float = 0.0, failures: int = 0, port: int = 0):
+        """
+        :param directory: the directory of the saved pages
+        :param latency: the number of seconds to wait before every response
+        :param failures: the number of requests for every page that fail before it is served
+        :param port: the port to listen on, defaults to a free one
+        """
+        self.directory = directory
+        self.latency = latency
+        self.failures = failures
+        # Number of requests answered, by path
+        self.requests = {}
+        self._pages = {}
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(("127.0.0.1", port), self._handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        """
+        The url to scrape instead of scraper.SITE
+        """
+        return "http://127.0.0.1:{}/index/en/".format(self._server.server_address[1])
+
+    def start(self) -> "FixtureServer":
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def wait(self):
+        self._thread.join()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def page(self, path: str) -> bytes:
+        """
+        Gets the contents of the page for a path. The pages were saved as the repr of the bytes that were fetched,
+        so they are turned back into those bytes.
+        :param path: the path of the request
+        :return: the contents, or None if there is no page for the path
+        """
+        name = os.path.basename(urlsplit(path).path)
+        if name == INDEX:
+            filename = "content"
+        elif name.startswith("public_transit-line-"):
+            filename = line_name(name)
+        else:
+            return None
+        with self._lock:
+            if filename not in self._pages:
+                self._pages[filename] = self._read(os.path.join(self.directory, "{}.html".format(filename)))
+            return self._pages[filename]
+
+    def _read(self, filename: str) -> bytes:
+        if not os.path.exists(filename):
+            return None
+        with open(filename, encoding="utf-8") as f:
+            content = f.read()
+        if content.startswith("b'") or content.startswith('b"'):
+            return ast.literal_eval(content)
+        return content.encode("utf-8")
+
+    def _count(self, path: str) -> int:
+        with self._lock:
+            self.requests[path] = self.requests.get(path, 0) + 1
+            return self.requests[path]
+
+    def _handler(self):
+        fixture = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # Keeps connections open between requests, so that the scraper's connection pool is used
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                if fixture.latency > 0:
+                    time.sleep(fixture.latency)
+                if fixture._count(self.path) <= fixture.failures:
+                    self._respond(503, b"Service Unavailable", {"Retry-After": "0"})
+                    return
+                content = fixture.page(self.path)
+                if content is None:
+                    self._respond(404, b"Not Found")
+                else:
+                    self._respond(200, content)
+
+            def _respond(self, status: int, content: bytes, headers: dict = None):
+                self.send_response(status)
+                self.send_header("Content-Type", "text/html; charset=utf-8")
+                self.send_header("Content-Length", str(len(content)))
+                for key, value in (headers or {}).items():
+                    self.send_header(key, value)
+                self.end_headers()
+                self.wfile.write(content)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--directory", default=PAGE_DIRECTORY)
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds to wait before every response")
+    parser.add_argument("--failures", type=int, default=0, help="requests for every page answered with 503")
+    args = parser.parse_args()
+
+    server = FixtureServer(args.directory, args.latency, args.failures, args.port)
+    print("Serving {} at {}".format(args.directory, server.url))
+    try:
+        server.start().wait()
+    except KeyboardInterrupt:
+        server.stop()
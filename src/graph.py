@@ -0,0 +1,371 @@
+from __future__ import annotations
+import numpy as np
+from collections import deque
+from heapq import heappush, heappop
+from typing import List
+
+from src.models import SubwayStation
+
+
+# Marks a pair of stations with no path between them in the all-pairs matrices
+UNREACHABLE = -1
+
+# Coordinates that scraper.get_coordinates falls back to when an address can't be geocoded
+PLACEHOLDER_COORDINATES = (40.7127281, -74.0060152)
+
+# Upper bound on the speed of a train, in kilometers per minute (90 km/h)
+MAX_TRAIN_SPEED = 1.5
+
+# Running time for connections that have no schedule
+DEFAULT_RUNNING_MINUTES = 2
+
+EARTH_RADIUS = 6371.0
+
+
+def great_circle_distance(latitude_1, longitude_1, latitude_2, longitude_2):
+    """
+    Gets the great-circle distance between two points with the haversine formula. Works on NumPy arrays.
+    :param latitude_1: latitude of the first point, in radians
+    :param longitude_1: longitude of the first point, in radians
+    :param latitude_2: latitude of the second point, in radians
+    :param longitude_2: longitude of the second point, in radians
+    :return: the distance in kilometers
+    """
+    a = np.sin((latitude_2 - latitude_1) / 2) ** 2 \
+        + np.cos(latitude_1) * np.cos(latitude_2) * np.sin((longitude_2 - longitude_1) / 2) ** 2
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(a))
+
+
+def _coordinate(value) -> float:
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return np.nan
+
+
+def normalize_line(line: str) -> str:
+    """
+    Maps the 7X and 6X to the 7 and 6, which they share schedules with
+    :param line: the line
+    :return: the normalized line
+    """
+    if line == "7X":
+        return "7"
+    elif line == "6X":
+        return "6"
+    return line
+
+
+class GraphSnapshot:
+    """
+    In-memory copy of the SubwayStation nodes and their CONNECTS and REROUTES relationships, stored as a compressed
+    sparse row (CSR) adjacency. Relationships are stored in both directions, the same way the shortest path
+    projection treats them. Neo4j remains the source of truth; the snapshot is tagged with the graph version it was
+    built from.
+    """
+    def __init__(self, stations: List[SubwayStation], edges: List[tuple], version: int = 0):
+        """
+        :param stations: the SubwayStation objects, in node order
+        :param edges: list of (start index, end index, line) tuples
+        :param version: the graph version the snapshot was built from
+        """
+        self.version = version
+        self.stations = stations
+        self.index = {(station.station_name, station.entrances): i for i, station in enumerate(stations)}
+        self.active = np.array([station.status == "Normal" for station in stations], dtype=bool)
+
+        self.lines = sorted(set([edge[2] for edge in edges]))
+        line_codes = {line: i for i, line in enumerate(self.lines)}
+
+        # Every relationship is added in both directions
+        sources = np.array([edge[0] for edge in edges] + [edge[1] for edge in edges], dtype=np.int32)
+        targets = np.array([edge[1] for edge in edges] + [edge[0] for edge in edges], dtype=np.int32)
+        codes = np.array([line_codes[edge[2]] for edge in edges] * 2, dtype=np.int16)
+
+        order = np.argsort(sources, kind='stable')
+        self.indices = targets[order]
+        self.edge_lines = codes[order]
+        self.indptr = np.zeros(len(stations) + 1, dtype=np.int32)
+        np.cumsum(np.bincount(sources, minlength=len(stations)), out=self.indptr[1:])
+
+        # All-pairs matrices, computed the first time they are needed
+        self.hops = None
+        self.transfers = None
+
+        # Coordinates in radians, NaN for stations that weren't geocoded
+        latitude = np.array([_coordinate(station.latitude) for station in stations], dtype=float)
+        longitude = np.array([_coordinate(station.longitude) for station in stations], dtype=float)
+        placeholder = (latitude == PLACEHOLDER_COORDINATES[0]) & (longitude == PLACEHOLDER_COORDINATES[1])
+        latitude[placeholder] = np.nan
+        longitude[placeholder] = np.nan
+        self.latitude = np.radians(latitude)
+        self.longitude = np.radians(longitude)
+        self.weights = np.full(len(self.indices), DEFAULT_RUNNING_MINUTES, dtype=float)
+        self._check_coordinates()
+
+    @classmethod
+    def from_records(cls, nodes: list, relationships: list, version: int = 0) -> GraphSnapshot:
+        """
+        Builds the snapshot from the records returned by MapRepository.get_graph
+        :param nodes: records with the id of every SubwayStation node and the node itself
+        :param relationships: records with the start id, end id and line of every relationship
+        :param version: the graph version
+        :return: GraphSnapshot
+        """
+        positions = {}
+        stations = []
+        for record in nodes:
+            positions[record['id']] = len(stations)
+            stations.append(SubwayStation.from_node(record['s']))
+        edges = [(positions[record['start']], positions[record['end']], record['line']) for record in relationships
+                 if record['start'] in positions and record['end'] in positions]
+        return cls(stations, edges, version)
+
+    def station_index(self, station: SubwayStation):
+        """
+        Gets the position of a SubwayStation in the snapshot
+        :param station: SubwayStation object
+        :return: the index, or None if the station is not in the snapshot
+        """
+        return self.index.get((station.station_name, station.entrances))
+
+    def neighbors(self, i: int) -> np.ndarray:
+        return self.indices[self.indptr[i]:self.indptr[i + 1]]
+
+    def lines_between(self, i: int, j: int) -> List[str]:
+        """
+        Gets the lines of all of the relationships between two stations
+        :param i: index of the first station
+        :param j: index of the second station
+        :return: list of lines
+        """
+        start, end = self.indptr[i], self.indptr[i + 1]
+        codes = self.edge_lines[start:end][self.indices[start:end] == j]
+        return [self.lines[code] for code in codes]
+
+    def lines_along(self, path: List[int]) -> List[List[str]]:
+        """
+        Gets the lines connecting each pair of consecutive stations in a path
+        :param path: list of station indices
+        :return: list containing the lines for each pair of stations
+        """
+        return [self.lines_between(path[i], path[i + 1]) for i in range(0, len(path) - 1)]
+
+    def shortest_path(self, start: int, stop: int) -> List[int]:
+        """
+        Gets the path with the fewest stops between two stations, only going through stations whose status is
+        "Normal"
+        :param start: index of the starting station
+        :param stop: index of the ending station
+        :return: list of station indices, or None if there is no path
+        """
+        if not self.active[start] or not self.active[stop]:
+            return None
+        previous = {start: None}
+        queue = deque([start])
+        while len(queue) > 0:
+            current = queue.popleft()
+            if current == stop:
+                break
+            for neighbor in self.neighbors(current).tolist():
+                if neighbor not in previous and self.active[neighbor]:
+                    previous[neighbor] = current
+                    queue.append(neighbor)
+        if stop not in previous:
+            return None
+
+        path = [stop]
+        while previous[path[0]] is not None:
+            path.insert(0, previous[path[0]])
+        return path
+
+    def set_running_times(self, running_times: dict):
+        """
+        Weights every connection by its running time. Connections without a running time keep
+        DEFAULT_RUNNING_MINUTES.
+        :param running_times: dictionary mapping sorted pairs of schedule keys to minutes
+        :return: None
+        """
+        keys = [station.schedule_key() for station in self.stations]
+        for i in range(0, len(self.stations)):
+            for position in range(self.indptr[i], self.indptr[i + 1]):
+                pair = tuple(sorted((keys[i], keys[self.indices[position]])))
+                if pair in running_times:
+                    self.weights[position] = running_times[pair]
+        self._check_coordinates()
+
+    def _check_coordinates(self):
+        """
+        Marks which stations have coordinates that the A* heuristic can use. Besides missing and placeholder
+        coordinates, a station is left out if reaching a neighbor would need a train faster than MAX_TRAIN_SPEED,
+        since one of the two was geocoded to the wrong place.
+        :return: None
+        """
+        sources = np.repeat(np.arange(len(self.stations)), np.diff(self.indptr))
+        distances = great_circle_distance(self.latitude[sources], self.longitude[sources],
+                                          self.latitude[self.indices], self.longitude[self.indices])
+        too_fast = distances > self.weights * MAX_TRAIN_SPEED
+        valid = ~np.isnan(self.latitude) & ~np.isnan(self.longitude)
+        valid[sources[too_fast]] = False
+        valid[self.indices[too_fast]] = False
+        self.has_coordinates = valid
+
+    def heuristic(self, stop: int) -> np.ndarray:
+        """
+        Gets a lower bound on the running time from every station to 'stop': the great-circle distance divided by
+        MAX_TRAIN_SPEED. Stations without usable coordinates get 0.
+        :param stop: index of the ending station
+        :return: array of minutes
+        """
+        if not self.has_coordinates[stop]:
+            return np.zeros(len(self.stations))
+        distances = great_circle_distance(self.latitude, self.longitude, self.latitude[stop], self.longitude[stop])
+        return np.where(self.has_coordinates, distances / MAX_TRAIN_SPEED, 0.0)
+
+    def search(self, start: int, stop: int, use_heuristic: bool = True) -> (List[int], int):
+        """
+        Gets the path with the least running time between two stations, only going through stations whose status is
+        "Normal". Runs A* with the geographic heuristic, or uniform-cost search without it.
+        :param start: index of the starting station
+        :param stop: index of the ending station
+        :param use_heuristic: whether to use the geographic heuristic
+        :return: list of station indices (None if there is no path) and the number of stations expanded
+        """
+        if not self.active[start] or not self.active[stop]:
+            return None, 0
+        heuristic = self.heuristic(stop).tolist() if use_heuristic else [0.0] * len(self.stations)
+
+        costs = {start: 0.0}
+        previous = {start: None}
+        heap = [(heuristic[start], 0.0, start)]
+        expanded = 0
+        while len(heap) > 0:
+            estimate, cost, current = heappop(heap)
+            if cost > costs[current]:
+                continue
+            if current == stop:
+                break
+            expanded += 1
+            start_position, end_position = self.indptr[current], self.indptr[current + 1]
+            for neighbor, weight in zip(self.indices[start_position:end_position].tolist(),
+                                        self.weights[start_position:end_position].tolist()):
+                if not self.active[neighbor]:
+                    continue
+                new_cost = cost + weight
+                if new_cost < costs.get(neighbor, float('inf')):
+                    costs[neighbor] = new_cost
+                    previous[neighbor] = current
+                    heappush(heap, (new_cost + heuristic[neighbor], new_cost, neighbor))
+        if stop not in previous:
+            return None, expanded
+
+        path = [stop]
+        while previous[path[0]] is not None:
+            path.insert(0, previous[path[0]])
+        return path, expanded
+
+    def fastest_path(self, start: int, stop: int) -> List[int]:
+        """
+        Gets the path with the least running time between two stations with A*
+        :param start: index of the starting station
+        :param stop: index of the ending station
+        :return: list of station indices, or None if there is no path
+        """
+        return self.search(start, stop, use_heuristic=True)[0]
+
+    def compute_distance_matrices(self):
+        """
+        Computes the fewest stops and the fewest transfers between every pair of stations whose status is "Normal".
+        Unreachable pairs are marked with UNREACHABLE.
+        :return: None
+        """
+        n = len(self.stations)
+        hops = np.full((n, n), UNREACHABLE, dtype=np.int16)
+        for source in range(0, n):
+            if not self.active[source]:
+                continue
+            hops[source, source] = 0
+            frontier = [source]
+            distance = 0
+            while len(frontier) > 0:
+                distance += 1
+                next_frontier = []
+                for current in frontier:
+                    for neighbor in self.neighbors(current).tolist():
+                        if hops[source, neighbor] == UNREACHABLE and self.active[neighbor]:
+                            hops[source, neighbor] = distance
+                            next_frontier.append(neighbor)
+                frontier = next_frontier
+
+        # Transfers are counted over (station, line) states. Riding along a line is free and changing lines at a
+        # station costs one transfer. 7X and 6X are the same trains as the 7 and 6.
+        line_names = [normalize_line(line) for line in self.lines]
+        states = {}
+        state_station = []
+        for station in range(0, n):
+            start, end = self.indptr[station], self.indptr[station + 1]
+            for code in sorted(set(self.edge_lines[start:end].tolist())):
+                state = (station, line_names[code])
+                if state not in states:
+                    states[state] = len(state_station)
+                    state_station.append(station)
+        rides = [[] for i in range(0, len(state_station))]
+        for (station, line), state in states.items():
+            start, end = self.indptr[station], self.indptr[station + 1]
+            for neighbor, code in zip(self.indices[start:end].tolist(), self.edge_lines[start:end].tolist()):
+                if line_names[code] == line and self.active[neighbor]:
+                    rides[state].append(states[(neighbor, line)])
+        states_at = [[] for i in range(0, n)]
+        for state, station in enumerate(state_station):
+            states_at[station].append(state)
+
+        transfers = np.full((n, n), UNREACHABLE, dtype=np.int16)
+        for source in range(0, n):
+            if not self.active[source]:
+                continue
+            transfers[source, source] = 0
+            distance = {state: 0 for state in states_at[source]}
+            queue = deque(states_at[source])
+            while len(queue) > 0:
+                state = queue.popleft()
+                cost = distance[state]
+                station = state_station[state]
+                if transfers[source, station] == UNREACHABLE or cost < transfers[source, station]:
+                    transfers[source, station] = cost
+                # 0-1 BFS: riding to the next station is free, changing lines costs one
+                for next_state in rides[state]:
+                    if next_state not in distance or cost < distance[next_state]:
+                        distance[next_state] = cost
+                        queue.appendleft(next_state)
+                for next_state in states_at[station]:
+                    if next_state not in distance or cost + 1 < distance[next_state]:
+                        distance[next_state] = cost + 1
+                        queue.append(next_state)
+
+        self.hops = hops
+        self.transfers = transfers
+
+    def min_stops(self, i: int, j: int) -> int:
+        """
+        Gets the fewest stops between two stations
+        :param i: index of the first station
+        :param j: index of the second station
+        :return: the number of stops, or UNREACHABLE if there is no path
+        """
+        if self.hops is None:
+            self.compute_distance_matrices()
+        return int(self.hops[i, j])
+
+    def min_transfers(self, i: int, j: int) -> int:
+        """
+        Gets the fewest transfers between two stations
+        :param i: index of the first station
+        :param j: index of the second station
+        :return: the number of transfers, or UNREACHABLE if there is no path
+        """
+        if self.transfers is None:
+            self.compute_distance_matrices()
+        return int(self.transfers[i, j])
+
+    def is_connected(self, i: int, j: int) -> bool:
+        return self.min_stops(i, j) != UNREACHABLE
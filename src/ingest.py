@@ -0,0 +1,270 @@
+from __future__ import annotations
+import hashlib
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from typing import List, Iterator, Tuple
+import numpy as np
+import pandas as pd
+
+from src.stations import StationIds
+
+
+"""
+Parsing of the Trains/*.csv schedules into Schedule documents. It imports no repository, and importing the src package
+only creates the database clients without connecting, so the worker processes that parse the files never connect to
+a database, whether they are forked or spawned.
+"""
+
+
+# Cells that mark a stop the train skips
+SKIPPED_STOP = ["—", "-"]
+# Footnote marks that the source schedules append to times
+FOOTNOTE_MARKS = r"[#*+^]"
+
+
+def fix_schedule_exceptions(stations, lines):
+    """
+    Fixes errors in station names and lines for the Schedule Collection
+    :param stations: list of stations
+    :param lines: list of lines
+    :return:
+    """
+    for i in range(0, len(stations)):
+        station = stations[i]
+        if station == "Wtc - Cortlandt" or station == "Park Place Station" or station == "World Trade Center":
+            stations[i] = "World Trade Center"
+            lines[i] = "1,2,3,A,C,E,N,Q,R,W"
+        if station == "51 St" or station == "Lexington Av/53 St":
+            stations[i] = "Lexington Av/53 St"
+            lines[i] = "4,6,6X,E,M"
+        if station == "Lexington Av/63 St" or station == "Lexington Av / 59 St":
+            stations[i] = "Lexington Av / 59 St"
+            lines[i] = "4,5,6,F,N,Q,R"
+        if station == "Broadway-Lafayette St" or station == "Bleecker St":
+            stations[i] = "Bleecker St"
+            lines[i] = "4,6,6X,B,D,F,M"
+        if station == "E 180th":
+            lines[i] = "2,5"
+        if station == "61 St":
+            stations[i] = "New Utrecht Av"
+            lines[i] = "D,N,W"
+        if station == "Canal St" and "6" in lines[i]:
+            lines[i] = "N,Q,R,J,Z,4,6"
+        if station == "East 174 Street Station Subway":
+            lines[i] = "2,5"
+        if station == "Jay St - Metrotech":
+            lines[i] = "A,C,F,N,Q,R"
+        if station == "45 St":
+            lines[i] = "N,R"
+        if station == "Court St":
+            lines[i] = "N,Q,R"
+        if station == "Rector St" and lines[i] == "N,R":
+            lines[i] = "N,Q,R"
+        if station == "City Hall":
+            lines[i] = "N,Q,R"
+        if station == "Whitehall St":
+            lines[i] = "N,Q,R,W"
+        if station == "45 St":
+            lines[i] = "N,R"
+
+    stations = ["{} [{}]".format(station, ','.join(sorted(line.split(','))).upper()) for station, line in
+                zip(stations, lines)]
+    return stations
+
+
+def schedule_files(directory: str = "Trains") -> List[str]:
+    """
+    Gets the schedule CSV files in a directory
+    :param directory: the directory
+    :return: list of paths
+    """
+    return sorted(os.path.join(directory, f) for f in os.listdir(directory)
+                  if os.path.isfile(os.path.join(directory, f)) and 'csv' in f)
+
+
+def file_hash(filename: str) -> str:
+    """
+    Gets the SHA-256 hash of the contents of a file
+    :param filename: the path of the file
+    :return: the hex digest
+    """
+    digest = hashlib.sha256()
+    with open(filename, "rb") as f:
+        for block in iter(lambda: f.read(1 << 16), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def line_direction(filename: str) -> Tuple[str, str]:
+    """
+    Gets the line and direction of a schedule file from its name, e.g. Trains/4-train-Bronx-Bound.csv
+    :param filename: the path of the file
+    :return: tuple of the line and direction
+    """
+    split_file_name = os.path.basename(filename).split('-')
+    return str(split_file_name[0]), str(split_file_name[-2]) + '-bound'
+
+
+def _read_stations(df: pd.DataFrame) -> List[str]:
+    stations_lines = df.columns.values.tolist()
+    stations = [' '.join(station.rstrip().split(" ")[:-1]) for station in stations_lines]
+    lines = [lines.rstrip().split(" ")[-1][1:-1] for lines in stations_lines]
+    return fix_schedule_exceptions(stations, lines)
+
+
+def schedule_keys(directory: str = "Trains") -> List[str]:
+    """
+    Gets the schedule keys of the stations in the schedule files, reading only their headers
+    :param directory: the directory of the schedule files
+    :return: sorted list of schedule keys
+    """
+    keys = set()
+    for filename in schedule_files(directory):
+        keys.update(_read_stations(pd.read_csv(filename, dtype=str, nrows=0)))
+    return sorted(keys)
+
+
+def intern_schedule_stations(directory: str = "Trains") -> int:
+    """
+    Gives every station in the schedule files a station id, and saves the ids that are new
+    :param directory: the directory of the schedule files
+    :return: the number of new station ids
+    """
+    StationIds.intern_all(schedule_keys(directory))
+    return StationIds.save()
+
+
+def parse_schedule_file(filename: str) -> List[dict]:
+    """
+    Parses a schedule CSV into Schedule documents in the stops layout, with stop times in minutes since the start of
+    the service day and the station id of every stop, which has to be interned before the file is parsed. The cells
+    are cleaned and parsed as whole columns, and rows with a time that can't be parsed are skipped. Times after
+    midnight are rolled forward with the same rule as timetable.to_service_minutes.
+    :param filename: the path of the file
+    :return: list of documents
+    """
+    line, direction = line_direction(filename)
+    df = pd.read_csv(filename, dtype=str)
+    df.dropna(inplace=True)
+    stations = _read_stations(df)
+    if len(df) == 0:
+        return []
+
+    raw = df.to_numpy(dtype=object)
+    served = ~np.isin(raw, SKIPPED_STOP)
+
+    # A file only has a few thousand distinct cells, so each of them is cleaned and parsed once
+    codes, cells = pd.factorize(raw.ravel())
+    cells = pd.Series(cells).str.replace(FOOTNOTE_MARKS, "", regex=True).str.strip()
+    parts = cells.str.extract(r"^(\d{1,2}):(\d{1,2})$").astype(float).to_numpy()
+    hours = parts[codes, 0].reshape(raw.shape)
+    minutes = parts[codes, 1].reshape(raw.shape)
+    parsed = (hours < 24) & (minutes < 60)
+
+    # A trip is only kept if every stop it serves has a valid time
+    rows = np.flatnonzero(np.all(parsed | ~served, axis=1) & served.any(axis=1))
+    served = served[rows]
+    minutes = np.where(served, hours[rows] * 60 + minutes[rows], np.nan)
+
+    # Each stop depends on the one before it, so this walks the columns, for every trip at once
+    previous = np.full(len(rows), -np.inf)
+    for column in range(0, minutes.shape[1]):
+        current = minutes[:, column] + 720 * np.maximum(0, np.ceil((previous - 360 - minutes[:, column]) / 720))
+        minutes[:, column] = current
+        previous = np.where(served[:, column], current, previous)
+    times = np.where(served, minutes, 0).astype(np.int64).tolist()
+
+    station_ids = [StationIds.get(station) for station in stations]
+    documents = []
+    for row in range(0, len(rows)):
+        columns = np.flatnonzero(served[row]).tolist()
+        schedule = {stations[column]: (times[row][column], station_ids[column]) for column in columns}
+        documents.append({
+            "Line": line,
+            "Direction": direction,
+            "stops": [{"station": station, "station_id": station_id, "seq": seq, "time": time}
+                      for seq, (station, (time, station_id)) in enumerate(schedule.items())]
+        })
+    return documents
+
+
+def parse_schedule_file_iterrows(filename: str) -> List[dict]:
+    """
+    Parses a schedule CSV one row and one cell at a time. This is the original loader, kept as the baseline for
+    the parse benchmark.
+    :param filename: the path of the file
+    :return: list of documents with a {station: time} "Schedule" object
+    """
+    line, direction = line_direction(filename)
+    df = pd.read_csv(filename)
+    df.dropna(inplace=True)
+    stations = _read_stations(df)
+
+    documents_array = []
+    for index, row in df.iterrows():
+        values = row.values
+        good_indices = [i for i in range(0, len(values)) if values[i] != "—" and values[i] != np.nan
+                        and values[i] != "-"]
+        times = [values[i].rstrip()
+                     .replace("#", '')
+                     .replace("*", "")
+                     .replace("+", "")
+                     .replace("^", "")
+                     .lstrip()
+                     .rstrip() for i in good_indices]
+        curr_stations = [stations[i] for i in good_indices]
+        try:
+            new_times = [datetime.strptime(time, "%H:%M") for time in times]
+            prev_time = new_times[0]
+            for j in range(1, len(new_times)):
+                if new_times[j] < prev_time:
+                    new_times[j] = new_times[j].replace(year=1900, month=1, day=2)
+                    prev_time = new_times[j]
+
+            res = {curr_stations[j]: new_times[j] for j in range(len(curr_stations))}
+        except (IndexError, ValueError):
+            continue
+        documents_array.append({
+            "Line": line,
+            "Direction": direction,
+            "Schedule": res
+        })
+    return documents_array
+
+
+def parse_schedule_files(filenames: List[str], workers: int = None, chunk_size: int = 1000) -> Iterator[List[dict]]:
+    """
+    Parses schedule files in a process pool and yields their documents in chunks. At most two files per worker
+    are parsed ahead of the consumer, so memory stays bounded however many files there are. Sending the documents
+    back from a worker costs about as much as parsing them, so with a single worker the files are parsed in this
+    process instead.
+    :param filenames: the paths of the files
+    :param workers: the number of worker processes, defaults to the number of CPUs
+    :param chunk_size: the maximum number of documents per chunk
+    :return: iterator of lists of documents
+    """
+    workers = workers or os.cpu_count() or 1
+    if workers == 1:
+        for filename in filenames:
+            documents = parse_schedule_file(filename)
+            for i in range(0, len(documents), chunk_size):
+                yield documents[i:i + chunk_size]
+        return
+
+    filenames = iter(filenames)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for filename in filenames:
+            pending.append(executor.submit(parse_schedule_file, filename))
+            if len(pending) == 2 * workers:
+                break
+
+        while len(pending) > 0:
+            documents = pending.popleft().result()
+            filename = next(filenames, None)
+            if filename is not None:
+                pending.append(executor.submit(parse_schedule_file, filename))
+            for i in range(0, len(documents), chunk_size):
+                yield documents[i:i + chunk_size]
@@ -0,0 +1,42 @@
+import argparse
+import sys
+
+from src.repository import ScheduleRepository
+
+
+"""
+One-shot migration of the Schedule collection from documents with a {station: time} "Schedule" object, or with
+datetime stop times, to the stops layout with times in minutes since the start of the service day. Delays that were
+written into the documents are moved to the Delay collection. It ends with a check that the hot queries are index
+scans. Documents that were already migrated are skipped, so it is safe to run again. Run with
+python -m src.migrate_schedules [--batch-size N] [--explain-only]
+"""
+
+
+def explain(schedule_repository: ScheduleRepository) -> bool:
+    """
+    Prints the winning plan of every hot query
+    :param schedule_repository: the ScheduleRepository
+    :return: True if none of them scans the whole collection
+    """
+    ok = True
+    for name, stages in schedule_repository.explain_hot_queries().items():
+        uses_index = "COLLSCAN" not in stages and any(stage in ("IXSCAN", "DISTINCT_SCAN", "IDHACK") for stage in stages)
+        ok = ok and uses_index
+        print("{:<35} {:<6} {}".format(name, "OK" if uses_index else "FAIL", " <- ".join(stages)))
+    return ok
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument("--explain-only", action="store_true")
+    args = parser.parse_args()
+
+    schedule_repository = ScheduleRepository()
+    if not args.explain_only:
+        print("Converted {} documents".format(schedule_repository.migrate_to_stops(batch_size=args.batch_size)))
+        print("Moved {} delays to the Delay collection".format(schedule_repository.migrate_delays()))
+    schedule_repository.ensure_indexes()
+    if not explain(schedule_repository):
+        sys.exit(1)
@@ -12,6 +12,9 @@ from sqlalchemy.ext.declarative import as_declarative
 from sqlalchemy.types import LargeBinary, Boolean
 from flask_login import UserMixin
 
+from src.timetable import to_service_minutes
+from src.stations import StationIds
+
 Base = declarative_base()
 
 
@@ -65,7 +68,8 @@ class SubwayStation:
                  lines: list = None,
                  status: str = None,
                  latitude: float = None,
-                 longitude: float = None) -> SubwayStation:
+                 longitude: float = None,
+                 station_id: int = None) -> SubwayStation:
         self._station_name = station_name
         self._entrances = entrances
         self._lines = lines
@@ -73,6 +77,8 @@ class SubwayStation:
         self._borough = borough
         self._latitude = latitude
         self._longitude = longitude
+        self._station_id = station_id
+        self._schedule_key = None
 
     @property
     def station_name(self):
@@ -81,6 +87,7 @@ class SubwayStation:
     @station_name.setter
     def station_name(self, value):
         self._station_name = value
+        self._renamed()
         return self
 
     @property
@@ -108,6 +115,7 @@ class SubwayStation:
     @lines.setter
     def lines(self, value):
         self._lines = value
+        self._renamed()
         return self
 
     @property
@@ -137,14 +145,31 @@ class SubwayStation:
         self._longitude = value
         return self
 
+    @property
+    def station_id(self) -> int:
+        """
+        The integer id of the schedule key of the station, interned the first time it is needed if the node
+        doesn't have one
+        """
+        if self._station_id is None:
+            self._station_id = StationIds.intern(self.schedule_key())
+        return self._station_id
+
     def append_line(self, line):
         self._lines.append(line)
+        self._renamed()
         return self
 
     def remove_line(self, line):
         self._lines = [x for x in self._lines if x != line]
+        self._renamed()
         return self
 
+    def _renamed(self):
+        # The schedule key and its id are derived from the name and the lines
+        self._schedule_key = None
+        self._station_id = None
+
     def reroute(self):
         return self.station_name + "?" + self.entrances
 
@@ -162,7 +187,8 @@ class SubwayStation:
             lines=node['lines'],
             status=node['status'],
             latitude=node['latitude'],
-            longitude=node['longitude']
+            longitude=node['longitude'],
+            station_id=node.get('station_id')
         )
 
     @classmethod
@@ -193,7 +219,9 @@ class SubwayStation:
 
 
     def schedule_key(self):
-        return "{} [{}]".format(self.station_name, ','.join(sorted(self.lines)))
+        if self._schedule_key is None:
+            self._schedule_key = "{} [{}]".format(self.station_name, ','.join(sorted(self.lines)))
+        return self._schedule_key
 
 
     def __eq__(self, other: SubwayStation) -> bool:
@@ -292,11 +320,13 @@ class Schedule:
                  line: str = None,
                  direction: str = None,
                  schedule: [] = None,
-                 delay: {} = None):
+                 delay: {} = None,
+                 trip: str = None):
         self._line = line
         self._direction = direction
         self._schedule = schedule
         self._delay = delay
+        self._trip = trip
 
     @property
     def line(self):
@@ -331,9 +361,13 @@ class Schedule:
 
     @delay.setter
     def delay(self, value):
-        self._delay = delay
+        self._delay = value
         return self
 
+    @property
+    def trip(self):
+        return self._trip
+
     @classmethod
     def from_mongo(cls, query: {}) -> Schedule:
         '''
@@ -345,13 +379,46 @@ class Schedule:
             delay = query["Delay"]
         else:
             delay = None
+        if "stops" in query:
+            # Stops layout: an array of {station, seq, time} in the order the train stops
+            schedule = {stop['station']: stop['time'] for stop in sorted(query['stops'], key=lambda x: x['seq'])}
+        else:
+            schedule = query['Schedule']
+        if any(isinstance(time, datetime) for time in schedule.values()):
+            # Documents from before stop times were stored as minutes since the start of the service day
+            schedule = dict(zip(schedule.keys(), to_service_minutes(list(schedule.values()))))
+        # The trip id is the _id of the Schedule document
+        if "trip" in query:
+            trip = query["trip"]
+        elif "_id" in query:
+            trip = str(query["_id"])
+        else:
+            trip = None
         return cls(
             line=query['Line'],
             direction=query['Direction'],
-            schedule=query['Schedule'],
-            delay=delay
+            schedule=schedule,
+            delay=delay,
+            trip=trip
         )
 
+    def to_mongo(self) -> {}:
+        """
+        Creates a Mongo document in the stops layout, which stores the stops as an ordered array so that the station
+        and time of a stop can be indexed. Every stop carries the integer id of its station, as in the documents
+        written by ingest, or None if the station has no id yet.
+        :return: the document
+        """
+        document = {
+            "Line": self.line,
+            "Direction": self.direction,
+            "stops": [{"station": station, "station_id": StationIds.get(station), "seq": seq, "time": time}
+                      for seq, (station, time) in enumerate(self.schedule.items())]
+        }
+        if self.delay is not None:
+            document["Delay"] = self.delay
+        return document
+
 
 class Trip(Base):
     __tablename__ = 'trips'
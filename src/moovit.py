@@ -0,0 +1,14 @@
+"""
+Addresses of the Moovit pages that the map is scraped from, shared by the scraper and the fixture server, so that
+the fixture server doesn't import the models that the scraper builds.
+"""
+
+
+SITE = "https://moovitapp.com/index/en/"
+INDEX = "public_transit-lines-NYCNJ-121-855111"
+CODES = SITE + INDEX
+PAGE_DIRECTORY = "html_pages"
+
+
+def line_name(href: str) -> str:
+    return href.split('-')[2]
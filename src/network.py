@@ -0,0 +1,304 @@
+from __future__ import annotations
+import argparse
+import json
+import os
+import sys
+import time
+from typing import List, Tuple
+import pandas as pd
+
+from src.models import SubwayStation
+from src.ingest import file_hash, schedule_keys
+from src.stations import StationIds
+
+
+"""
+Offline compiler of the subway map. The station lists in data/*.csv are cleaned with the declarative alias table in
+data/aliases.json, checked by the validation passes and written to a single versioned network artifact: stations
+with integer ids, station ids, schedule keys and coordinates, and the directed connections of every line. Station
+ids come from src.stations and are shared with the schedules, while the integer ids only number the nodes. The map
+loader reads the artifact instead of repeating the cleanup, and compiles it again when any of its sources change.
+Build it with
+python -m src.network [--output PATH] [--strict]
+"""
+
+
+# Bumped whenever the layout of the artifact changes
+FORMAT_VERSION = 2
+DEFAULT_PATH = "network.json"
+MAP_DIRECTORY = "data"
+ALIASES_PATH = "data/aliases.json"
+SCHEDULE_DIRECTORY = "Trains"
+# Properties of a station that an alias can match on and set
+ALIAS_PROPERTIES = ["station_name", "borough", "entrances", "lines"]
+
+
+class Network:
+    """
+    The compiled subway map. Station ids are positions in 'stations', which are sorted by their properties so that
+    compiling the same sources gives the same ids.
+    """
+    def __init__(self, stations: List[SubwayStation], edges: List[Tuple[int, int, str]], sources: dict = None,
+                 problems: List[str] = None, built: str = None):
+        """
+        :param stations: the SubwayStations, in id order
+        :param edges: list of (start id, stop id, line) tuples, one per directed connection
+        :param sources: dictionary mapping each source file to the hash of its contents
+        :param problems: the problems found by the validation passes
+        :param built: when the network was compiled
+        """
+        self.stations = stations
+        self.edges = edges
+        self.sources = sources if sources is not None else {}
+        self.problems = problems if problems is not None else []
+        self.built = built
+
+    def to_json(self) -> dict:
+        """
+        Converts the network to the document written to the artifact
+        :return: dictionary
+        """
+        return {
+            "format": FORMAT_VERSION,
+            "built": self.built,
+            "sources": self.sources,
+            "problems": self.problems,
+            "stations": [{"id": i,
+                          "station_id": station.station_id,
+                          "station_name": station.station_name,
+                          "borough": station.borough,
+                          "entrances": station.entrances,
+                          "lines": station.lines,
+                          "schedule_key": station.schedule_key(),
+                          "latitude": station.latitude,
+                          "longitude": station.longitude} for i, station in enumerate(self.stations)],
+            "edges": [list(edge) for edge in self.edges]
+        }
+
+    @classmethod
+    def from_json(cls, document: dict) -> Network:
+        """
+        Builds the network from the document read from the artifact
+        :param document: the document
+        :return: Network
+        """
+        stations = [SubwayStation(station_name=station["station_name"],
+                                  borough=station["borough"],
+                                  entrances=station["entrances"],
+                                  lines=station["lines"],
+                                  status="Normal",
+                                  latitude=station["latitude"],
+                                  longitude=station["longitude"],
+                                  station_id=station["station_id"])
+                    for station in sorted(document["stations"], key=lambda station: station["id"])]
+        return cls(stations, [tuple(edge) for edge in document["edges"]], document["sources"], document["problems"],
+                   document["built"])
+
+
+def source_hashes(directory: str = MAP_DIRECTORY, aliases_path: str = ALIASES_PATH) -> dict:
+    """
+    Gets the hash of every file the network is compiled from
+    :param directory: the directory of the map files
+    :param aliases_path: the path of the alias table
+    :return: dictionary mapping each file to the hash of its contents
+    """
+    filenames = sorted(os.path.join(directory, f) for f in os.listdir(directory) if f.endswith('.csv'))
+    return {filename: file_hash(filename) for filename in filenames + [aliases_path]}
+
+
+def read_aliases(path: str = ALIASES_PATH) -> List[dict]:
+    """
+    Reads the alias table. Every alias has a "match" object of station properties and a "set" object of the
+    properties to give the stations that match. The aliases are applied in order, each to the result of the ones
+    before it.
+    :param path: the path of the alias table
+    :return: list of aliases
+    """
+    with open(path) as f:
+        aliases = json.load(f)
+    for alias in aliases:
+        unknown = [key for key in list(alias["match"]) + list(alias["set"]) if key not in ALIAS_PROPERTIES]
+        if len(unknown) > 0:
+            raise ValueError("Unknown station properties {} in {}".format(unknown, path))
+    return aliases
+
+
+def apply_aliases(station: SubwayStation, aliases: List[dict]) -> SubwayStation:
+    """
+    Applies the aliases that match a station to it
+    :param station: the SubwayStation
+    :param aliases: the alias table
+    :return: the SubwayStation
+    """
+    for alias in aliases:
+        if all(getattr(station, key) == value for key, value in alias["match"].items()):
+            for key, value in alias["set"].items():
+                setattr(station, key, list(value) if key == "lines" else value)
+    return station
+
+
+def compile_network(directory: str = MAP_DIRECTORY, aliases_path: str = ALIASES_PATH,
+                    schedule_directory: str = SCHEDULE_DIRECTORY) -> Network:
+    """
+    Compiles the map files into a network. A station is a node per distinct set of properties, as it was when every
+    row was MERGEd on its own, and consecutive rows of a line file are connected between every node of the two
+    stations that has the line.
+    :param directory: the directory of the map files
+    :param aliases_path: the path of the alias table
+    :param schedule_directory: the directory of the schedule files, whose stations are checked against the map
+    :return: Network
+    """
+    sources = source_hashes(directory, aliases_path)
+    aliases = read_aliases(aliases_path)
+    stations = {}
+    # Keys of the nodes of every station, by (station_name, borough, entrances)
+    nodes_by_station = {}
+    pairs = []
+    for csv in [filename for filename in sources if filename.endswith('.csv')]:
+        line = os.path.basename(csv).split('.')[0]
+
+        df = pd.read_csv(csv)
+        df.fillna('Not Found', inplace=True)
+
+        previous = None
+        for index in range(0, len(df)):
+            subway_station = SubwayStation.from_csv_row(df.loc[index])
+            subway_station.lines = [line for line in subway_station.lines if line != ""]
+            subway_station = apply_aliases(subway_station, aliases)
+
+            station = (subway_station.station_name, subway_station.borough, subway_station.entrances)
+            key = station + (tuple(subway_station.lines), subway_station.status)
+            if key in stations:
+                # The coordinates of the last row win, as they were SET on every MERGE
+                stations[key].latitude = subway_station.latitude
+                stations[key].longitude = subway_station.longitude
+            else:
+                stations[key] = subway_station
+                nodes_by_station.setdefault(station, []).append(key)
+            if previous is not None:
+                pairs.append((previous, station, line))
+            previous = station
+
+    keys = sorted(stations.keys())
+    ids = {key: i for i, key in enumerate(keys)}
+    StationIds.intern_all([station.schedule_key() for station in stations.values()])
+    StationIds.save()
+    edges = []
+    for start, stop, line in pairs:
+        edges.extend((ids[a], ids[b], line)
+                     for a in nodes_by_station[start] if line in stations[a].lines
+                     for b in nodes_by_station[stop] if line in stations[b].lines)
+
+    network = Network([stations[key] for key in keys], edges, sources, built=time.strftime("%Y-%m-%dT%H:%M:%S"))
+    network.problems = validate(network, pairs, schedule_keys(schedule_directory))
+    return network
+
+
+def validate(network: Network, pairs: List[tuple], keys: List[str]) -> List[str]:
+    """
+    Runs the validation passes over a compiled network
+    :param network: the Network
+    :param pairs: the consecutive stations of every line file, as ((station_name, borough, entrances) x 2, line)
+    :param keys: the schedule keys of the stations in the schedule files
+    :return: list of problems
+    """
+    problems = []
+
+    # Dangling lines: connections dropped because a station doesn't list their line, and lines that a station lists
+    # without a connection on them
+    served = set()
+    for start, stop, line in network.edges:
+        served.add((start, line))
+        served.add((stop, line))
+    listed = {}
+    for i, station in enumerate(network.stations):
+        listed.setdefault((station.station_name, station.borough, station.entrances), set()).update(station.lines)
+        for line in station.lines:
+            if (i, line) not in served:
+                problems.append("{} ({}) lists line {} but has no connection on it".format(
+                    station.station_name, station.entrances, line))
+    for start, stop, line in pairs:
+        for station in [start, stop]:
+            if line not in listed[station]:
+                problems.append("Line {} connects {} to {}, but {} doesn't list it".format(
+                    line, start[0], stop[0], station[0]))
+
+    # Duplicate stations: nodes that station lookups by name and entrance can't tell apart
+    nodes = {}
+    for station in network.stations:
+        nodes.setdefault((station.station_name, station.entrances), []).append(station)
+    for (station_name, entrances), stations in nodes.items():
+        if len(stations) > 1:
+            problems.append("{} ({}) has {} nodes: {}".format(
+                station_name, entrances, len(stations),
+                "; ".join("{} [{}]".format(station.borough, ",".join(station.lines)) for station in stations)))
+
+    # Schedule keys that no station has, so their trains can't be placed on the map
+    map_keys = set(station.schedule_key() for station in network.stations)
+    for key in keys:
+        if key not in map_keys:
+            problems.append("Schedule key {} has no station".format(key))
+    return problems
+
+
+def write_network(network: Network, path: str = DEFAULT_PATH):
+    """
+    Writes a network to the artifact. The file is written next to 'path' and then renamed over it, so readers only
+    ever see a complete file.
+    :param network: the Network
+    :param path: the path of the artifact
+    :return: None
+    """
+    temporary = "{}.{}.tmp".format(path, os.getpid())
+    with open(temporary, "w") as f:
+        json.dump(network.to_json(), f)
+    os.replace(temporary, path)
+
+
+def read_network(path: str = DEFAULT_PATH) -> Network:
+    """
+    Reads a network from the artifact
+    :param path: the path of the artifact
+    :return: Network, or None if the artifact was written with another format version
+    """
+    with open(path) as f:
+        document = json.load(f)
+    if document.get("format") != FORMAT_VERSION:
+        return None
+    return Network.from_json(document)
+
+
+def load_network(path: str = DEFAULT_PATH, directory: str = MAP_DIRECTORY, aliases_path: str = ALIASES_PATH) -> Network:
+    """
+    Reads the network from the artifact, compiling it again first if the artifact is missing or any of its sources
+    changed
+    :param path: the path of the artifact
+    :param directory: the directory of the map files
+    :param aliases_path: the path of the alias table
+    :return: Network
+    """
+    if os.path.exists(path):
+        network = read_network(path)
+        if network is not None and network.sources == source_hashes(directory, aliases_path):
+            return network
+    network = compile_network(directory, aliases_path)
+    write_network(network, path)
+    return network
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--output", default=DEFAULT_PATH)
+    parser.add_argument("--strict", action="store_true", help="exit with an error if validation finds problems")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    network = compile_network()
+    write_network(network, args.output)
+    print("Compiled {} stations and {} connections to {} in {:.2f} s".format(
+        len(network.stations), len(network.edges), args.output, time.perf_counter() - start))
+    for problem in network.problems:
+        print("  {}".format(problem))
+    print("{} problems".format(len(network.problems)))
+    if args.strict and len(network.problems) > 0:
+        sys.exit(1)
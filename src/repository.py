@@ -1,20 +1,28 @@
 from __future__ import annotations
 
 from neo4j.graph import Relationship
+from neo4j.exceptions import ClientError
+from pymongo.errors import OperationFailure
 
 from src.models import *
+from src.timetable import MINUTES_PER_DAY
 from src import login_manager
 from typing import List
 import pymongo
-from bson import SON
+from bson import SON, ObjectId
 from sqlalchemy import create_engine, MetaData
 from sqlalchemy.orm import sessionmaker
-from datetime import timedelta
+import time
 from src import mysql_engine, neo4j_driver, mongo_client
 
 
-mongo_client.start_session()
 collection = mongo_client['Train']['schedule']
+# Content hash of every schedule file that was loaded into the Schedule collection
+manifest_collection = mongo_client['Train']['schedule_manifest']
+# Frequency-compressed copy of the Schedule collection, one document per (Line, Direction)
+timetable_collection = mongo_client['Train']['timetable']
+# Delays, one document per delayed train keyed by the _id of its Schedule document, applied when schedules are read
+delay_collection = mongo_client['Train']['delay']
 
 
 
@@ -58,10 +66,32 @@ class UserRepository:
         return query
 
 
+# Prefix of the named GDS graph projections of the subway network
+PROJECTION_PREFIX = "subway_network_"
+# Name of the node that holds the version of the graph shared by every process
+GRAPH_VERSION_NAME = "subway"
+# Number of rows sent with each UNWIND when the graph is loaded in bulk
+BATCH_SIZE = 5000
+# Schema of the graph, as the name of each index or constraint and the statements that can create it, in order of
+# preference. Node keys are only available in the Enterprise Edition, so they fall back to a composite index.
+GRAPH_SCHEMA = {
+    "subway_station_key": ["CREATE CONSTRAINT subway_station_key IF NOT EXISTS ON (s:SubwayStation) "
+                           "ASSERT (s.station_name, s.entrances) IS NODE KEY",
+                           "CREATE INDEX subway_station_key IF NOT EXISTS FOR (s:SubwayStation) "
+                           "ON (s.station_name, s.entrances)"],
+    "subway_station_id": ["CREATE INDEX subway_station_id IF NOT EXISTS FOR (s:SubwayStation) ON (s.station_id)"],
+    "subway_station_status": ["CREATE INDEX subway_station_status IF NOT EXISTS FOR (s:SubwayStation) ON (s.status)"],
+    "connects_line": ["CREATE INDEX connects_line IF NOT EXISTS FOR ()-[r:CONNECTS]-() ON (r.line)"]
+}
+
+
 class MapRepository:
     """
     Class that handles all queries to the Neo4j graph database
     """
+    # Name of the GDS graph projection used for shortest paths, shared by every MapRepository in the process
+    projection_name = None
+
     def create_station(self, station: SubwayStation) -> Node:
         """
         Creates a station node in the graph based on 'station'
@@ -182,6 +212,83 @@ class MapRepository:
         temp = result.single()
         return temp
 
+    def create_stations(self, stations: List[SubwayStation]) -> List[int]:
+        """
+        Creates station nodes in bulk, BATCH_SIZE stations per UNWIND, all in a single transaction
+        :param stations: list of SubwayStation objects
+        :return: the ids of the nodes that were created, in the same order as 'stations'
+        """
+        with neo4j_driver.session() as s:
+            transact = s.write_transaction(self._create_stations, stations)
+        return transact
+
+    @staticmethod
+    def _create_stations(tx, stations):
+        ids = [None] * len(stations)
+        for start in range(0, len(stations), BATCH_SIZE):
+            result = tx.run(
+                '''
+                UNWIND $rows AS row
+                CREATE (s:SubwayStation{
+                    station_name: row.station_name,
+                    borough: row.borough,
+                    entrances: row.entrances,
+                    lines: row.lines,
+                    status: row.status,
+                    latitude: row.latitude,
+                    longitude: row.longitude,
+                    station_id: row.station_id
+                })
+                RETURN row.i AS i, id(s) AS id
+                ''',
+                rows=[
+                    {
+                        "i": i,
+                        "station_name": station.station_name,
+                        "borough": station.borough,
+                        "entrances": station.entrances,
+                        "lines": station.lines,
+                        "status": station.status,
+                        "latitude": station.latitude,
+                        "longitude": station.longitude,
+                        "station_id": station.station_id
+                    }
+                    for i, station in enumerate(stations[start:start + BATCH_SIZE], start)
+                ]
+            )
+            for record in result:
+                ids[record['i']] = record['id']
+        return ids
+
+    def create_connections(self, connections: List[tuple]) -> int:
+        """
+        Creates CONNECTS relationships in bulk between nodes given by their ids, BATCH_SIZE relationships per UNWIND,
+        all in a single transaction
+        :param connections: list of tuples of the id of the starting node, the id of the ending node and the line
+        :return: the number of relationships that were created
+        """
+        with neo4j_driver.session() as s:
+            transact = s.write_transaction(self._create_connections, connections)
+        return transact
+
+    @staticmethod
+    def _create_connections(tx, connections):
+        count = 0
+        for start in range(0, len(connections), BATCH_SIZE):
+            result = tx.run(
+                '''
+                UNWIND $rows AS row
+                MATCH (a:SubwayStation) WHERE id(a) = row.start
+                MATCH (b:SubwayStation) WHERE id(b) = row.stop
+                CREATE (a)-[r:CONNECTS { line: row.line, cost:1 }]->(b)
+                RETURN count(r) AS count
+                ''',
+                rows=[{"start": start_id, "stop": stop_id, "line": line}
+                      for start_id, stop_id, line in connections[start:start + BATCH_SIZE]]
+            )
+            count += result.single()['count']
+        return count
+
     def get_connections_between_stations(self, station_1, station_2) -> List[Relationship]:
         """
         Gets all of the connections between two SubwayStation nodes
@@ -211,19 +318,97 @@ class MapRepository:
         )
         return [x['line'] for x in result]
 
+    def get_connections_along_path(self, stations: List[SubwayStation]) -> List[List[str]]:
+        """
+        Gets the lines of all of the connections between each pair of consecutive stations in a path, in a single query
+        :param stations: the ordered list of SubwayStation objects in the path
+        :return: a list containing the lines for each pair of consecutive stations
+        """
+        with neo4j_driver.session() as s:
+            transact = s.write_transaction(self._get_connections_along_path, stations)
+        return transact
+
+    @staticmethod
+    def _get_connections_along_path(tx, stations):
+        result = tx.run(
+            '''
+            UNWIND range(0, size($stations) - 2) AS i
+            WITH i, $stations[i] AS s1, $stations[i + 1] AS s2
+            MATCH (a:SubwayStation{station_name: s1.station_name, borough: s1.borough, entrances: s1.entrances})
+            -[r]-(b:SubwayStation{station_name: s2.station_name, borough: s2.borough, entrances: s2.entrances})
+            RETURN i, collect(r.line) AS lines
+            ''',
+            stations=[
+                {
+                    "station_name": station.station_name,
+                    "borough": station.borough,
+                    "entrances": station.entrances
+                }
+                for station in stations
+            ]
+        )
+        lines = [[] for i in range(0, max(len(stations) - 1, 0))]
+        for record in result:
+            lines[record['i']] = record['lines']
+        return lines
+
     def shortest_path(self, start_station: SubwayStation, stop_station: SubwayStation):
         """
-        Gets the shortest, unweighted paths between two nodes.
+        Gets the shortest, unweighted paths between two nodes, using the named GDS projection of the graph.
+        :param start_station:
+        :param stop_station:
+        :return: a list of the shortest paths
+        """
+        projection_name = self.ensure_projection()
+        try:
+            with neo4j_driver.session() as s:
+                transact = s.write_transaction(self._shortest_path, start_station, stop_station, projection_name)
+        except ClientError:
+            # The projection was dropped by another process that refreshed it
+            MapRepository.projection_name = None
+            projection_name = self.ensure_projection()
+            with neo4j_driver.session() as s:
+                transact = s.write_transaction(self._shortest_path, start_station, stop_station, projection_name)
+        return transact
+
+    @staticmethod
+    def _shortest_path(tx, start_station, stop_station, projection_name):
+        result = tx.run(
+            '''
+            MATCH (start:SubwayStation{station_name: $start_name, entrances: $start_entrance}),
+             (end:SubwayStation{station_name:$stop_name, entrances: $stop_entrance})
+            CALL gds.alpha.kShortestPaths.stream($projection_name, {
+                startNode: start,
+                endNode: end,
+                k: 1,
+                relationshipWeightProperty: 'cost',
+                path: true
+            })
+            YIELD path
+            RETURN path
+            ''',
+            projection_name=projection_name,
+            start_name=start_station.station_name,
+            stop_name=stop_station.station_name,
+            start_entrance=start_station.entrances,
+            stop_entrance=stop_station.entrances
+        )
+        return [x for x in result]
+
+    def shortest_path_with_cypher_projection(self, start_station: SubwayStation, stop_station: SubwayStation):
+        """
+        Gets the shortest, unweighted paths between two nodes, projecting the graph for this call only.
+        Kept to compare against the named projection.
         :param start_station:
         :param stop_station:
         :return: a list of the shortest paths
         """
         with neo4j_driver.session() as s:
-            transact = s.write_transaction(self._shortest_path, start_station, stop_station)
+            transact = s.write_transaction(self._shortest_path_with_cypher_projection, start_station, stop_station)
         return transact
 
     @staticmethod
-    def _shortest_path(tx, start_station, stop_station):
+    def _shortest_path_with_cypher_projection(tx, start_station, stop_station):
         result = tx.run(
             '''
             MATCH (start:SubwayStation{station_name: $start_name, entrances: $start_entrance}),
@@ -248,6 +433,127 @@ class MapRepository:
         )
         return [x for x in result]
 
+    def ensure_projection(self) -> str:
+        """
+        Gets the name of the current GDS projection of the graph, creating the projection if none exists
+        :return: the name of the projection
+        """
+        if MapRepository.projection_name is None:
+            with neo4j_driver.session() as s:
+                names = s.read_transaction(self._get_projection_names)
+            if len(names) > 0:
+                # Names end with their creation time, so the newest projection sorts last
+                MapRepository.projection_name = max(names)
+            else:
+                self.refresh_projection()
+        return MapRepository.projection_name
+
+    def get_graph_version(self) -> int:
+        """
+        Gets the version of the graph, which every process that changes the graph bumps so that the others know to
+        rebuild what they computed from it
+        :return: the version, 0 if the graph was never changed
+        """
+        with neo4j_driver.session() as s:
+            version = s.read_transaction(self._get_graph_version)
+        return version
+
+    @staticmethod
+    def _get_graph_version(tx):
+        result = tx.run(
+            '''
+            MATCH (v:GraphVersion{name: $name})
+            RETURN v.version AS version
+            ''',
+            name=GRAPH_VERSION_NAME
+        )
+        record = result.single()
+        return record['version'] if record is not None else 0
+
+    def bump_graph_version(self) -> int:
+        """
+        Increments the version of the graph after it has been changed
+        :return: the new version
+        """
+        with neo4j_driver.session() as s:
+            version = s.write_transaction(self._bump_graph_version)
+        return version
+
+    @staticmethod
+    def _bump_graph_version(tx):
+        result = tx.run(
+            '''
+            MERGE (v:GraphVersion{name: $name})
+            SET v.version = coalesce(v.version, 0) + 1
+            RETURN v.version AS version
+            ''',
+            name=GRAPH_VERSION_NAME
+        )
+        return result.single()['version']
+
+    def refresh_projection(self) -> str:
+        """
+        Creates a new GDS projection of the graph and then drops the old ones. Shortest paths keep running
+        against the old projection until the new one is ready.
+        :return: the name of the new projection
+        """
+        projection_name = "{}{}".format(PROJECTION_PREFIX, int(time.time() * 1000))
+        with neo4j_driver.session() as s:
+            s.write_transaction(self._create_projection, projection_name)
+            old_names = [name for name in s.read_transaction(self._get_projection_names) if name != projection_name]
+        MapRepository.projection_name = projection_name
+
+        for name in old_names:
+            try:
+                with neo4j_driver.session() as s:
+                    s.write_transaction(self._drop_projection, name)
+            except ClientError:
+                # Already dropped by another process
+                pass
+        return projection_name
+
+    @staticmethod
+    def _get_projection_names(tx):
+        result = tx.run(
+            '''
+            CALL gds.graph.list()
+            YIELD graphName
+            WHERE graphName STARTS WITH $prefix
+            RETURN graphName
+            ''',
+            prefix=PROJECTION_PREFIX
+        )
+        return [x['graphName'] for x in result]
+
+    @staticmethod
+    def _create_projection(tx, projection_name):
+        result = tx.run(
+            '''
+            CALL gds.graph.create.cypher(
+                $projection_name,
+                'MATCH(n:SubwayStation{status:"Normal"}) RETURN id(n) AS id',
+                'MATCH(n:SubwayStation)-[r]-(m:SubwayStation) RETURN id(n) AS source, id(m) AS target, r.cost as cost',
+                {validateRelationships: false}
+            )
+            YIELD graphName, nodeCount, relationshipCount
+            RETURN graphName, nodeCount, relationshipCount
+            ''',
+            projection_name=projection_name
+        )
+        return result.single()
+
+    @staticmethod
+    def _drop_projection(tx, projection_name):
+        result = tx.run(
+            '''
+            CALL gds.graph.drop($projection_name)
+            YIELD graphName
+            RETURN graphName
+            ''',
+            projection_name=projection_name
+        )
+        return result.single()
+
     def all_stations(self) -> List[Node]:
         """
         Gets all of the SubwayStation nodes in the graph
@@ -267,6 +573,33 @@ class MapRepository:
         )
         return [x for x in result]
 
+    def get_graph(self):
+        """
+        Gets every SubwayStation node and every relationship between them
+        :return: the node records (id, s) and the relationship records (start, end, line)
+        """
+        with neo4j_driver.session() as s:
+            transact = s.write_transaction(self._get_graph)
+        return transact
+
+    @staticmethod
+    def _get_graph(tx):
+        nodes = tx.run(
+            '''
+            MATCH (s:SubwayStation)
+            RETURN id(s) AS id, s
+            '''
+        )
+        nodes = [x for x in nodes]
+        relationships = tx.run(
+            '''
+            MATCH (a:SubwayStation)-[r]->(b:SubwayStation)
+            RETURN id(a) AS start, id(b) AS end, r.line AS line
+            '''
+        )
+        relationships = [x for x in relationships]
+        return nodes, relationships
+
     def get_all_active_stations(self):
         """
         Gets all stations whose status is "normal"
@@ -464,62 +797,224 @@ class MapRepository:
         )
         return [x for x in result]
 
+    def ensure_indexes(self) -> List[str]:
+        """
+        Creates the schema that the station and connection lookups match on, if it doesn't exist yet: a node key on
+        (station_name, entrances), or a composite index where node keys aren't available (Community Edition), and
+        indexes on the status of stations and on the line of connections
+        :return: the names of the indexes that were missing
+        """
+        missing = self.missing_indexes()
+        with neo4j_driver.session() as s:
+            for name in missing:
+                for statement in GRAPH_SCHEMA[name]:
+                    try:
+                        s.run(statement).consume()
+                        break
+                    except ClientError:
+                        if statement == GRAPH_SCHEMA[name][-1]:
+                            raise
+        return missing
+
+    def missing_indexes(self) -> List[str]:
+        """
+        Gets the indexes and constraints of GRAPH_SCHEMA that don't exist in the graph
+        :return: list of names
+        """
+        with neo4j_driver.session() as s:
+            names = set(record["name"] for record in s.run("SHOW INDEXES YIELD name RETURN name"))
+        return [name for name in GRAPH_SCHEMA if name not in names]
+
+    def profile_hot_queries(self) -> dict:
+        """
+        Profiles the station and connection lookups that the map queries start from, using a station from the graph
+        as the sample values
+        :return: dictionary mapping the name of each query to the operators of its plan
+        """
+        with neo4j_driver.session() as s:
+            sample = s.run("MATCH (s:SubwayStation) RETURN s LIMIT 1").single()['s']
+            line = sample['lines'][0]
+            profiles = {
+                "station by name and entrance": s.run(
+                    '''
+                    PROFILE MATCH (s:SubwayStation{station_name: $station_name, entrances: $entrance})
+                    RETURN s
+                    ''',
+                    station_name=sample['station_name'],
+                    entrance=sample['entrances']
+                ).consume().profile,
+                "stations by status": s.run(
+                    '''
+                    PROFILE MATCH (s:SubwayStation{status: "Normal"})
+                    RETURN count(s)
+                    '''
+                ).consume().profile,
+                "connections by line": s.run(
+                    '''
+                    PROFILE MATCH ()-[r:CONNECTS]->()
+                    WHERE r.line = $line
+                    RETURN count(r)
+                    ''',
+                    line=line
+                ).consume().profile
+            }
+        return {name: MapRepository._plan_operators(profile) for name, profile in profiles.items()}
+
+    @staticmethod
+    def _plan_operators(profile) -> List[str]:
+        """
+        Collects the operators of a PROFILE plan, without their runtime suffix
+        :param profile: the profile of a result summary
+        :return: list of operator names
+        """
+        operators = [profile["operatorType"].split("@")[0]]
+        for child in profile.get("children", []):
+            operators.extend(MapRepository._plan_operators(child))
+        return operators
+
     @staticmethod
     def clear_db():
         """
-        Clears the graph
+        Clears the graph, keeping its version so that running processes see the new graph as a change
         :return:
         """
         with neo4j_driver.session() as s:
             s.run('''
-                MATCH (n) DETACH DELETE n
+                MATCH (n) WHERE NOT n:GraphVersion DETACH DELETE n
             ''')
 
 
+# Name of the compound multikey index that covers the stops of every train
+STOP_TIME_INDEX = "line_direction_stop_time"
+# Collection that a new Schedule collection is built in before it is swapped in
+STAGING_COLLECTION = "schedule_staging"
+# Error code of a server that does not support transactions (not a replica set)
+ILLEGAL_OPERATION = 20
+
+# Converts the ordered stops array back to the {station: time} layout that the services use, with the _id of the
+# document as the trip id
+SCHEDULE_PROJECTION = {
+    "$project": {
+        "_id": 0,
+        "trip": {"$toString": "$_id"},
+        "Line": 1,
+        "Direction": 1,
+        "Delay": 1,
+        "Schedule": {
+            "$arrayToObject": {
+                "$map": {"input": "$stops", "as": "stop", "in": {"k": "$$stop.station", "v": "$$stop.time"}}
+            }
+        }
+    }
+}
+
+# Attaches the delay of a train, if it has one, as "Delay"
+DELAY_LOOKUP = [
+    {"$lookup": {"from": delay_collection.name, "localField": "_id", "foreignField": "_id", "as": "Delay"}},
+    {"$addFields": {"Delay": {"$cond": [{"$gt": [{"$size": "$Delay"}, 0]},
+                                        {"$arrayElemAt": ["$Delay", 0]},
+                                        "$$REMOVE"]}}}
+]
+
+# Same as SCHEDULE_PROJECTION, with the delay added to every stop after the one that it starts at
+DELAYED_SCHEDULE_PROJECTION = {
+    "$project": {
+        "_id": 0,
+        "trip": {"$toString": "$_id"},
+        "Line": 1,
+        "Direction": 1,
+        "Delay": 1,
+        "Schedule": {
+            "$arrayToObject": {
+                "$map": {
+                    "input": "$stops",
+                    "as": "stop",
+                    "in": {
+                        "k": "$$stop.station",
+                        "v": {"$add": ["$$stop.time",
+                                       {"$cond": [{"$gt": ["$$stop.seq",
+                                                           {"$indexOfArray": ["$stops.station", "$Delay.start"]}]},
+                                                  {"$ifNull": ["$Delay.time", 0]},
+                                                  0]}]}
+                    }
+                }
+            }
+        }
+    }
+}
+
+
 class ScheduleRepository:
     """
-    Class that manages all queries to the Schedule collection in the MongoDB database
+    Class that manages all queries to the Schedule collection in the MongoDB database. Documents store their stops
+    as an ordered array of {station, seq, time}, covered by a compound multikey index on
+    (Line, Direction, stops.station, stops.time). Reads return documents with a {station: time} "Schedule" object.
+    Schedule documents are never changed once loaded. Delays are kept in the Delay collection and added to the stop
+    times when schedules are read.
     """
     def __init__(self):
         self.collection = collection
+        self.manifest = manifest_collection
+        self.timetable = timetable_collection
+        self.delays = delay_collection
+
+    def ensure_indexes(self, target=None):
+        """
+        Creates the indexes used by the schedule queries, if they don't exist yet
+        :param target: the collection to index, defaults to the Schedule collection
+        :return: None
+        """
+        target = target if target is not None else self.collection
+        target.create_index([("Line", pymongo.ASCENDING),
+                             ("Direction", pymongo.ASCENDING),
+                             ("stops.station", pymongo.ASCENDING),
+                             ("stops.time", pymongo.ASCENDING)],
+                            name=STOP_TIME_INDEX)
 
     def get_schedules_by_line(self, line: str) -> pymongo.CursorType:
         """
-        Gets all of the schedules for the given line.
+        Gets all of the schedules for the given line, with their delays applied
         :param line: the line
         :return: Pymongo Cursor for the query
         """
-        schedules = []
-        result = self.collection.find(
-            {"Line": line},
-            {"_id": 0}
-        )
+        result = self.collection.aggregate([{"$match": {"Line": line}}] + DELAY_LOOKUP + [DELAYED_SCHEDULE_PROJECTION])
         return result
 
-    def get_next_train_by_station_name_and_line(self, start_station: SubwayStation,
-                                                end_station: SubwayStation,
-                                                line: str,
-                                                time: datetime.datetime):
+    def get_all_schedules(self) -> pymongo.CursorType:
         """
-        Gets the next train, after 'time', going from 'start_station' to 'end_station' on 'line'
-        :param start_station: SubwayStation
-        :param end_station: SubwayStation
-        :param line: the ling
-        :param time: the time
-        :return: time when the next train arrives at starting_station and arrives at ending_station
+        Gets every schedule in the Schedule collection, without delays
+        :return: Pymongo Cursor for the query
         """
-        pipeline = [
+        result = self.collection.aggregate([SCHEDULE_PROJECTION])
+        return result
+
+    def _next_train_pipeline(self, start_key: str, end_key: str, line: str, time: int) -> List[dict]:
+        """
+        Aggregation pipeline for the next train on 'line' from 'start_key' to 'end_key'. The first stage matches on
+        the index, then the two stops are pulled out of the array to compare and sort on their times.
+        """
+        def stop_at(key):
+            return {"$arrayElemAt": [{"$filter": {"input": "$stops",
+                                                  "as": "stop",
+                                                  "cond": {"$eq": ["$$stop.station", key]}}}, 0]}
+
+        return [
             {
                 "$match":
                     {
                         "Line": str(line).upper(),
-                        "Schedule.{}".format(start_station): {"$gte": time},
-                        "$expr": {"$gt": ["$Schedule.{}".format(end_station),
-                                          "$Schedule.{}".format(start_station)]},
+                        "stops": {"$elemMatch": {"station": start_key, "time": {"$gte": time}}},
+                        "stops.station": end_key
                     }
             },
             {
-                "$sort": SON([("Schedule.{}".format(end_station), 1)])
+                "$project": {"_id": 0, "Line": 1, "start": stop_at(start_key), "end": stop_at(end_key)}
+            },
+            {
+                "$match": {"$expr": {"$gt": ["$end.time", "$start.time"]}}
+            },
+            {
+                "$sort": SON([("end.time", 1)])
             },
             {
                 "$limit": 1
@@ -527,130 +1022,163 @@ class ScheduleRepository:
             {
                 "$project":
                     {
-                        "Schedule.{}".format(start_station): 1,
-                        "Schedule.{}".format(end_station): 1
+                        "Line": 1,
+                        "Schedule": {"$arrayToObject": [[{"k": start_key, "v": "$start.time"},
+                                                         {"k": end_key, "v": "$end.time"}]]}
                     }
             }
         ]
+
+    def get_next_train_by_station_name_and_line(self, start_station: SubwayStation,
+                                                end_station: SubwayStation,
+                                                line: str,
+                                                time: int):
+        """
+        Gets the next train, after 'time', going from 'start_station' to 'end_station' on 'line'
+        :param start_station: SubwayStation
+        :param end_station: SubwayStation
+        :param line: the ling
+        :param time: the time in minutes since the start of the service day
+        :return: time when the next train arrives at starting_station and arrives at ending_station
+        """
+        pipeline = self._next_train_pipeline(start_station.schedule_key(), end_station.schedule_key(), line, time)
         result = self.collection.aggregate(pipeline=pipeline)
         return result
 
-    def get_train_by_line_direction_station_and_start_time(self, line, direction, starting_station, time):
+    def get_train(self, trip: str):
+        """
+        Gets a train by its trip id, without its delay applied
+        :param trip: the trip id
+        :return: the schedule of the train, with its delay as "Delay" if it has one, or None if there is no such train
+        """
+        if not ObjectId.is_valid(trip):
+            return None
+        result = self.collection.aggregate([{"$match": {"_id": ObjectId(trip)}}] + DELAY_LOOKUP + [SCHEDULE_PROJECTION])
+        return next(result, None)
+
+    def get_trains_in_window(self, line: str, direction: str, stations: List[str], start: int, end: int):
         """
-        Gets a train on the given line, going in the given direction, with the given start time
+        Gets the trains on a line and direction that stop at any of the given stations between two clock times
         :param line: the line
         :param direction: the direction
-        :param starting_station: the name of the starting station
-        :param time: the time
-        :return: the schedule corresponding to that train
-        """
-        result = self.collection.find_one({
-            "Line": str(line),
-            "Direction": direction,
-            "Schedule.{}".format(starting_station): {"$eq": time}
-        })
+        :param stations: the stations
+        :param start: the start of the window in minutes since midnight
+        :param end: the end of the window in minutes since midnight, before 'start' if the window crosses midnight
+        :return: Pymongo Cursor of schedules, without their delays applied, with their delay as "Delay"
+        """
+        if end < start:
+            end += MINUTES_PER_DAY
+        # A clock time matches the stop on the service day and the one after midnight
+        windows = [{"stops": {"$elemMatch": {"station": {"$in": stations},
+                                             "time": {"$gte": start + days, "$lte": end + days}}}}
+                   for days in (0, MINUTES_PER_DAY)]
+        result = self.collection.aggregate([{"$match": {"Line": str(line), "Direction": direction, "$or": windows}}] +
+                                           DELAY_LOOKUP + [SCHEDULE_PROJECTION])
         return result
 
-    def delay_train(self, schedule: Schedule, station_name: str, delay: timedelta) -> Schedule:
+    @staticmethod
+    def _delay_document(schedule: Schedule, station_name: str, delay: int) -> dict:
+        return {
+            "_id": ObjectId(schedule.trip),
+            "Line": schedule.line,
+            "Direction": schedule.direction,
+            "start": station_name,
+            "time": delay
+        }
+
+    def delay_train(self, schedule: Schedule, station_name: str, delay: int):
         """
-        Delays a train starting at the station specified by station_name. Adds the "Delay" property to the schedule,
-        indicating the delay amount and the starting station. Adds the delay amount to all stations after the starting station.
-        :param schedule: The schedule that will be delayed
+        Delays a train at every stop after station_name, replacing the delay it already has
+        :param schedule: the Schedule of the train
         :param station_name: the starting station
-        :param delay: the amount of delay
-        :return:
+        :param delay: the amount of delay in minutes
+        :return: the result of the write
         """
-        update = \
-            {
-                "$set":
-                    {
-                        "Delay":
-                            {
-                                "start": station_name,
-                                "time": int(delay.seconds / 60)
-                            }
-                    }
-            }
-
-        for stop in schedule.schedule:
-            if schedule.schedule[station_name] < schedule.schedule[stop]:
-                update["$set"]["Schedule.{}".format(stop)] = schedule.schedule[stop] + delay
-
-        result = self.collection.update(
-            {
-                "Line": schedule.line,
-                "Direction": schedule.direction,
-                "Schedule.{}".format(station_name): {"$eq": schedule.schedule[station_name]}
-            },
-            update
-
-        )
-
+        result = self.delays.replace_one({"_id": ObjectId(schedule.trip)},
+                                         self._delay_document(schedule, station_name, delay),
+                                         upsert=True)
         return result
 
-    def remove_delay(self, schedule: Schedule) -> Schedule:
+    def delay_trains(self, delays: List[tuple], delay: int):
         """
-        Removes the delay from the given Schedule. Uses the "Delay" property to properly subtract from arrival times.
-        Unsets the "Delay" property
-        :param schedule: the delayed Schedule
-        :return: the updated Schedule
+        Delays many trains in a single bulk write, replacing the delays they already have
+        :param delays: list of tuples of the Schedule of a train and the station that its delay starts at
+        :param delay: the amount of delay in minutes
+        :return: the result of the bulk write, or None if there is nothing to write
         """
+        if len(delays) == 0:
+            return None
+        result = self.delays.bulk_write([pymongo.ReplaceOne({"_id": ObjectId(schedule.trip)},
+                                                            self._delay_document(schedule, station_name, delay),
+                                                            upsert=True)
+                                         for schedule, station_name in delays], ordered=False)
+        return result
 
-        # { $unwind: '$foobars'},
-        # { $group: {_id: null, maxTime: { $max: '$foobars.time'}}},
-        # callback);
+    def remove_delay(self, schedule: Schedule):
+        """
+        Removes the delay of a train
+        :param schedule: the Schedule of the train
+        :return: the result of the write
+        """
+        result = self.delays.delete_one({"_id": ObjectId(schedule.trip)})
+        return result
 
+    def remove_delays(self, schedules: List[Schedule]):
+        """
+        Removes the delays of many trains in a single bulk write
+        :param schedules: the Schedules of the trains
+        :return: the result of the bulk write, or None if there is nothing to write
+        """
+        if len(schedules) == 0:
+            return None
+        result = self.delays.bulk_write([pymongo.DeleteOne({"_id": ObjectId(schedule.trip)})
+                                         for schedule in schedules], ordered=False)
+        return result
 
-        update = \
-            {
-                "$set": {
-                    # Reset times to pre-delay
-                },
-                "$unset": {"Delay": ""}  # Remove delay property
-            }
-        start = schedule.delay['start']
-        print(start)
-        delay = schedule.delay['time']
-        for stop in schedule.schedule:
-            if schedule.schedule[start] < schedule.schedule[stop]:
-                update["$set"]["Schedule.{}".format(stop)] = schedule.schedule[stop] - timedelta(minutes=delay)
-        result = self.collection.find_one_and_update(
-            {
-                "Line": schedule.line,
-                "Direction": schedule.direction,
-                "Schedule.{}".format(start): {"$eq": schedule.schedule[start]}
-            },
-            update,
-            return_document=pymongo.ReturnDocument.AFTER
-        )
+    def get_delays(self, trips: List[str] = None):
+        """
+        Gets the delayed trains, without their delays applied
+        :param trips: the trip ids of the trains, every delayed train if None
+        :return: Pymongo Cursor of schedules with their delay as "Delay"
+        """
+        if trips is None:
+            trips = [delay["_id"] for delay in self.delays.find({}, {"_id": 1})]
+        else:
+            trips = [ObjectId(trip) for trip in trips]
+        result = self.collection.aggregate([{"$match": {"_id": {"$in": trips}}}] + DELAY_LOOKUP + [SCHEDULE_PROJECTION])
         return result
 
-    def get_delays(self):
+    def get_delay_documents(self):
         """
-        Gets all of the delays on the system
-        :return: Pymongo Cursor
+        Gets the delay of every delayed train, without reading their schedules
+        :return: Pymongo Cursor of delay documents
         """
-        result = self.collection.find(
-            {
-                "Delay": {"$exists": True}
-            }
-        )
+        result = self.delays.find({}, {"start": 1, "time": 1})
         return result
 
-    def get_schedules_by_line_direction(self, line: str, direction: str) -> pymongo.CursorType:
+    def watch_delays(self):
+        """
+        Opens a change stream on the Delay collection. Change streams need MongoDB to run as a replica set, and opening
+        one on a standalone server raises OperationFailure.
+        :return: Pymongo ChangeStream
+        """
+        return self.delays.watch(full_document="updateLookup")
+
+    def get_schedules_by_line_direction(self, line: str, direction: str,
+                                        apply_delays: bool = True) -> pymongo.CursorType:
         """
         Gets all of the schedules for the given line and direction
         :param line: the line
         :param direction: the direction
+        :param apply_delays: if False, the schedules are returned as they were loaded
         :return: Pymongo Cursor
         """
-        result = self.collection.find(
-            {
-                "Line": str(line.upper()),
-                "Direction": direction
-            },
-            {"Schedule": 1, "Delay": 1, "_id": 0}
-        )
+        pipeline = [{"$match": {"Line": str(line.upper()), "Direction": direction}}]
+        if apply_delays:
+            pipeline += DELAY_LOOKUP + [DELAYED_SCHEDULE_PROJECTION]
+        else:
+            pipeline += [SCHEDULE_PROJECTION]
+        result = self.collection.aggregate(pipeline)
         return result
 
     def get_unique_line_direction(self):
@@ -679,18 +1207,247 @@ class ScheduleRepository:
 
     def bulk_insert_schedules(self, schedules):
         """
-        Bulk inserts schedule documents into the Schedule collection
-        :param schedules: an array of schedule documents
+        Bulk inserts schedule documents into the Schedule collection, converting them to the stops layout if needed
+        :param schedules: an array of schedule documents, in either layout
+        :return: None
+        """
+        self._insert(self.collection, schedules)
+
+    def load_all_schedules(self, chunks) -> int:
+        """
+        Replaces the whole Schedule collection. The documents are inserted and indexed in a staging collection, which
+        is then renamed over the Schedule collection, so readers see either the old or the new schedules. Delays are
+        cleared, since the trains they were for are gone.
+        :param chunks: iterable of lists of schedule documents
+        :return: the number of documents loaded
+        """
+        staging = self.collection.database[STAGING_COLLECTION]
+        staging.drop()
+        count = 0
+        for documents in chunks:
+            if len(documents) > 0:
+                self._insert(staging, documents)
+                count += len(documents)
+        self.ensure_indexes(staging)
+        staging.rename(self.collection.name, dropTarget=True)
+        self.delays.delete_many({})
+        return count
+
+    def replace_schedules(self, documents_by_line_direction: dict):
+        """
+        Replaces the schedules of some (Line, Direction) pairs, leaving the others untouched. Each pair is replaced
+        in a transaction, along with its delays. Servers that don't support transactions get a staging collection with
+        the untouched schedules copied over on the server, which is then swapped in.
+        :param documents_by_line_direction: dictionary mapping (Line, Direction) to its new schedule documents
+        :return: None
+        """
+        try:
+            with mongo_client.start_session() as session:
+                for (line, direction), documents in documents_by_line_direction.items():
+                    session.with_transaction(
+                        lambda s: self._replace_line_direction(line, direction, documents, s))
+        except OperationFailure as e:
+            if e.code != ILLEGAL_OPERATION:
+                raise
+            self._swap_in_line_directions(documents_by_line_direction)
+
+    def _replace_line_direction(self, line: str, direction: str, documents: List[dict], session):
+        self.collection.delete_many({"Line": line, "Direction": direction}, session=session)
+        self.delays.delete_many({"Line": line, "Direction": direction}, session=session)
+        if len(documents) > 0:
+            self._insert(self.collection, documents, session=session)
+
+    def _swap_in_line_directions(self, documents_by_line_direction: dict):
+        staging = self.collection.database[STAGING_COLLECTION]
+        staging.drop()
+        unchanged = {"$nor": [{"Line": line, "Direction": direction}
+                              for line, direction in documents_by_line_direction.keys()]}
+        self.collection.aggregate([{"$match": unchanged}, {"$out": STAGING_COLLECTION}])
+        for documents in documents_by_line_direction.values():
+            if len(documents) > 0:
+                self._insert(staging, documents)
+        self.ensure_indexes(staging)
+        staging.rename(self.collection.name, dropTarget=True)
+        self.delays.delete_many({"$or": unchanged["$nor"]})
+
+    @staticmethod
+    def _insert(target, schedules, session=None):
+        target.insert_many([schedule if "stops" in schedule else Schedule.from_mongo(schedule).to_mongo()
+                            for schedule in schedules], session=session)
+
+    def get_manifest(self) -> dict:
+        """
+        Gets the manifest of the schedule files that were loaded
+        :return: dictionary mapping file names to their manifest entries
+        """
+        return {entry["_id"]: entry for entry in self.manifest.find({})}
+
+    def save_manifest(self, entries: List[dict], replace: bool = False):
+        """
+        Saves manifest entries, keyed by their file name in "_id"
+        :param entries: the entries
+        :param replace: if True, entries that aren't in 'entries' are removed
+        :return: None
+        """
+        if replace:
+            self.manifest.delete_many({"_id": {"$nin": [entry["_id"] for entry in entries]}})
+        if len(entries) > 0:
+            self.manifest.bulk_write([pymongo.ReplaceOne({"_id": entry["_id"]}, entry, upsert=True)
+                                      for entry in entries])
+
+    def remove_manifest_entries(self, names: List[str]):
+        """
+        Removes the manifest entries of files that no longer exist
+        :param names: the file names
+        :return: None
+        """
+        if len(names) > 0:
+            self.manifest.delete_many({"_id": {"$in": names}})
+
+    def get_timetables(self) -> pymongo.CursorType:
+        """
+        Gets the documents of the compressed Timetable collection
+        :return: Pymongo Cursor
+        """
+        return self.timetable.find({}, {"_id": 0})
+
+    def save_timetables(self, documents: List[dict], replace: bool = False):
+        """
+        Saves compressed timetable documents, keyed by their Line and Direction
+        :param documents: the documents
+        :param replace: if True, the documents of the other lines and directions are removed
+        :return: None
+        """
+        if replace:
+            kept = [{"Line": document["Line"], "Direction": document["Direction"]} for document in documents]
+            self.timetable.delete_many({"$nor": kept} if len(kept) > 0 else {})
+        if len(documents) > 0:
+            self.timetable.bulk_write([pymongo.ReplaceOne({"Line": document["Line"],
+                                                           "Direction": document["Direction"]},
+                                                          document, upsert=True)
+                                       for document in documents])
+
+    def remove_timetable(self, line: str, direction: str):
+        """
+        Removes the compressed timetable of a line and direction that no longer has schedules
+        :param line: the line
+        :param direction: the direction
         :return: None
         """
-        self.collection.insert_many(schedules)
+        self.timetable.delete_many({"Line": line, "Direction": direction})
+
+    def migrate_to_stops(self, batch_size: int = 1000) -> int:
+        """
+        Converts the documents that still have a {station: time} "Schedule" object, or datetime stop times, to the
+        stops layout with stop times in minutes since the start of the service day
+        :param batch_size: the number of documents replaced per bulk write
+        :return: the number of documents converted
+        """
+        converted = 0
+        batch = []
+        for document in self.collection.find({"$or": [{"Schedule": {"$exists": True}, "stops": {"$exists": False}},
+                                                      {"stops.time": {"$type": "date"}}]}):
+            batch.append(pymongo.ReplaceOne({"_id": document["_id"]}, Schedule.from_mongo(document).to_mongo()))
+            if len(batch) == batch_size:
+                converted += self.collection.bulk_write(batch, ordered=False).modified_count
+                batch = []
+        if len(batch) > 0:
+            converted += self.collection.bulk_write(batch, ordered=False).modified_count
+        return converted
+
+    def migrate_delays(self) -> int:
+        """
+        Moves the delays that were written into Schedule documents to the Delay collection, restoring the stop times
+        that they shifted
+        :return: the number of delays moved
+        """
+        moved = 0
+        for document in self.collection.find({"Delay": {"$exists": True}}):
+            schedule = Schedule.from_mongo(document)
+            start = schedule.delay["start"]
+            delay = schedule.delay["time"]
+            # Every stop after the start of the delay was shifted past the time at the start
+            schedule.schedule = {stop: time - delay if time > schedule.schedule[start] else time
+                                 for stop, time in schedule.schedule.items()}
+            schedule.delay = None
+            self.collection.replace_one({"_id": document["_id"]}, schedule.to_mongo())
+            self.delay_train(schedule, start, delay)
+            moved += 1
+        return moved
+
+    def storage_stats(self) -> dict:
+        """
+        Gets the storage used by the schedules, their compressed copy and the delays, as reported by collStats
+        :return: dictionary mapping each collection to its document count, data size, storage size and index size in
+        bytes
+        """
+        database = self.collection.database
+        stats = {}
+        for target in [self.collection, self.timetable, self.delays]:
+            result = database.command("collStats", target.name)
+            stats[target.name] = {"count": result.get("count", 0),
+                                  "size": result.get("size", 0),
+                                  "storageSize": result.get("storageSize", 0),
+                                  "totalIndexSize": result.get("totalIndexSize", 0)}
+        return stats
+
+    def explain_hot_queries(self) -> dict:
+        """
+        Explains the queries run on every trip plan, delay and schedule page, using a train from the collection as
+        the sample values
+        :return: dictionary mapping the name of each query to the stages of its winning plan
+        """
+        sample = Schedule.from_mongo(self.collection.find_one({"stops.1": {"$exists": True}}))
+        stations = list(sample.schedule.keys())
+        start, end = stations[0], stations[-1]
+        departure = sample.schedule[start]
+        trip = ObjectId(sample.trip)
+        database = self.collection.database
+
+        explains = {
+            "next train": database.command("aggregate", self.collection.name,
+                                           pipeline=self._next_train_pipeline(start, end, sample.line, departure),
+                                           explain=True),
+            "train by trip id": database.command("aggregate", self.collection.name,
+                                                 pipeline=[{"$match": {"_id": trip}}] + DELAY_LOOKUP,
+                                                 explain=True),
+            "delay train": database.command("explain",
+                                            {"update": self.delays.name,
+                                             "updates": [{"q": {"_id": trip}, "u": {"time": 0}, "upsert": True}]},
+                                            verbosity="queryPlanner"),
+            "schedules by line and direction": self.collection.find({"Line": sample.line,
+                                                                     "Direction": sample.direction}).explain(),
+            "delays": self.collection.find({"_id": {"$in": [trip]}}).explain()
+        }
+        return {name: ScheduleRepository._plan_stages(explain) for name, explain in explains.items()}
+
+    @staticmethod
+    def _plan_stages(explain) -> List[str]:
+        """
+        Collects the stages of the winning plans in an explain() result
+        :param explain: the explain result
+        :return: list of stage names
+        """
+        stages = []
+        if isinstance(explain, dict):
+            for key, value in explain.items():
+                if key == "stage":
+                    stages.append(value)
+                elif key != "rejectedPlans":
+                    stages.extend(ScheduleRepository._plan_stages(value))
+        elif isinstance(explain, list):
+            for value in explain:
+                stages.extend(ScheduleRepository._plan_stages(value))
+        return stages
 
     def clear_db(self):
         """
-        Clears out the Schedule collection
+        Clears out the Schedule collection, its compressed copy and the delays
         :return: None
         """
         self.collection.delete_many({})
+        self.timetable.delete_many({})
+        self.delays.delete_many({})
 
 
 class TripRepository:
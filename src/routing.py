@@ -0,0 +1,353 @@
+from __future__ import annotations
+from bisect import bisect_left, bisect_right
+from typing import List
+
+from src.stations import StationIds
+
+
+INFINITY = float('inf')
+
+
+class Route:
+    """
+    A group of trips on the same line and direction that stop at exactly the same stations in the same order
+    """
+    def __init__(self, line: str, direction: str, stops: List[int]):
+        self.line = line
+        self.direction = direction
+        self.stops = stops
+        self.trips = []
+        self.departures = []
+
+    def can_add_trip(self, times: List[int]) -> bool:
+        """
+        Checks if a trip can be added without overtaking, or being overtaken by, the trips already on the route
+        :param times: the times of the trip at every stop
+        :return: bool
+        """
+        index = bisect_left(self.trips, times)
+        if index > 0 and any(a > b for a, b in zip(self.trips[index - 1], times)):
+            return False
+        if index < len(self.trips) and any(a < b for a, b in zip(self.trips[index], times)):
+            return False
+        return True
+
+    def add_trip(self, times: List[int]):
+        self.trips.insert(bisect_left(self.trips, times), times)
+
+    def finalize(self):
+        """
+        Builds a column of departure times for every stop, so that the earliest trip at a stop can be found with a
+        binary search
+        :return: None
+        """
+        self.departures = [[trip[i] for trip in self.trips] for i in range(0, len(self.stops))]
+
+    def earliest_trip(self, position: int, time: int):
+        """
+        Gets the index of the first trip that departs the stop at 'position' at or after 'time'
+        :param position: the index of the stop on the route
+        :param time: the time in minutes
+        :return: the index of the trip, or None if there is no such trip
+        """
+        index = bisect_left(self.departures[position], time)
+        if index == len(self.trips):
+            return None
+        return index
+
+
+class Leg:
+    """
+    A single ride on one train between two stations, identified by their station ids
+    """
+    def __init__(self, line: str, direction: str, start: int, stop: int, departure: int, arrival: int):
+        self.line = line
+        self.direction = direction
+        self.start = start
+        self.stop = stop
+        self.departure = departure
+        self.arrival = arrival
+
+    def __repr__(self):
+        return "<Leg(line={0}, start={1}, stop={2}, departure={3}, arrival={4})>" \
+            .format(self.line, self.start, self.stop, self.departure, self.arrival)
+
+
+class RaptorPlanner:
+    """
+    Round-based earliest-arrival planner (RAPTOR) that runs over the timetable in memory. Round k finds the earliest
+    arrival at every station using at most k trains, so the number of transfers is bounded by the number of rounds.
+    Stations are identified by their station id, so transfers are only possible at stations that share an id.
+    """
+    def __init__(self, routes: List[Route]):
+        self.routes = routes
+        self.routes_by_stop = {}
+        for route_index, route in enumerate(routes):
+            for position, stop in enumerate(route.stops):
+                self.routes_by_stop.setdefault(stop, []).append((route_index, position))
+        # The last time a train leaves any stop, which goes past MINUTES_PER_DAY when trains run after midnight
+        self.last_departure = max((column[-1] for route in routes for column in route.departures if len(column) > 0),
+                                  default=0)
+
+    @classmethod
+    def from_timetable(cls, timetable) -> RaptorPlanner:
+        """
+        Builds the planner from a Timetable. The runs of every line and direction are expanded into their trips,
+        which are split into routes by the stations that they stop at. Trips of different profiles are merged into
+        the same route, so that a round scans one route per stop pattern instead of one per profile.
+        :param timetable: the Timetable
+        :return: RaptorPlanner
+        """
+        routes = []
+        for line_timetable in timetable.lines.values():
+            routes.extend(RaptorPlanner._line_routes(line_timetable))
+        return cls(routes)
+
+    @staticmethod
+    def _line_routes(line_timetable) -> List[Route]:
+        stop_ids = [StationIds.intern(stop) for stop in line_timetable.stops]
+        patterns = {}
+        for served, trip in line_timetable.trips():
+            if len(served) < 2:
+                continue
+            # Trips that overtake each other go on separate routes, so the trips of a route stay in the same order at
+            # every stop
+            pattern_routes = patterns.setdefault(served, [])
+            route = next((route for route in pattern_routes if route.can_add_trip(trip)), None)
+            if route is None:
+                route = Route(line=line_timetable.line,
+                              direction=line_timetable.direction,
+                              stops=[stop_ids[i] for i in served])
+                pattern_routes.append(route)
+            route.add_trip(trip)
+        routes = []
+        for pattern_routes in patterns.values():
+            for route in pattern_routes:
+                route.finalize()
+                routes.append(route)
+        return routes
+
+    def replace_lines(self, line_timetables) -> RaptorPlanner:
+        """
+        Builds a planner with the routes of some lines and directions rebuilt from their timetables, reusing the
+        routes of every other line. This planner is left untouched, so queries that are running on it can finish.
+        :param line_timetables: list of LineTimetables
+        :return: RaptorPlanner
+        """
+        replaced = set((line_timetable.line, line_timetable.direction) for line_timetable in line_timetables)
+        routes = [route for route in self.routes if (route.line, route.direction) not in replaced]
+        for line_timetable in line_timetables:
+            routes.extend(RaptorPlanner._line_routes(line_timetable))
+        return RaptorPlanner(routes)
+
+    def has_stop(self, stop: int) -> bool:
+        return stop in self.routes_by_stop
+
+    def earliest_arrival(self,
+                         source: int,
+                         target: int,
+                         departure: int,
+                         max_transfers: int = 5,
+                         excluded: set = None) -> List[Leg]:
+        """
+        Finds the journey that arrives at 'target' the earliest when leaving 'source' at 'departure'. Ties are broken
+        by choosing the journey with the least number of transfers.
+        :param source: station id of the starting station
+        :param target: station id of the ending station
+        :param departure: departure time in minutes
+        :param max_transfers: maximum number of transfers
+        :param excluded: station ids of the stations where trains can't be boarded or left
+        :return: List[Leg] describing the journey, or None if there is no journey
+        """
+        if excluded is None:
+            excluded = set()
+        if not self._can_route(source, target, excluded):
+            return None
+        if source == target:
+            return []
+
+        labels, bests, parents = self._new_labels(max_transfers)
+        self._run_rounds(source, target, departure, labels, bests, parents, excluded)
+
+        # Earliest arrival, using the fewest trains
+        arrival = bests[-1].get(target, INFINITY)
+        if arrival == INFINITY:
+            return None
+        best_round = min(k for k in range(1, len(bests)) if bests[k].get(target, INFINITY) == arrival)
+        return self._journey(source, target, best_round, labels, parents)
+
+    def profile(self,
+                source: int,
+                target: int,
+                earliest: int,
+                latest: int,
+                max_transfers: int = 5,
+                excluded: set = None) -> List[List[Leg]]:
+        """
+        Finds every journey from 'source' to 'target' leaving between 'earliest' and 'latest' that is Pareto-optimal
+        on departure time, arrival time and number of transfers (rRAPTOR). The departures from 'source' are scanned
+        from the latest to the earliest, keeping the labels of the previous departures, so each run only explores
+        the stations that an earlier departure reaches sooner.
+        :param source: station id of the starting station
+        :param target: station id of the ending station
+        :param earliest: the earliest departure time in minutes
+        :param latest: the latest departure time in minutes
+        :param max_transfers: maximum number of transfers
+        :param excluded: station ids of the stations where trains can't be boarded or left
+        :return: list of journeys ordered by departure, each a List[Leg]
+        """
+        if excluded is None:
+            excluded = set()
+        if not self._can_route(source, target, excluded) or source == target:
+            return []
+
+        departures = set()
+        for route_index, position in self.routes_by_stop[source]:
+            column = self.routes[route_index].departures[position]
+            departures.update(column[bisect_left(column, earliest):bisect_right(column, latest)])
+
+        labels, bests, parents = self._new_labels(max_transfers)
+        journeys = []
+        for departure in sorted(departures, reverse=True):
+            for k in self._run_rounds(source, target, departure, labels, bests, parents, excluded, latest):
+                journeys.append(self._journey(source, target, k, labels, parents))
+
+        # A later departure with the same arrival and trains is found first, and dominates the earlier ones
+        return pareto_journeys(journeys)
+
+    def _can_route(self, source: int, target: int, excluded: set) -> bool:
+        return source in self.routes_by_stop and target in self.routes_by_stop \
+            and source not in excluded and target not in excluded
+
+    @staticmethod
+    def _new_labels(max_transfers: int):
+        """
+        Creates the labels for a search. labels[k] holds the arrival times found in round k, bests[k] the earliest
+        arrival using at most k trains, and parents[k] the trip that each label in round k was reached with.
+        :param max_transfers: maximum number of transfers
+        :return: tuple of labels, bests and parents
+        """
+        rounds = max_transfers + 2
+        return [{} for k in range(0, rounds)], [{} for k in range(0, rounds)], [{} for k in range(0, rounds)]
+
+    @staticmethod
+    def _set_label(labels, bests, k: int, stop: int, arrival: int):
+        labels[k][stop] = arrival
+        for j in range(k, len(bests)):
+            if arrival < bests[j].get(stop, INFINITY):
+                bests[j][stop] = arrival
+
+    def _run_rounds(self, source, target, departure, labels, bests, parents, excluded, latest=None) -> List[int]:
+        """
+        Runs the rounds for one departure from 'source', improving the labels in place
+        :param latest: the latest time a train can be boarded at 'source', if any
+        :return: the rounds in which the arrival at 'target' improved
+        """
+        self._set_label(labels, bests, 0, source, departure)
+        marked = {source}
+        improved = []
+
+        for k in range(1, len(labels)):
+            previous = bests[k - 1]
+            current = bests[k]
+
+            # Collect the routes that serve a marked stop, and the earliest marked stop on each of them
+            queue = {}
+            for stop in marked:
+                for route_index, position in self.routes_by_stop[stop]:
+                    if route_index not in queue or position < queue[route_index]:
+                        queue[route_index] = position
+            marked = set()
+
+            for route_index, first_position in queue.items():
+                route = self.routes[route_index]
+                trip = None
+                board_position = None
+                for position in range(first_position, len(route.stops)):
+                    stop = route.stops[position]
+                    if stop in excluded:
+                        continue
+
+                    # Alight here if it improves the arrival time at this stop and at the target
+                    if trip is not None:
+                        arrival = route.trips[trip][position]
+                        if arrival < min(current.get(stop, INFINITY), current.get(target, INFINITY)):
+                            self._set_label(labels, bests, k, stop, arrival)
+                            parents[k][stop] = (route_index, trip, board_position, position)
+                            marked.add(stop)
+
+                    # Board an earlier trip if this stop was reached with one train less
+                    if stop in previous and (trip is None or previous[stop] <= route.trips[trip][position]):
+                        earlier_trip = route.earliest_trip(position, previous[stop])
+                        if earlier_trip is not None and stop == source and latest is not None \
+                                and route.departures[position][earlier_trip] > latest:
+                            earlier_trip = None
+                        if earlier_trip is not None and earlier_trip != trip:
+                            trip = earlier_trip
+                            board_position = position
+
+            if target in marked:
+                improved.append(k)
+            if len(marked) == 0:
+                break
+        return improved
+
+    def _journey(self, source, target, k, labels, parents) -> List[Leg]:
+        """
+        Follows the parents back from the label of 'target' in round k
+        :return: List[Leg]
+        """
+        legs = []
+        stop = target
+        while stop != source:
+            route_index, trip, board_position, alight_position = parents[k][stop]
+            route = self.routes[route_index]
+            times = route.trips[trip]
+            legs.insert(0, Leg(line=route.line,
+                               direction=route.direction,
+                               start=route.stops[board_position],
+                               stop=route.stops[alight_position],
+                               departure=times[board_position],
+                               arrival=times[alight_position]))
+            stop = route.stops[board_position]
+            # The trip was boarded from the label of the fewest trains that was there in time
+            k = min(j for j in range(0, k) if labels[j].get(stop, INFINITY) <= times[board_position])
+        return legs
+
+
+def pareto_journeys(journeys: List[List[Leg]]) -> List[List[Leg]]:
+    """
+    Keeps the journeys that no other journey beats on departure time, arrival time and number of transfers. Of the
+    journeys that tie on all three, the first one is kept.
+    :param journeys: list of journeys, each a List[Leg]
+    :return: list of journeys ordered by departure
+    """
+    pareto = {}
+    for legs in journeys:
+        key = (legs[0].departure, legs[-1].arrival, len(legs))
+        if key not in pareto and not any(_dominates(other, legs) for other in journeys):
+            pareto[key] = legs
+    pareto = list(pareto.values())
+    pareto.sort(key=lambda legs: (legs[0].departure, legs[-1].arrival, len(legs)))
+    return pareto
+
+
+def shift_legs(legs: List[Leg], minutes: int) -> List[Leg]:
+    """
+    Moves a journey in time, e.g. to bring a journey of the previous service day back to minutes since midnight
+    :param legs: List[Leg]
+    :param minutes: the number of minutes to add to every time
+    :return: List[Leg]
+    """
+    return [Leg(leg.line, leg.direction, leg.start, leg.stop, leg.departure + minutes, leg.arrival + minutes)
+            for leg in legs]
+
+
+def _dominates(a: List[Leg], b: List[Leg]) -> bool:
+    """
+    Checks if journey 'a' leaves no earlier, arrives no later and uses no more trains than journey 'b', and is
+    better in at least one of them
+    """
+    better_or_equal = a[0].departure >= b[0].departure and a[-1].arrival <= b[-1].arrival and len(a) <= len(b)
+    better = a[0].departure > b[0].departure or a[-1].arrival < b[-1].arrival or len(a) < len(b)
+    return better_or_equal and better
@@ -1,34 +1,161 @@
 from src.models import SubwayStation
+from src.ingest import file_hash
+import argparse
+import json
+import random
 import requests
+import threading
 from bs4 import BeautifulSoup
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from typing import List
+from urllib.parse import urlsplit
 import pandas as pd
 import time
 import os
 import numpy as np
 import geocoder
 
-CODES = "https://moovitapp.com/index/en/public_transit-lines-NYCNJ-121-855111"
-SITE = "https://moovitapp.com/index/en/"
+from src.moovit import SITE, INDEX, CODES, PAGE_DIRECTORY, line_name
 
 
-def yieldLineLinks():
+"""
+Scraper of the station lists of every line from Moovit. The line pages are fetched concurrently by a thread pool
+sharing one pooled session, saved to html_pages and parsed into the map files in data. Run with
+python -m src.scraper [--fetch] [--site URL] [--workers N] [--restart]
+"""
+
+
+PROGRESS_FILE = "progress.json"
+
+# Number of threads fetching pages, and the most requests that may be in flight to one host at a time
+WORKERS = 8
+PER_HOST = 4
+# Seconds to wait for a connection or a response
+TIMEOUT = 10
+# Attempts after the first one, waiting BACKOFF, 2 * BACKOFF, 4 * BACKOFF... seconds between them
+RETRIES = 4
+BACKOFF = 0.5
+MAX_BACKOFF = 30
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+def new_session(pool_size: int = PER_HOST) -> requests.Session:
+    """
+    Creates a session that keeps up to 'pool_size' connections open to every host, so that they are reused by
+    every request instead of connecting again for each page
+    :param pool_size: the number of connections kept per host
+    :return: Session
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+class Fetcher:
+    """
+    Fetches pages for any number of threads over one pooled session. At most 'per_host' requests are in flight to a
+    host at a time, and requests that fail to connect, time out or get a retryable status are retried with
+    exponential backoff.
+    """
+    def __init__(self,
+                 per_host: int = PER_HOST,
+                 timeout: float = TIMEOUT,
+                 retries: int = RETRIES,
+                 backoff: float = BACKOFF):
+        self.session = new_session(per_host)
+        self.per_host = per_host
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        # Number of attempts that were retried
+        self.retried = 0
+        self._hosts = {}
+        self._lock = threading.Lock()
+
+    def get(self, url: str) -> requests.Response:
+        """
+        Gets a page, retrying failed attempts. The backoff is slept outside of the host's slots, so other pages can
+        be fetched from the host meanwhile.
+        :param url: the url of the page
+        :return: the Response, which may have a status that isn't retried like 404, or None if every attempt failed
+        """
+        slots = self._host_slots(url)
+        for attempt in range(0, self.retries + 1):
+            response = None
+            with slots:
+                try:
+                    response = self.session.get(url, timeout=self.timeout)
+                    if response.status_code not in RETRY_STATUSES:
+                        return response
+                    error = "HTTP {}".format(response.status_code)
+                except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                    error = e
+            if attempt < self.retries:
+                with self._lock:
+                    self.retried += 1
+                time.sleep(self._backoff(attempt, response))
+        print("{}: Couldn't connect to {}".format(error, url))
+        return None
+
+    def _host_slots(self, url: str) -> threading.BoundedSemaphore:
+        host = urlsplit(url).netloc
+        with self._lock:
+            if host not in self._hosts:
+                self._hosts[host] = threading.BoundedSemaphore(self.per_host)
+            return self._hosts[host]
+
+    def _backoff(self, attempt: int, response: requests.Response = None) -> float:
+        """
+        Gets the number of seconds to wait before the next attempt. The wait is jittered so that threads that failed
+        together don't retry together, and is at least as long as the Retry-After header of the response asks for.
+        :param attempt: the number of the attempt that failed, starting from 0
+        :param response: the Response of the attempt, if it got one
+        :return: the number of seconds
+        """
+        delay = min(MAX_BACKOFF, self.backoff * 2 ** attempt) * random.uniform(0.5, 1)
+        if response is not None and response.headers.get("Retry-After", "").isdigit():
+            delay = max(delay, int(response.headers["Retry-After"]))
+        return delay
+
+
+def yieldLineLinks(fetcher: Fetcher = None, site: str = SITE, directory: str = PAGE_DIRECTORY) -> List[list]:
+    """
+    Gets the page of every line from the index of the lines, saving the index to content.html
+    :param fetcher: the Fetcher, defaults to a new one
+    :param site: the url that the index and the line pages are under
+    :param directory: the directory to save the index to
+    :return: list of [line, url] pairs, empty if the index couldn't be fetched
+    """
+    if fetcher is None:
+        fetcher = Fetcher()
     arr = []
-    resp = requests.get(CODES)
+    resp = fetcher.get(site + INDEX)
+    if resp is None or not resp.ok:
+        return arr
     soup = BeautifulSoup(resp.content, 'html.parser')
-    with open('html_pages/content.html', 'w', encoding='utf-8') as f:
+    with open(os.path.join(directory, 'content.html'), 'w', encoding='utf-8') as f:
         f.write(str(resp.content))
         f.close()
     for list_item in soup.find_all("li", {"class": "line-item"}):
         a = list_item.find("a")
         href = a['href']
-        line_name = href.split('-')[2]
-        arr.append([line_name, SITE + href])
+        arr.append([line_name(href), site + href])
     return arr
 
 
-def save(name, content):
-    with open('html_pages/{0}.html'.format(name), 'w', encoding='utf-8') as f:
+def page_path(name: str, directory: str = PAGE_DIRECTORY) -> str:
+    return os.path.join(directory, '{0}.html'.format(name))
+
+
+def save(name, content, directory: str = PAGE_DIRECTORY):
+    # Written next to the page and renamed over it, so an interrupted scrape never leaves half a page behind
+    temporary = "{}.{}.tmp".format(page_path(name, directory), threading.get_ident())
+    with open(temporary, 'w', encoding='utf-8') as f:
         f.write(str(content))
+    os.replace(temporary, page_path(name, directory))
 
 
 class StationScraper:
@@ -36,12 +163,109 @@ class StationScraper:
         self.line = line
         self.url = url
 
-    def scrape(self):
-        try:
-            return requests.get(self.url)
-        except requests.exceptions.RequestException as e:
-            print("{}: Couldn't connect to {}".format(e, self.url))
-            return None
+    def scrape(self, fetcher: Fetcher = None):
+        if fetcher is None:
+            fetcher = Fetcher()
+        return fetcher.get(self.url)
+
+
+class Progress:
+    """
+    Record of the pages that were saved to a directory, kept in its progress.json so that an interrupted scrape
+    resumes where it stopped. A page only counts as done while it still has the url and the hash that were recorded
+    when it was saved.
+    """
+    def __init__(self, directory: str = PAGE_DIRECTORY):
+        self.directory = directory
+        self.path = os.path.join(directory, PROGRESS_FILE)
+        self.pages = {}
+        self._lock = threading.Lock()
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                self.pages = json.load(f)
+
+    def done(self, name: str, url: str) -> bool:
+        """
+        Checks if a page was already saved
+        :param name: the name of the page
+        :param url: the url of the page
+        :return: bool
+        """
+        entry = self.pages.get(name)
+        filename = page_path(name, self.directory)
+        return entry is not None and entry["url"] == url and os.path.exists(filename) and \
+            file_hash(filename) == entry["hash"]
+
+    def record(self, name: str, url: str):
+        """
+        Records that a page was saved, and writes the progress file
+        :param name: the name of the page
+        :param url: the url of the page
+        :return: None
+        """
+        entry = {"url": url,
+                 "hash": file_hash(page_path(name, self.directory)),
+                 "fetched": time.strftime("%Y-%m-%dT%H:%M:%S")}
+        with self._lock:
+            self.pages[name] = entry
+            temporary = "{}.tmp".format(self.path)
+            with open(temporary, "w") as f:
+                json.dump(self.pages, f, indent=1, sort_keys=True)
+            os.replace(temporary, self.path)
+
+    def clear(self):
+        """
+        Forgets every page, so that they are all fetched again
+        :return: None
+        """
+        with self._lock:
+            self.pages = {}
+            if os.path.exists(self.path):
+                os.remove(self.path)
+
+
+def scrape_pages(links: List[list],
+                 fetcher: Fetcher = None,
+                 directory: str = PAGE_DIRECTORY,
+                 workers: int = WORKERS,
+                 resume: bool = True) -> dict:
+    """
+    Fetches and saves the page of every line in a thread pool, skipping the pages that were already saved
+    :param links: list of [line, url] pairs. Only the first url of a line is fetched, as they are saved by line
+    :param fetcher: the Fetcher, defaults to a new one
+    :param directory: the directory to save the pages to
+    :param workers: the number of threads
+    :param resume: whether to skip the pages recorded in the progress file, otherwise they are all fetched again
+    :return: dictionary with the number of pages fetched, skipped and failed
+    """
+    if fetcher is None:
+        fetcher = Fetcher()
+    progress = Progress(directory)
+    if not resume:
+        progress.clear()
+
+    urls = {}
+    for line, url in links:
+        urls.setdefault(line, url)
+    pending = [(line, url) for line, url in urls.items() if not progress.done(line, url)]
+
+    def fetch(link):
+        line, url = link
+        resp = StationScraper(line, url).scrape(fetcher)
+        if resp is None:
+            return False
+        if not resp.ok:
+            print("HTTP {}: Couldn't fetch {}".format(resp.status_code, url))
+            return False
+        save(line, resp.content, directory)
+        progress.record(line, url)
+        return True
+
+    counts = {"fetched": 0, "skipped": len(urls) - len(pending), "failed": 0}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for fetched in executor.map(fetch, pending):
+            counts["fetched" if fetched else "failed"] += 1
+    return counts
 
 
 class Parser:
@@ -89,7 +313,7 @@ class Parser:
             station_entrances.append(entrance)
         return np.array(station_entrances).T
 
-    def get_station_boroughs(self):\
+    def get_station_boroughs(self):
         """
         Parses the content and gets the boroughs
         :return: list of boroughs
@@ -184,7 +408,25 @@ def fix_map_exceptions(stations, addresses, lines):
 
 
 if __name__ == "__main__":
-    folder = "html_pages"
+    argument_parser = argparse.ArgumentParser()
+    argument_parser.add_argument("--fetch", action="store_true", help="fetch the line pages before parsing them")
+    argument_parser.add_argument("--site", default=SITE,
+                                 help="the url of the site, e.g. of python -m src.fixture_server")
+    argument_parser.add_argument("--workers", type=int, default=WORKERS)
+    argument_parser.add_argument("--per-host", type=int, default=PER_HOST)
+    argument_parser.add_argument("--restart", action="store_true",
+                                 help="fetch every page again instead of resuming")
+    args = argument_parser.parse_args()
+
+    folder = PAGE_DIRECTORY
+    if args.fetch:
+        fetcher = Fetcher(per_host=args.per_host)
+        start = time.perf_counter()
+        counts = scrape_pages(yieldLineLinks(fetcher, args.site, folder), fetcher, folder, args.workers,
+                              resume=not args.restart)
+        print("Fetched {fetched}, skipped {skipped} and failed {failed} pages".format(**counts) +
+              " in {:.2f} s with {} retries".format(time.perf_counter() - start, fetcher.retried))
+
     pages = os.listdir(folder)
     pages = ['{}/{}'.format(folder, page) for page in pages if len(page) <= 7]
 
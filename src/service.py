@@ -1,12 +1,20 @@
 from __future__ import annotations
 from src.repository import *
 from src.models import *
-import pandas as pd
+from src.routing import RaptorPlanner, pareto_journeys, shift_legs
+from src.timetable import Timetable, LineTimetable, DepartureBoard, format_minutes, MINUTES_PER_DAY
+from src.graph import GraphSnapshot, UNREACHABLE, normalize_line
+from src.cache import RouteCache
+from src.snapshot import read_snapshot, write_snapshot
+from src.delays import DelayRegistry
+from src.stations import StationIds
+from pymongo.errors import ServerSelectionTimeoutError, OperationFailure, PyMongoError
 import numpy as np
-import itertools
 import os
 import hashlib
-from datetime import datetime, timedelta
+import threading
+import time
+from datetime import datetime
 from sqlalchemy.exc import IntegrityError
 
 
@@ -14,6 +22,19 @@ class MapService:
     """
     Class that handles all intermediate logic for the Neo4j graph database
     """
+    # In-memory snapshot of the graph and the SubwayStations grouped by station id, shared by every MapService
+    # in the process. The version is kept in Neo4j and bumped by any process that changes the graph, and this process
+    # reads it at most once every 'graph_version_interval' seconds.
+    _graph_version = 0
+    _graph_checked = None
+    _snapshot = None
+    _stations_by_id = None
+    graph_version_interval = 1
+
+    # Planned routes, keyed by the stations, the departure bucket and the graph and schedule versions
+    route_cache = RouteCache()
+    departure_bucket_minutes = 1
+
     def __init__(self):
         self.repository = MapRepository()
 
@@ -45,13 +66,342 @@ class MapService:
 
     def get_shortest_path(self,
                           start_station: SubwayStation,
-                          stop_station: SubwayStation) -> List[TrainLine]:
+                          stop_station: SubwayStation,
+                          departure_time: datetime = None) -> List[TrainLine]:
+        """
+        Gets the fastest route between two SubwayStation nodes. The route is planned in memory over the timetable,
+        falling back to the graph when either station is missing from the timetable.
+        :param start_station: the starting node
+        :param stop_station: the ending node
+        :param departure_time: the time to leave at, defaults to now
+        :return: List[TrainLine] objects describing the route taken, and the departure and arrival time of each one
+        """
+        self._sync_graph_version()
+        departure = self._departure_bucket(departure_time)
+        key = (start_station.station_id, start_station.entrances,
+               stop_station.station_id, stop_station.entrances,
+               departure, MapService._graph_version, ScheduleService.schedule_version)
+        result = MapService.route_cache.get(key)
+        if result is None:
+            result = self._get_shortest_path_uncached(start_station, stop_station, departure)
+            MapService.route_cache.put(key, result)
+        return result
+
+    def get_alternative_paths(self,
+                              start_station: SubwayStation,
+                              stop_station: SubwayStation,
+                              window: int = 60,
+                              departure_time: datetime = None) -> List[List[TrainLine]]:
+        """
+        Gets every route between two SubwayStation nodes leaving within 'window' minutes that is not beaten by
+        another one on departure time, arrival time and number of transfers, e.g. leaving later but arriving at
+        the same time. All of them are found in a single profile search over the timetable.
+        :param start_station: the starting node
+        :param stop_station: the ending node
+        :param window: the number of minutes after the departure time to look at
+        :param departure_time: the start of the window, defaults to now
+        :return: list of routes ordered by departure, each a tuple of the List[TrainLine] and the departure and arrival
+        time of each one
+        """
+        self._sync_graph_version()
+        departure = self._departure_bucket(departure_time)
+        key = ("profile", start_station.station_id, start_station.entrances,
+               stop_station.station_id, stop_station.entrances,
+               departure, window, MapService._graph_version, ScheduleService.schedule_version)
+        result = MapService.route_cache.get(key)
+        if result is None:
+            result = []
+            planner = ScheduleService().get_planner()
+            if planner.has_stop(start_station.station_id) and planner.has_stop(stop_station.station_id):
+                excluded = self._excluded_ids()
+                journeys = []
+                for shift in self._service_day_shifts(planner, departure):
+                    journeys.extend(shift_legs(legs, -shift) for legs in planner.profile(start_station.station_id,
+                                                                                         stop_station.station_id,
+                                                                                         departure + shift,
+                                                                                         departure + window + shift,
+                                                                                         excluded=excluded))
+                result = [self._legs_to_train_lines(legs, start_station, stop_station)
+                          for legs in pareto_journeys(journeys)]
+            MapService.route_cache.put(key, result)
+        return result
+
+    def _departure_bucket(self, departure_time: datetime = None) -> int:
+        """
+        Rounds a departure time down to the start of its bucket, so every request in the bucket shares the cached
+        routes
+        :param departure_time: the departure time, defaults to now
+        :return: the start of the bucket in minutes
+        """
+        if departure_time is None:
+            departure_time = datetime.now()
+        minutes = departure_time.hour * 60 + departure_time.minute
+        return minutes // self.departure_bucket_minutes * self.departure_bucket_minutes
+
+    def _get_shortest_path_uncached(self,
+                                    start_station: SubwayStation,
+                                    stop_station: SubwayStation,
+                                    departure: int) -> List[TrainLine]:
+        """
+        Plans the fastest route between two SubwayStation nodes without going through the route cache
+        :param start_station: the starting node
+        :param stop_station: the ending node
+        :param departure: the departure time in minutes
+        :return: List[TrainLine] objects describing the route taken, and the departure and arrival time of each one
+        """
+        if not self.are_connected(start_station, stop_station):
+            return None, None
+
+        planner = ScheduleService().get_planner()
+        if planner.has_stop(start_station.station_id) and planner.has_stop(stop_station.station_id):
+            return self._plan_with_timetable(planner, start_station, stop_station, departure)
+        return self._get_shortest_path_from_graph(start_station, stop_station, departure)
+
+    def _plan_with_timetable(self,
+                             planner: RaptorPlanner,
+                             start_station: SubwayStation,
+                             stop_station: SubwayStation,
+                             departure: int) -> List[TrainLine]:
+        """
+        Plans the earliest arrival between two SubwayStation nodes with the RaptorPlanner
+        :param planner: the RaptorPlanner
+        :param start_station: the starting node
+        :param stop_station: the ending node
+        :param departure: the departure time in minutes
+        :return: List[TrainLine] objects describing the route taken, and the departure and arrival time of each one
+        """
+        excluded = self._excluded_ids()
+        best = None
+        for shift in self._service_day_shifts(planner, departure):
+            legs = planner.earliest_arrival(start_station.station_id,
+                                            stop_station.station_id,
+                                            departure + shift,
+                                            excluded=excluded)
+            if legs is None or len(legs) == 0:
+                continue
+            legs = shift_legs(legs, -shift)
+            # Earliest arrival, using the fewest trains
+            if best is None or (legs[-1].arrival, len(legs)) < (best[-1].arrival, len(best)):
+                best = legs
+        if best is None:
+            return None, None
+        return self._legs_to_train_lines(best, start_station, stop_station)
+
+    @staticmethod
+    def _service_day_shifts(planner: RaptorPlanner, departure: int) -> List[int]:
+        """
+        Gets the shifts to plan a departure at. Trips of the previous service day are stored past MINUTES_PER_DAY, so
+        while they are still running after midnight the departure is also planned a day later, the way
+        DepartureBoard.next_departures looks them up.
+        :param planner: the RaptorPlanner
+        :param departure: the departure time in minutes since midnight
+        :return: list of the minutes to add to the departure
+        """
+        if departure + MINUTES_PER_DAY <= planner.last_departure:
+            return [0, MINUTES_PER_DAY]
+        return [0]
+
+    def _excluded_ids(self) -> set:
+        """
+        Gets the station ids of the stations where trains can't be boarded or left because they are out of order
+        :return: set of station ids
+        """
+        return set([station_id for station_id, stations in self._get_stations_by_id().items()
+                    if all(station.status != "Normal" for station in stations)])
+
+    def _legs_to_train_lines(self, legs, start_station: SubwayStation, stop_station: SubwayStation):
+        """
+        Converts the legs of a planned journey to TrainLines
+        :param legs: List[Leg]
+        :param start_station: the starting node
+        :param stop_station: the ending node
+        :return: List[TrainLine], and the departure and arrival time of each one
+        """
+        train_lines = []
+        path_times = []
+        for leg in legs:
+            start = self._station_for_id(leg.start, start_station, stop_station)
+            stop = self._station_for_id(leg.stop, start_station, stop_station)
+            train_lines.append(TrainLine(start=start,
+                                         stop=stop,
+                                         line=leg.line,
+                                         departure_time=format_minutes(leg.departure),
+                                         arrival_time=format_minutes(leg.arrival)))
+            path_times.append([leg.departure, leg.arrival])
+
+        return train_lines, path_times
+
+    def _station_for_id(self, station_id: int, start_station: SubwayStation,
+                        stop_station: SubwayStation) -> SubwayStation:
+        """
+        Gets the SubwayStation for a station id, preferring the stations that the trip starts and stops at
+        :param station_id: the station id
+        :param start_station: the starting SubwayStation of the trip
+        :param stop_station: the ending SubwayStation of the trip
+        :return: SubwayStation
+        """
+        if station_id == start_station.station_id:
+            return start_station
+        if station_id == stop_station.station_id:
+            return stop_station
+        stations = self._get_stations_by_id().get(station_id, [])
+        for station in stations:
+            if station.status == "Normal":
+                return station
+        if len(stations) > 0:
+            return stations[0]
+        return SubwayStation(station_name=StationIds.key(station_id), entrances="")
+
+    def _get_stations_by_id(self) -> dict:
+        """
+        Gets all of the SubwayStations grouped by their station id. Loaded once and reset whenever a station's
+        status changes
+        :return: dictionary mapping station ids to lists of SubwayStation objects
+        """
+        if MapService._stations_by_id is None:
+            stations_by_id = {}
+            for station in self.get_graph_snapshot().stations:
+                stations_by_id.setdefault(station.station_id, []).append(station)
+            MapService._stations_by_id = stations_by_id
+        return MapService._stations_by_id
+
+    def get_graph_snapshot(self) -> GraphSnapshot:
+        """
+        Gets the in-memory snapshot of the graph, rebuilding it from Neo4j if the graph has changed since it was built
+        :return: GraphSnapshot
+        """
+        self._sync_graph_version()
+        snapshot = MapService._snapshot
+        if snapshot is None or snapshot.version != MapService._graph_version:
+            nodes, relationships = self.repository.get_graph()
+            snapshot = GraphSnapshot.from_records(nodes, relationships, MapService._graph_version)
+            snapshot.set_running_times(ScheduleService().get_timetable().running_times())
+            MapService._snapshot = snapshot
+            MapService._stations_by_id = None
+        return snapshot
+
+    def are_connected(self,
+                      start_station: SubwayStation,
+                      stop_station: SubwayStation) -> bool:
+        """
+        Checks whether there is a path between two SubwayStations through stations whose status is "Normal"
+        :param start_station: the starting SubwayStation
+        :param stop_station: the ending SubwayStation
+        :return: False if there is no path, True otherwise (or if either station is not in the snapshot)
+        """
+        snapshot = self.get_graph_snapshot()
+        i = snapshot.station_index(start_station)
+        j = snapshot.station_index(stop_station)
+        if i is None or j is None:
+            return True
+        return snapshot.is_connected(i, j)
+
+    def get_min_stops(self,
+                      start_station: SubwayStation,
+                      stop_station: SubwayStation) -> int:
+        """
+        Gets the fewest stops between two SubwayStations from the precomputed all-pairs matrix
+        :param start_station: the starting SubwayStation
+        :param stop_station: the ending SubwayStation
+        :return: the number of stops, or None if there is no path or either station is unknown
+        """
+        snapshot = self.get_graph_snapshot()
+        i = snapshot.station_index(start_station)
+        j = snapshot.station_index(stop_station)
+        if i is None or j is None or snapshot.min_stops(i, j) == UNREACHABLE:
+            return None
+        return snapshot.min_stops(i, j)
+
+    def get_min_transfers(self,
+                          start_station: SubwayStation,
+                          stop_station: SubwayStation) -> int:
         """
-        Gets the shortest paths between two SubwayStation nodes
+        Gets the fewest transfers between two SubwayStations from the precomputed all-pairs matrix
+        :param start_station: the starting SubwayStation
+        :param stop_station: the ending SubwayStation
+        :return: the number of transfers, or None if there is no path or either station is unknown
+        """
+        snapshot = self.get_graph_snapshot()
+        i = snapshot.station_index(start_station)
+        j = snapshot.station_index(stop_station)
+        if i is None or j is None or snapshot.min_transfers(i, j) == UNREACHABLE:
+            return None
+        return snapshot.min_transfers(i, j)
+
+    def _invalidate_graph(self):
+        """
+        Marks the in-memory snapshot as out of date in every process and refreshes the GDS projection after the graph
+        has been changed
+        :return: None
+        """
+        MapService._graph_version = self.repository.bump_graph_version()
+        MapService._graph_checked = time.monotonic()
+        MapService._stations_by_id = None
+        MapService.route_cache.clear()
+        self.repository.refresh_projection()
+
+    def _sync_graph_version(self):
+        """
+        Picks up the changes that other processes made to the graph. The snapshot is rebuilt the next time it is
+        used, and the routes planned on the old graph are dropped.
+        :return: None
+        """
+        now = time.monotonic()
+        if MapService._graph_checked is not None and now - MapService._graph_checked < self.graph_version_interval:
+            return
+        MapService._graph_checked = now
+        version = self.repository.get_graph_version()
+        if version != MapService._graph_version:
+            MapService._graph_version = version
+            MapService._stations_by_id = None
+            MapService.route_cache.clear()
+
+    def _get_shortest_path_from_graph(self,
+                                      start_station: SubwayStation,
+                                      stop_station: SubwayStation,
+                                      departure: int) -> List[TrainLine]:
+        """
+        Gets the shortest paths between two SubwayStation nodes in the graph and times them with the schedules
         :param start_station: the starting node
         :param stop_station: the ending node
+        :param departure: the departure time in minutes
         :return: List[TrainLine] objects describing the route taken
         """
+        stations, lines = self._get_station_path(start_station, stop_station)
+
+        # Use the 2d array of lines to construct the paths with the fewest transfers
+        paths = []
+        reduced_stations = []
+        for sequence in MapService._line_assignments(lines):
+            p, s = MapService._reduce_path(sequence, list(stations))
+            paths.append(p)
+            reduced_stations.append(s)
+        if len(paths) == 0:
+            return None, None
+        shortest_path = MapService._calculate_shortest_path(paths, reduced_stations, departure)
+
+        return shortest_path
+
+    def _get_station_path(self,
+                          start_station: SubwayStation,
+                          stop_station: SubwayStation) -> (List[SubwayStation], List[List[str]]):
+        """
+        Gets the path between two SubwayStation nodes and the lines connecting each pair of stations on it. Served
+        from the in-memory snapshot with an A* search over running times, or from Neo4j (fewest stops) if either
+        station is not in the snapshot.
+        :param start_station: the starting node
+        :param stop_station: the ending node
+        :return: the list of SubwayStations in the path and the lines between each pair of them
+        """
+        snapshot = self.get_graph_snapshot()
+        start = snapshot.station_index(start_station)
+        stop = snapshot.station_index(stop_station)
+        if start is not None and stop is not None:
+            path = snapshot.fastest_path(start, stop)
+            if path is None:
+                return [stop_station], []
+            return [snapshot.stations[i] for i in path], snapshot.lines_along(path)
+
         result = self.repository.shortest_path(start_station, stop_station)
 
         # Iterate through the path and append stations to an array
@@ -63,33 +413,48 @@ class MapService:
         # Add the stop station to the array
         stations.append(stop_station)
 
+        # Get the lines connecting each pair of stations in the path
+        lines = self.get_connections_along_path(stations)
+        return stations, lines
 
-        # Iterate through the stations in the path adding the lines connecting each pair of stations
-        # to an array
-        lines = []
-        for i in range(0, len(stations) - 1):
-            connections = self.get_connections_between_stations(stations[i], stations[i + 1])
-            lines.append(connections)
-
-        # Use the 2d array of lines to construct all possible paths
-        paths = []
-        reduced_stations = []
-
-        min_transfers = 10000
-
-        for t in itertools.product(*lines):
-            p, s = MapService._reduce_path(list(t), list(stations))
-            if len(paths) < min_transfers:
-                paths.insert(0, p)
-                reduced_stations.insert(0, s)
-                min_transfers = len(paths)
-
-            else:
-                paths.append(p)
-                reduced_stations.append(s)
-        shortest_path = MapService._calculate_shortest_path(paths, reduced_stations)
-
-        return shortest_path
+    @staticmethod
+    def _line_assignments(lines: List[List[str]], k: int = 5) -> List[List[str]]:
+        """
+        Assigns a line to every hop of a path so that the number of transfers is minimized. Solved as a dynamic
+        program over (hop, line) states that keeps the k best partial assignments for every state, instead of
+        expanding every combination of lines.
+        :param lines: the lines that connect each pair of consecutive stations
+        :param k: the number of assignments to return
+        :return: up to k line assignments, ordered by their number of transfers
+        """
+        # 7X and 6X are the same trains as the 7 and 6 in the schedules db
+        lines = [sorted(set([normalize_line(line) for line in hop])) for hop in lines]
+        if len(lines) == 0 or any(len(hop) == 0 for hop in lines):
+            return []
+
+        # best[i][line] holds up to k (transfers, previous line, rank of the previous entry) tuples
+        best = [{line: [(0, None, None)] for line in lines[0]}]
+        for i in range(1, len(lines)):
+            layer = {}
+            for line in lines[i]:
+                candidates = []
+                for previous_line, entries in best[i - 1].items():
+                    for rank, entry in enumerate(entries):
+                        candidates.append((entry[0] + (line != previous_line), previous_line, rank))
+                layer[line] = sorted(candidates)[:k]
+            best.append(layer)
+
+        endings = sorted([(entry[0], line, rank) for line, entries in best[-1].items()
+                          for rank, entry in enumerate(entries)])[:k]
+        assignments = []
+        for transfers, line, rank in endings:
+            sequence = []
+            for i in range(len(lines) - 1, -1, -1):
+                sequence.insert(0, line)
+                _, previous_line, previous_rank = best[i][line][rank]
+                line, rank = previous_line, previous_rank
+            assignments.append(sequence)
+        return assignments
 
     @staticmethod
     def _reduce_path(path, stations):
@@ -125,25 +490,24 @@ class MapService:
         return reduced_paths, reduced_stations
 
     @staticmethod
-    def _calculate_shortest_path(paths, reduced_stations) -> List[TrainLine]:
+    def _calculate_shortest_path(paths, reduced_stations, departure: int) -> List[TrainLine]:
         """
         Uses the schedules to determine which unweighted path is fastest.
         :param paths: list of paths
         :param reduced_stations: list of stations for those paths
+        :param departure: the departure time in minutes
         :return: list of TrainLine objects describing the shortest path
         """
         schedule_service = ScheduleService()
         fastest_path = paths[0]
-        fastest_time_taken = timedelta(minutes=100000)
+        fastest_time_taken = 100000
         fastest_path_times = []
         fastest_stations = []
         transfers = 1000
 
         visited_paths = {}
 
-        # start_time = datetime(year=1900,  month=1, day=1, hour=13, minute=48, second=0)
-
-        start_time = datetime.now().replace(year=1900, month=1, day=1)
+        start_time = departure
 
         for path, stations in zip(paths, reduced_stations):
             evaluate = True
@@ -173,7 +537,7 @@ class MapService:
                 departure_time = sched['Schedule'][cur_start_station.schedule_key()]
                 arrival_time = sched['Schedule'][cur_end_station.schedule_key()]
                 path_times.append([departure_time, arrival_time])
-                time = arrival_time.replace(day=1, second=0)
+                time = arrival_time
 
 
             # If it takes less time, make that path the fastest path
@@ -199,8 +563,8 @@ class MapService:
             train_line = TrainLine(start=fastest_stations[i],
                                    stop=fastest_stations[i+1],
                                    line=fastest_path[i],
-                                   departure_time=fastest_path_times[i][0].strftime("%H:%M"),
-                                   arrival_time=fastest_path_times[i][1].strftime("%H:%M"))
+                                   departure_time=format_minutes(fastest_path_times[i][0]),
+                                   arrival_time=format_minutes(fastest_path_times[i][1]))
             train_lines.append(train_line)
 
         return train_lines, fastest_path_times
@@ -364,9 +728,27 @@ class MapService:
         :param station_2: SubwayStation object
         :return: list containing the starting nodes, ending nodes, and relationships between the two stations
         """
+        snapshot = self.get_graph_snapshot()
+        i = snapshot.station_index(station_1)
+        j = snapshot.station_index(station_2)
+        if i is not None and j is not None:
+            return snapshot.lines_between(i, j)
         result = self.repository.get_connections_between_stations(station_1, station_2)
         return result
 
+    def get_connections_along_path(self,
+                                   stations: List[SubwayStation]) -> List[List[str]]:
+        """
+        Gets the lines connecting each pair of consecutive SubwayStations in a path
+        :param stations: ordered list of SubwayStation objects
+        :return: list containing the lines between each pair of stations
+        """
+        snapshot = self.get_graph_snapshot()
+        path = [snapshot.station_index(station) for station in stations]
+        if None not in path:
+            return snapshot.lines_along(path)
+        return self.repository.get_connections_along_path(stations)
+
     def get_station_by_name_and_entrance(self, station_name: str, entrance: str) -> SubwayStation:
         """
         Gets the SubwayStation node corresponding to the given name and entrance
@@ -384,7 +766,7 @@ class MapService:
         Gets a list of the unique lines in the graph
         :return:
         """
-        return self.repository.get_distinct_lines()
+        return [{"lines": line} for line in self.get_graph_snapshot().lines]
 
     def set_station_status_out_of_order(self,
                                         station: SubwayStation):
@@ -489,6 +871,8 @@ class MapService:
             else:
                 self.repository.create_reroute(train_line=train_line, reroute=[station.reroute()])
 
+        self._invalidate_graph()
+
 
     def _get_all_reroutes_and_extras(self, station):
         """
@@ -588,13 +972,250 @@ class MapService:
                     self.repository.create_reroute(train_line=line_out,
                                                    reroute=rerouted_stations[station_index + 1:])
 
+        self._invalidate_graph()
+
 
 
 class ScheduleService:
+    # Timetable and RaptorPlanner over the whole Schedule collection, shared by every ScheduleService in the process.
+    # The base timetable is the schedules as they were loaded, and the timetable has the delays applied on top of it.
+    # The version is bumped every time this process changes the schedules.
+    _base_timetable = None
+    _timetable = None
+    _planner = None
+    _departure_board = None
+    schedule_version = 0
+    # Delayed trains, as Schedules without their delay applied, kept current by this process and by follow_delays
+    delay_registry = DelayRegistry()
+    _apply_lock = threading.Lock()
+    _follower = None
+    # Path of the binary timetable snapshot that is mapped at startup instead of querying MongoDB, if set
+    snapshot_path = None
 
     def __init__(self):
         self.repository = ScheduleRepository()
 
+    def load_timetable(self) -> Timetable:
+        """
+        Loads the in-memory Timetable. The snapshot is mapped if there is one, otherwise the Timetable is read from
+        the compressed Timetable collection, compiling it from the Schedule collection the first time, and then
+        written to the snapshot for the next process. The delays are then applied on top of it.
+        :return: Timetable
+        """
+        if ScheduleService.snapshot_path is not None and os.path.exists(ScheduleService.snapshot_path):
+            ScheduleService._base_timetable = read_snapshot(ScheduleService.snapshot_path)
+        else:
+            documents = list(self.repository.get_timetables())
+            if len(documents) > 0:
+                ScheduleService._base_timetable = Timetable.from_mongo(documents)
+            else:
+                ScheduleService._base_timetable = self.compile_timetable()
+            if ScheduleService.snapshot_path is not None:
+                write_snapshot(ScheduleService._base_timetable, ScheduleService.snapshot_path, source="mongo")
+
+        try:
+            ScheduleService.delay_registry.load([Schedule.from_mongo(x) for x in self.repository.get_delays()])
+        except ServerSelectionTimeoutError:
+            print("MongoDB is unavailable, the timetable is loaded without delays")
+            ScheduleService.delay_registry.load([])
+        delays = {}
+        for schedule in ScheduleService.delay_registry.schedules():
+            delays.setdefault((schedule.line, schedule.direction), []).append(
+                (schedule.schedule, schedule.delay["start"], schedule.delay["time"]))
+        ScheduleService._timetable = ScheduleService._base_timetable.with_delays(delays)
+
+        ScheduleService._planner = None
+        ScheduleService._departure_board = None
+        ScheduleService.schedule_version += 1
+        MapService.route_cache.clear()
+        return ScheduleService._timetable
+
+    def compile_timetable(self) -> Timetable:
+        """
+        Compresses every schedule in the Schedule collection and saves the result to the Timetable collection
+        :return: Timetable
+        """
+        timetable = Timetable.from_schedules(self.repository.get_all_schedules())
+        self.repository.save_timetables(timetable.to_mongo(), replace=True)
+        return timetable
+
+    def compile_line_direction(self, line: str, direction: str) -> LineTimetable:
+        """
+        Compresses the schedules of a single line and direction and saves the result to the Timetable collection
+        :param line: the line
+        :param direction: the direction
+        :return: LineTimetable, or None if the line and direction has no schedules
+        """
+        schedules = [x for x in self.repository.get_schedules_by_line_direction(line=line, direction=direction,
+                                                                                apply_delays=False)]
+        if len(schedules) == 0:
+            self.repository.remove_timetable(str(line).upper(), direction)
+            return None
+        line_timetable = LineTimetable.from_schedules(str(line).upper(), direction, schedules)
+        self.repository.save_timetables([line_timetable.to_mongo()])
+        return line_timetable
+
+    def get_timetable(self) -> Timetable:
+        """
+        Gets the in-memory Timetable with the delays applied, loading it the first time
+        :return: Timetable
+        """
+        if ScheduleService._timetable is None:
+            self.load_timetable()
+        return ScheduleService._timetable
+
+    def get_planner(self) -> RaptorPlanner:
+        """
+        Gets the RaptorPlanner for the in-memory Timetable
+        :return: RaptorPlanner
+        """
+        if ScheduleService._planner is None:
+            ScheduleService._planner = RaptorPlanner.from_timetable(self.get_timetable())
+        return ScheduleService._planner
+
+    def get_departure_board(self) -> DepartureBoard:
+        """
+        Gets the DepartureBoard for the in-memory Timetable, building it again the first time it is needed after the
+        delays change
+        :return: DepartureBoard
+        """
+        if ScheduleService._departure_board is None:
+            ScheduleService._departure_board = DepartureBoard.from_timetable(self.get_timetable())
+        return ScheduleService._departure_board
+
+    def get_next_departures(self, station_key: str, time: int, count: int = 10) -> List[dict]:
+        """
+        Gets the next departures of every line from a station, with the delays applied
+        :param station_key: schedule key of the station
+        :param time: the time in minutes since midnight
+        :param count: the maximum number of departures
+        :return: list of dictionaries of the Line, Direction, Destination, Time and the minutes until the departure, or
+        None if no train stops at the station
+        """
+        board = self.get_departure_board()
+        if station_key not in board:
+            return None
+        return [{"Line": line, "Direction": direction, "Destination": destination,
+                 "Time": format_minutes(departure), "Minutes": departure - time}
+                for departure, line, direction, destination in board.next_departures(station_key, time, count)]
+
+    def _apply_delays(self, line_directions):
+        """
+        Applies the delays of some lines and directions to their base timetables again after they change. The other
+        lines are left as they are, and the routes of the planner are only rebuilt for the lines that changed.
+        :param line_directions: iterable of tuples of the line and direction
+        :return: None
+        """
+        if ScheduleService._timetable is None:
+            return
+        # Held while the delays are read, so that a line can't be rebuilt from delays older than the last rebuild
+        with ScheduleService._apply_lock:
+            line_timetables = []
+            for line, direction in set(line_directions):
+                if (line, direction) not in ScheduleService._base_timetable.lines:
+                    continue
+                delays = [(schedule.schedule, schedule.delay["start"], schedule.delay["time"])
+                          for schedule in ScheduleService.delay_registry.schedules(line, direction)]
+                line_timetables.append(ScheduleService._base_timetable.lines[(line, direction)].with_delays(delays))
+            if len(line_timetables) == 0:
+                return
+            for line_timetable in line_timetables:
+                ScheduleService._timetable.replace_line(line_timetable)
+            if ScheduleService._planner is not None:
+                ScheduleService._planner = ScheduleService._planner.replace_lines(line_timetables)
+            ScheduleService._departure_board = None
+            ScheduleService.schedule_version += 1
+        MapService.route_cache.clear()
+
+    def _get_segment(self, line: str, direction: str, from_station: str, to_station: str) -> List[str]:
+        """
+        Gets the stations of a line and direction from one station to another, in the order the trains stop at them
+        :param line: the line, in upper case
+        :param direction: the direction
+        :param from_station: schedule key of the first station of the segment
+        :param to_station: schedule key of the last station of the segment
+        :return: list of schedule keys
+        """
+        self.get_timetable()
+        line_timetable = ScheduleService._base_timetable.lines.get((line, direction))
+        if line_timetable is None:
+            raise ValueError("There is no {} train going {}".format(line, direction))
+        stops = line_timetable.stops
+        for station in [from_station, to_station]:
+            if station not in stops:
+                raise ValueError("The {} train going {} doesn't stop at {}".format(line, direction, station))
+        first, last = sorted([stops.index(from_station), stops.index(to_station)])
+        return stops[first:last + 1]
+
+    def _get_trains_in_segment(self, line: str, direction: str, from_station: str, to_station: str,
+                               start: int, end: int) -> List[tuple]:
+        """
+        Gets the trains that stop in a segment of a line during a time window, with the first station of the segment
+        that each of them stops at
+        :param line: the line
+        :param direction: the direction
+        :param from_station: schedule key of the first station of the segment
+        :param to_station: schedule key of the last station of the segment
+        :param start: the start of the window in minutes since midnight
+        :param end: the end of the window in minutes since midnight
+        :return: list of tuples of the Schedule, without its delay applied, and the station
+        """
+        # Lines are stored in upper case, both in the timetable and in the Schedule collection
+        line = str(line).upper()
+        segment = self._get_segment(line, direction, from_station, to_station)
+        result = self.repository.get_trains_in_window(line=line, direction=direction, stations=segment,
+                                                      start=start, end=end)
+        trains = []
+        for record in result:
+            schedule = Schedule.from_mongo(record)
+            trains.append((schedule, next(station for station in segment if station in schedule.schedule)))
+        return trains
+
+    def delay_trains(self, line: str, direction: str, from_station: str, to_station: str,
+                     start: int, end: int, delay: int) -> int:
+        """
+        Delays every train that stops between from_station and to_station during a time window by the provided delay,
+        at every stop after the first station of the segment that it stops at. The delays are written in a single
+        bulk write and replace the delays the trains already have.
+        :param line: the line
+        :param direction: the direction
+        :param from_station: schedule key of the first station of the segment
+        :param to_station: schedule key of the last station of the segment
+        :param start: the start of the window in minutes since midnight
+        :param end: the end of the window in minutes since midnight
+        :param delay: the delay in minutes
+        :return: the number of trains delayed
+        """
+        trains = self._get_trains_in_segment(line, direction, from_station, to_station, start, end)
+        self.repository.delay_trains(trains, delay)
+        for schedule, station_name in trains:
+            schedule.delay = {"start": station_name, "time": delay}
+            ScheduleService.delay_registry.put(schedule)
+        self._apply_delays((schedule.line, schedule.direction) for schedule, station_name in trains)
+        return len(trains)
+
+    def remove_delays(self, line: str, direction: str, from_station: str, to_station: str,
+                      start: int, end: int) -> int:
+        """
+        Removes the delays of every train that stops between from_station and to_station during a time window, in a
+        single bulk write
+        :param line: the line
+        :param direction: the direction
+        :param from_station: schedule key of the first station of the segment
+        :param to_station: schedule key of the last station of the segment
+        :param start: the start of the window in minutes since midnight
+        :param end: the end of the window in minutes since midnight
+        :return: the number of trains whose delay was removed
+        """
+        schedules = [schedule for schedule, station_name in
+                     self._get_trains_in_segment(line, direction, from_station, to_station, start, end)
+                     if schedule.delay is not None]
+        self.repository.remove_delays(schedules)
+        for schedule in schedules:
+            ScheduleService.delay_registry.remove(schedule.trip)
+        self._apply_delays((schedule.line, schedule.direction) for schedule in schedules)
+        return len(schedules)
+
     def get_schedules_by_line(self,
                               line: str) -> List[Schedule]:
         """
@@ -614,53 +1235,53 @@ class ScheduleService:
                                                 start_station: SubwayStation,
                                                 end_station: SubwayStation,
                                                 line: str,
-                                                time: datetime) -> Schedule:
+                                                time: int) -> Schedule:
         """
         Getes the next train for going from start_station to end_station on the given line, after the time specified
         :param start_station: the starting SubwayStation
         :param end_station: the ending SubwayStation
         :param line: the line
-        :param time: the minimum time
-        :return: Schedule
-        """
-        result = self.repository.get_next_train_by_station_name_and_line(start_station.schedule_key(),
-                                                                         end_station.schedule_key(),
-                                                                         line,
-                                                                         time)
-        result = [res for res in result][0]
-        return result
-
-    def delay_train(self, schedule: Schedule, station_name: str, delay: timedelta):
+        :param time: the minimum time in minutes
+        :return: Schedule document with the departure from start_station and the arrival at end_station, in minutes
         """
-        Delays the specified schedule by the provided delay starting at station_name. If a delay already exists,
-        remove that delay first.
-        :param schedule: the Schedule object
+        start_key = start_station.schedule_key()
+        end_key = end_station.schedule_key()
+        result = self.get_timetable().next_train(start_key, end_key, line, time)
+        if result is None:
+            raise IndexError("No train on line {} from {} to {}".format(line, start_key, end_key))
+        return {
+            "Line": str(line).upper(),
+            "Schedule": {
+                start_key: result[0],
+                end_key: result[1]
+            }
+        }
+
+    def delay_train(self, schedule: Schedule, station_name: str, delay: int):
+        """
+        Delays the specified schedule by the provided delay at every stop after station_name, replacing the delay it
+        already has
+        :param schedule: the Schedule object, without its delay applied
         :param station_name: the name of the starting station
-        :param delay: the delay amount
+        :param delay: the delay in minutes
         :return:
         """
-        if schedule.delay is not None:
-            new_sched = self.remove_delay(schedule=schedule)
-            schedule = Schedule.from_mongo(new_sched)
         result = self.repository.delay_train(schedule=schedule, station_name=station_name, delay=delay)
+        schedule.delay = {"start": station_name, "time": delay}
+        ScheduleService.delay_registry.put(schedule)
+        self._apply_delays([(schedule.line, schedule.direction)])
         return result
 
-    def get_train_by_line_direction_station_and_start_time(self,
-                                                           line: str,
-                                                           direction: str,
-                                                           starting_station: str,
-                                                           time: datetime):
+    def get_train(self, trip: str) -> Schedule:
         """
-        Gets the Schedule that starts from the given starting_station at the given time, going in the given direction
-        on the given line
-        :param line: the line
-        :param direction: the direction
-        :param starting_station: the starting station
-        :param time: the time
-        :return:
+        Gets the Schedule of a train, without its delay applied
+        :param trip: the trip id
+        :return: the Schedule, with its delay if it has one, or None if there is no such train, e.g. because the
+        schedules were reloaded since the trip id was read
         """
-        result = self.repository.get_train_by_line_direction_station_and_start_time(line, direction,
-                                                                                    starting_station, time)
+        result = self.repository.get_train(trip)
+        if result is None:
+            return None
         return Schedule.from_mongo(result)
 
     def remove_delay(self, schedule: Schedule):
@@ -673,32 +1294,102 @@ class ScheduleService:
             return None
         else:
             result = self.repository.remove_delay(schedule=schedule)
+            ScheduleService.delay_registry.remove(schedule.trip)
+            self._apply_delays([(schedule.line, schedule.direction)])
             return result
 
-    def get_delays(self) -> pd.DataFrame:
+    def get_delays(self) -> List[dict]:
         """
-        Gets all of the delays on the system
-        :return: pd.DataFrame containing the relevant delay information
+        Gets all of the delays on the system from the delay registry
+        :return: list of dictionaries of the Line, Direction, Time, Starting Station, Trip and Delay, sorted by line
+        and time
         """
-        result = self.repository.get_delays()
-        schedules = [x for x in result]
+        return ScheduleService.delay_registry.rows()
 
-        output = [["Line", "Direction", "Time", "Starting Station", "Starting Station for Line", "Delay"]]
-        for schedule in schedules:
-            line = schedule["Line"]
-            direction = schedule["Direction"]
-            starting_station = schedule["Delay"]["start"]
-            start_station_for_line = list(schedule["Schedule"].keys())[0]
-            print(start_station_for_line)
-            delay = schedule["Delay"]["time"]
-            time = schedule["Schedule"][list(schedule["Schedule"].keys())[0]].strftime("%H:%M")
-            output.append([line, direction, time, starting_station, start_station_for_line, delay])
-        df = pd.DataFrame(output[1:], columns=output[0]).sort_values(by=["Line", "Time"])
-        return df
-
-    def get_schedules_by_line_direction(self, line, direction) -> (List, List):
+    def follow_delays(self, interval: float = 5):
+        """
+        Starts a background thread that keeps the delay registry and the timetable current with the delays written by
+        other processes. It follows a change stream on the Delay collection, and polls the collection every 'interval'
+        seconds instead when MongoDB runs standalone, where change streams aren't available.
+        :param interval: the number of seconds between polls
+        :return: None
+        """
+        if ScheduleService._follower is not None:
+            return
+        ScheduleService._follower = threading.Thread(target=self._follow_delays, args=(interval,),
+                                                     name="delay-follower", daemon=True)
+        ScheduleService._follower.start()
+
+    def _follow_delays(self, interval: float):
+        while True:
+            try:
+                with self.repository.watch_delays() as stream:
+                    # Catch up on the changes made before the stream was opened
+                    self.poll_delays()
+                    for change in stream:
+                        document = change.get("fullDocument")
+                        delay = None
+                        if change["operationType"] != "delete" and document is not None:
+                            delay = {"start": document["start"], "time": document["time"]}
+                        self._sync_delays({str(change["documentKey"]["_id"]): delay})
+            except OperationFailure as e:
+                # 40573: change streams are only supported on replica sets
+                if e.code == 40573:
+                    print("Change streams are unavailable, polling the delays every {} s".format(interval))
+                    break
+                print("Reopening the delay change stream: {}".format(e))
+            except PyMongoError as e:
+                print("Reopening the delay change stream: {}".format(e))
+            time.sleep(interval)
+
+        while True:
+            time.sleep(interval)
+            try:
+                self.poll_delays()
+            except PyMongoError as e:
+                print("Couldn't poll the delays: {}".format(e))
+
+    def poll_delays(self) -> int:
+        """
+        Compares the Delay collection with the delay registry and applies the differences
+        :return: the number of trains whose delay changed
+        """
+        current = {str(document["_id"]): {"start": document["start"], "time": document["time"]}
+                   for document in self.repository.get_delay_documents()}
+        known = ScheduleService.delay_registry.delays()
+        changes = {trip: delay for trip, delay in current.items() if known.get(trip) != delay}
+        changes.update({trip: None for trip in known if trip not in current})
+        return self._sync_delays(changes)
+
+    def _sync_delays(self, changes: dict) -> int:
+        """
+        Applies delays written by another process to the delay registry and the timetable. Changes this process
+        already made are skipped.
+        :param changes: dictionary of the trip id to its new delay, as {"start": station, "time": minutes}, or to
+        None if its delay was removed
+        :return: the number of trains whose delay changed
+        """
+        registry = ScheduleService.delay_registry
+        changed = []
+        for trip, delay in changes.items():
+            if delay is None:
+                schedule = registry.remove(trip)
+                if schedule is not None:
+                    changed.append(schedule)
+        trips = [trip for trip, delay in changes.items() if delay is not None and
+                 (registry.get(trip) is None or registry.get(trip).delay != delay)]
+        if len(trips) > 0:
+            for record in self.repository.get_delays(trips=trips):
+                schedule = Schedule.from_mongo(record)
+                if registry.put(schedule):
+                    changed.append(schedule)
+        self._apply_delays((schedule.line, schedule.direction) for schedule in changed)
+        return len(changed)
+
+    def get_schedules_by_line_direction(self, line, direction) -> (List, List, List):
         """
-        Gets all of the schedules for Trains going in the given direction on the given line
+        Gets all of the schedules for Trains going in the given direction on the given line, with their delays applied
+        :return: the stations, the clock times of every train at those stations, and the trip id of every train
         """
         result = self.repository.get_schedules_by_line_direction(line=line, direction=direction)
         results = [x for x in result]
@@ -720,14 +1411,14 @@ class ScheduleService:
                 result.append([])
                 for key in stations:
                     if key in schedule["Schedule"]:
-                        result[i].append(schedule["Schedule"][key].strftime("%H:%M"))
+                        result[i].append(format_minutes(schedule["Schedule"][key]))
                     else:
                         result[i].append("--")
                 i += 1
 
 
             # schedules = [[val.strftime("%H:%M") for val in schedule["Schedule"].values()] for schedule in schedules]
-            return stations, result
+            return stations, result, [schedule["trip"] for schedule in schedules]
         else:
             return None
 
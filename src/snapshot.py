@@ -0,0 +1,179 @@
+import argparse
+import hashlib
+import json
+import mmap
+import os
+import struct
+import time
+import numpy as np
+
+from src.ingest import schedule_files, parse_schedule_files, intern_schedule_stations
+from src.repository import ScheduleRepository
+from src.timetable import Timetable, LineTimetable
+
+
+"""
+Binary snapshot of the compressed timetable. The file starts with a fixed header of the magic, the format version and
+the length of a JSON index, followed by the index and then by the arrays, each aligned to ALIGNMENT bytes. The index
+holds the station dictionary, and for every line and direction the location, dtype and shape of its stops (as ids in
+the station dictionary), profile offsets and run table. Loading maps the file and wraps the arrays with
+NumPy without copying them, so processes that load the same file share its pages. Build it with
+python -m src.snapshot [--from-mongo] [--output PATH]
+"""
+
+
+MAGIC = b"SUBWAYTT"
+# Bumped whenever the layout of the file changes
+FORMAT_VERSION = 2
+HEADER = struct.Struct("<8sII")
+ALIGNMENT = 64
+DEFAULT_PATH = "timetable.snapshot"
+
+
+def _align(position: int) -> int:
+    return (position + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def write_snapshot(timetable: Timetable, path: str = DEFAULT_PATH, source: str = "") -> dict:
+    """
+    Writes a timetable to a snapshot file. The file is written next to 'path' and then renamed over it, so processes
+    that already mapped the old file keep reading it and new ones only ever see a complete file.
+    :param timetable: the Timetable
+    :param path: the path of the snapshot
+    :param source: where the timetable was built from
+    :return: the index of the snapshot
+    """
+    stations = sorted(set(stop for line_timetable in timetable.lines.values() for stop in line_timetable.stops))
+    station_ids = {station: i for i, station in enumerate(stations)}
+
+    arrays = []
+    lines = []
+    for line_timetable in timetable.lines.values():
+        sections = {}
+        for name, array in [("stops", np.array([station_ids[stop] for stop in line_timetable.stops], dtype=np.int32)),
+                            ("offsets", line_timetable.offsets),
+                            ("table", line_timetable.table)]:
+            array = np.ascontiguousarray(array)
+            sections[name] = {"dtype": array.dtype.str, "shape": list(array.shape), "offset": None}
+            arrays.append((sections[name], array))
+        lines.append({"Line": line_timetable.line,
+                      "Direction": line_timetable.direction,
+                      "run_count": line_timetable.run_count,
+                      "sections": sections})
+
+    digest = hashlib.sha256()
+    for section, array in arrays:
+        digest.update(array.tobytes())
+    index = {"built": time.strftime("%Y-%m-%dT%H:%M:%S"),
+             "source": source,
+             "digest": digest.hexdigest(),
+             "stations": stations,
+             "lines": lines}
+
+    # The offsets of the arrays depend on the length of the index, which depends on the offsets, so the index is
+    # padded to a fixed length once it has been measured with placeholders
+    for section, array in arrays:
+        section["offset"] = 0
+    index_length = len(json.dumps(index).encode("utf-8")) + 32 * len(arrays)
+    position = _align(HEADER.size + index_length)
+    for section, array in arrays:
+        section["offset"] = position
+        position = _align(position + array.nbytes)
+    encoded = json.dumps(index).encode("utf-8")
+    encoded += b" " * (index_length - len(encoded))
+
+    temporary = "{}.{}.tmp".format(path, os.getpid())
+    with open(temporary, "wb") as f:
+        f.write(HEADER.pack(MAGIC, FORMAT_VERSION, index_length))
+        f.write(encoded)
+        for section, array in arrays:
+            f.write(b"\0" * (section["offset"] - f.tell()))
+            f.write(array.tobytes())
+    os.replace(temporary, path)
+    return index
+
+
+def read_snapshot(path: str = DEFAULT_PATH) -> Timetable:
+    """
+    Maps a snapshot file into memory and builds a timetable whose arrays are read-only views of the mapped file
+    :param path: the path of the snapshot
+    :return: Timetable
+    """
+    with open(path, "rb") as f:
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    magic, version, index_length = HEADER.unpack_from(buffer, 0)
+    if magic != MAGIC:
+        raise ValueError("{} is not a timetable snapshot".format(path))
+    if version != FORMAT_VERSION:
+        raise ValueError("{} has format version {}, expected {}. Rebuild it with python -m src.snapshot"
+                         .format(path, version, FORMAT_VERSION))
+    index = json.loads(buffer[HEADER.size:HEADER.size + index_length])
+
+    def view(section):
+        count = int(np.prod(section["shape"]))
+        return np.frombuffer(buffer, dtype=section["dtype"], count=count, offset=section["offset"]) \
+            .reshape(section["shape"])
+
+    stations = index["stations"]
+    lines = {}
+    for line in index["lines"]:
+        sections = line["sections"]
+        line_timetable = LineTimetable(line=line["Line"],
+                                       direction=line["Direction"],
+                                       stops=[stations[i] for i in view(sections["stops"]).tolist()],
+                                       offsets=view(sections["offsets"]),
+                                       table=view(sections["table"]),
+                                       run_count=line["run_count"])
+        lines[(line_timetable.line, line_timetable.direction)] = line_timetable
+    return Timetable(lines)
+
+
+def build_from_csv(directory: str = "Trains", workers: int = None) -> Timetable:
+    """
+    Builds the timetable straight from the schedule files, without going through MongoDB
+    :param directory: the directory of the schedule files
+    :param workers: the number of worker processes used to parse the files
+    :return: Timetable
+    """
+    intern_schedule_stations(directory)
+    schedules = []
+    for documents in parse_schedule_files(schedule_files(directory), workers=workers):
+        for document in documents:
+            schedules.append({"Line": document["Line"],
+                              "Direction": document["Direction"],
+                              "Schedule": {stop["station"]: stop["time"] for stop in document["stops"]}})
+    return Timetable.from_schedules(schedules)
+
+
+def build_from_mongo() -> Timetable:
+    """
+    Builds the timetable from the compressed Timetable collection, or from the Schedule collection if it is empty
+    :return: Timetable
+    """
+    repository = ScheduleRepository()
+    documents = list(repository.get_timetables())
+    if len(documents) > 0:
+        return Timetable.from_mongo(documents)
+    return Timetable.from_schedules(repository.get_all_schedules())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--from-mongo", action="store_true", help="build from MongoDB instead of Trains/*.csv")
+    parser.add_argument("--output", default=DEFAULT_PATH)
+    parser.add_argument("--workers", type=int, default=None)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    if args.from_mongo:
+        timetable, source = build_from_mongo(), "mongo"
+    else:
+        timetable, source = build_from_csv(workers=args.workers), "csv"
+    index = write_snapshot(timetable, args.output, source=source)
+    print("Wrote {} lines and {} stations to {} ({} bytes) in {:.2f} s".format(
+        len(index["lines"]), len(index["stations"]), args.output, os.path.getsize(args.output),
+        time.perf_counter() - start))
+
+    start = time.perf_counter()
+    read_snapshot(args.output)
+    print("Loaded the snapshot in {:.2f} ms".format((time.perf_counter() - start) * 1000))
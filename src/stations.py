@@ -0,0 +1,112 @@
+from __future__ import annotations
+import json
+import os
+import threading
+from typing import List
+
+
+"""
+Process-wide interning table of the integer ids of stations. A station id stands for a schedule key, the
+"name [lines]" string that joins the graph to the timetable, and is stored on the SubwayStation nodes and on the stops
+of the schedule documents. The table is kept in data/station_ids.json as the list of keys in id order. Keys are only
+ever appended, so the id of a station never changes between builds.
+"""
+
+
+DEFAULT_PATH = "data/station_ids.json"
+
+
+class StationIds:
+    """
+    Both directions of the interning table, shared by every caller in the process. The table is read from 'path'
+    the first time it is used.
+    """
+    path = DEFAULT_PATH
+    _ids = None
+    _keys = None
+    # Number of keys that are already saved to 'path'
+    _saved = 0
+    _lock = threading.Lock()
+
+    @classmethod
+    def _load(cls):
+        if cls._ids is not None:
+            return
+        keys = []
+        if os.path.exists(cls.path):
+            with open(cls.path) as f:
+                keys = json.load(f)
+        cls._keys = keys
+        cls._ids = {key: i for i, key in enumerate(keys)}
+        cls._saved = len(keys)
+
+    @classmethod
+    def intern(cls, key: str) -> int:
+        """
+        Gets the id of a schedule key, giving it the next free id if it doesn't have one yet
+        :param key: the schedule key
+        :return: the station id
+        """
+        if cls._ids is None:
+            cls._load()
+        station_id = cls._ids.get(key)
+        if station_id is None:
+            with cls._lock:
+                station_id = cls._ids.get(key)
+                if station_id is None:
+                    station_id = len(cls._keys)
+                    cls._keys.append(key)
+                    cls._ids[key] = station_id
+        return station_id
+
+    @classmethod
+    def intern_all(cls, keys: List[str]) -> List[int]:
+        """
+        Interns schedule keys in sorted order, so that new keys get the same ids whatever order they are found in
+        :param keys: the schedule keys
+        :return: the station ids, in the same order as 'keys'
+        """
+        for key in sorted(set(keys)):
+            cls.intern(key)
+        return [cls._ids[key] for key in keys]
+
+    @classmethod
+    def get(cls, key: str) -> int:
+        """
+        Gets the id of a schedule key without interning it
+        :param key: the schedule key
+        :return: the station id, or None if the key has no id
+        """
+        if cls._ids is None:
+            cls._load()
+        return cls._ids.get(key)
+
+    @classmethod
+    def key(cls, station_id: int) -> str:
+        """
+        Gets the schedule key of a station id
+        :param station_id: the station id
+        :return: the schedule key
+        """
+        if cls._ids is None:
+            cls._load()
+        return cls._keys[station_id]
+
+    @classmethod
+    def save(cls) -> int:
+        """
+        Writes the table to 'path' if keys were interned since it was read
+        :return: the number of keys added to the file
+        """
+        if cls._ids is None:
+            cls._load()
+        with cls._lock:
+            added = len(cls._keys) - cls._saved
+            if added == 0:
+                return 0
+            temporary = "{}.{}.tmp".format(cls.path, os.getpid())
+            with open(temporary, "w") as f:
+                f.write("[\n" + ",\n".join(json.dumps(key) for key in cls._keys) + "\n]\n")
+            os.replace(temporary, cls.path)
+            cls._saved = len(cls._keys)
+        return added
@@ -21,12 +21,7 @@ user_service = UserService()
 
 stat = map_service.get_station_by_name_and_entrance("Astor Pl", "East 8th Street")
 stop = map_service.get_station_by_name_and_entrance("Union Sq - 14 St", "East 14th Street")
-test = schedule_service.get_next_train_by_station_name_and_line(stat, stop, "6", datetime(year=1900,
-                                                                                            month=1,
-                                                                                            day=1,
-                                                                                            hour=13,
-                                                                                            minute=48,
-                                                                                            second=0))
+test = schedule_service.get_next_train_by_station_name_and_line(stat, stop, "6", 13 * 60 + 48)
 
 print(test)
 # start = map_service.get_station_by_name_and_entrance("Dekalb Av", "340 Flatbush Ave Extension")
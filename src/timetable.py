@@ -0,0 +1,530 @@
+from __future__ import annotations
+import numpy as np
+from typing import List, Dict, Tuple
+
+
+# Marks a stop that a trip does not serve
+MISSING = -1
+# Stop times are minutes since the start of the service day, and go past this for stops after midnight
+MINUTES_PER_DAY = 1440
+# Smallest number of trips at a regular headway that is stored as a run
+MIN_RUN = 2
+
+
+def format_minutes(minutes: int) -> str:
+    """
+    Formats a stop time as a clock time
+    :param minutes: minutes since the start of the service day
+    :return: the time as HH:MM
+    """
+    minutes = int(minutes) % MINUTES_PER_DAY
+    return "{:02d}:{:02d}".format(minutes // 60, minutes % 60)
+
+
+def parse_minutes(time: str) -> int:
+    """
+    Parses a clock time into minutes since midnight
+    :param time: the time as HH:MM
+    :return: the minutes
+    """
+    hours, minutes = time.strip().split(":")
+    if not (0 <= int(hours) < 24 and 0 <= int(minutes) < 60):
+        raise ValueError("Invalid time {}".format(time))
+    return int(hours) * 60 + int(minutes)
+
+
+def to_service_minutes(times) -> List[int]:
+    """
+    Converts the clock times of the stops of a trip to minutes since the start of the service day. A time hours
+    before the previous stop is moved forward 12 hours at a time, which covers trips running past midnight as well as
+    noon being written as 00:xx in the source schedules. Steps of a few minutes backwards are kept as they are, since
+    they are typos.
+    :param times: the minutes since midnight of the stops, or their datetimes, in order
+    :return: list of minutes
+    """
+    minutes = []
+    for time in times:
+        current = time if isinstance(time, int) else time.hour * 60 + time.minute
+        while len(minutes) > 0 and current + 360 < minutes[-1]:
+            current += 720
+        minutes.append(current)
+    return minutes
+
+
+def merge_stop_orders(stop_orders: List[List[str]]) -> List[str]:
+    """
+    Merges the stops served by every trip on a line into a single ordered list. Stops that only some trips serve are
+    placed after the last stop that comes before them on those trips.
+    :param stop_orders: the ordered stops of every trip
+    :return: the ordered list of stops
+    """
+    stop_orders = sorted(stop_orders, key=len, reverse=True)
+    merged = list(stop_orders[0]) if len(stop_orders) > 0 else []
+    for stops in stop_orders[1:]:
+        previous = None
+        for stop in stops:
+            if stop not in merged:
+                position = merged.index(previous) + 1 if previous is not None else 0
+                merged.insert(position, stop)
+            previous = stop
+    return merged
+
+
+def compress_departures(departures: List[int]) -> Tuple[List[Tuple[int, int, int]], List[int]]:
+    """
+    Splits the departures of trips that share a running-time profile into runs at a regular headway and exceptions.
+    A run needs at least MIN_RUN trips. A run of two is still a single row of the table instead of two.
+    :param departures: the departure times of the trips
+    :return: list of runs as (first departure, headway, count), and list of the departures that are in no run
+    """
+    departures = sorted(departures)
+    runs = []
+    exceptions = []
+    i = 0
+    while i < len(departures):
+        headway = departures[i + 1] - departures[i] if i + 1 < len(departures) else 0
+        end = i + 1
+        while headway > 0 and end < len(departures) and departures[end] - departures[end - 1] == headway:
+            end += 1
+        if end - i >= MIN_RUN:
+            runs.append((departures[i], headway, end - i))
+            i = end
+        else:
+            exceptions.append(departures[i])
+            i += 1
+    return runs, exceptions
+
+
+class LineTimetable:
+    """
+    Frequency-compressed timetable for a single line and direction. Trips that stop at the same stations with the
+    same running times share a profile, which holds the offset of every stop from the earliest time of the trip.
+    The departures of a profile are stored as runs of (first departure, headway, count), and the trips that fit in
+    no run as exceptions, which are kept as runs of a single trip. The time of trip k of a run at a stop is
+    first + k * headway + offset, so lookups are arithmetic over the runs instead of searches over the trips.
+    """
+    def __init__(self, line: str, direction: str, stops: List[str], offsets: np.ndarray, table: np.ndarray,
+                 run_count: int):
+        """
+        :param line: the line
+        :param direction: the direction
+        :param stops: the ordered stops of the line
+        :param offsets: profiles x stops matrix of the minutes from the departure, MISSING where a stop isn't served
+        :param table: matrix of (profile, first departure, headway, count), with the runs first and then the
+        exceptions, which have a headway of 0 and a count of 1
+        :param run_count: the number of runs in the table
+        """
+        self.line = line
+        self.direction = direction
+        self.stops = stops
+        self.stop_index = {stop: i for i, stop in enumerate(stops)}
+        self.offsets = offsets
+        self.table = table
+        self.run_count = run_count
+
+        self._profile = table[:, 0]
+        self._first = table[:, 1]
+        self._headway = table[:, 2]
+        self._count = table[:, 3]
+
+    @property
+    def runs(self) -> np.ndarray:
+        return self.table[:self.run_count]
+
+    @property
+    def exceptions(self) -> np.ndarray:
+        return self.table[self.run_count:, :2]
+
+    @staticmethod
+    def _table(runs: List[Tuple[int, int, int, int]], exceptions: List[Tuple[int, int]]) -> np.ndarray:
+        rows = list(runs) + [(profile, departure, 0, 1) for profile, departure in exceptions]
+        return np.array(rows, dtype=np.int32).reshape(-1, 4)
+
+    @classmethod
+    def from_schedules(cls, line: str, direction: str, schedules: List[dict]) -> LineTimetable:
+        """
+        Builds the timetable from the Schedule documents of a single line and direction
+        :param line: the line
+        :param direction: the direction
+        :param schedules: list of Schedule documents
+        :return: LineTimetable
+        """
+        stops = merge_stop_orders([list(schedule['Schedule'].keys()) for schedule in schedules])
+        stop_index = {stop: i for i, stop in enumerate(stops)}
+        departures_by_profile = {}
+        for schedule in schedules:
+            if len(schedule['Schedule']) == 0:
+                continue
+            columns = tuple(stop_index[stop] for stop in schedule['Schedule'].keys())
+            times = list(schedule['Schedule'].values())
+            # Offsets are taken from the earliest time, so none of them can be mistaken for MISSING
+            departure = min(times)
+            profile = (columns, tuple(time - departure for time in times))
+            departures_by_profile.setdefault(profile, []).append(departure)
+
+        offsets = np.full((len(departures_by_profile), len(stops)), MISSING, dtype=np.int16)
+        runs = []
+        exceptions = []
+        for index, ((columns, profile_offsets), departures) in enumerate(departures_by_profile.items()):
+            offsets[index, list(columns)] = profile_offsets
+            profile_runs, profile_exceptions = compress_departures(departures)
+            runs.extend((index, first, headway, count) for first, headway, count in profile_runs)
+            exceptions.extend((index, departure) for departure in profile_exceptions)
+        return cls(line, direction, stops, offsets, cls._table(runs, exceptions), len(runs))
+
+    @classmethod
+    def from_mongo(cls, document: dict) -> LineTimetable:
+        """
+        Builds the timetable from its document in the compressed Timetable collection
+        :param document: the document
+        :return: LineTimetable
+        """
+        offsets = np.full((len(document["profiles"]), len(document["stops"])), MISSING, dtype=np.int16)
+        for index, (pattern, profile_offsets) in enumerate(document["profiles"]):
+            offsets[index, document["patterns"][pattern]] = profile_offsets
+        return cls(document["Line"], document["Direction"], document["stops"], offsets,
+                   cls._table(document["runs"], document["exceptions"]), len(document["runs"]))
+
+    def to_mongo(self) -> dict:
+        """
+        Converts the timetable to a document for the compressed Timetable collection. Profiles point at a pattern,
+        the list of stops that they serve, and hold the offsets of those stops only.
+        :return: dictionary with the Line, Direction, stops, patterns, profiles, runs and exceptions
+        """
+        patterns = {}
+        profiles = []
+        for row in self.offsets:
+            columns = tuple(np.flatnonzero(row != MISSING).tolist())
+            pattern = patterns.setdefault(columns, len(patterns))
+            profiles.append([pattern, row[list(columns)].tolist()])
+        return {
+            "Line": self.line,
+            "Direction": self.direction,
+            "stops": self.stops,
+            "patterns": [list(columns) for columns in patterns.keys()],
+            "profiles": profiles,
+            "runs": self.runs.tolist(),
+            "exceptions": self.exceptions.tolist()
+        }
+
+    def trips(self):
+        """
+        Expands the runs into the trips that they stand for
+        :return: iterator of tuples of the columns of the stops a trip serves, and its times at those stops
+        """
+        for profile, first, headway, count in zip(self._profile.tolist(), self._first.tolist(),
+                                                  self._headway.tolist(), self._count.tolist()):
+            columns = np.flatnonzero(self.offsets[profile] != MISSING)
+            offsets = self.offsets[profile, columns].tolist()
+            columns = tuple(columns.tolist())
+            for k in range(0, count):
+                departure = first + k * headway
+                yield columns, [departure + offset for offset in offsets]
+
+    def departures(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Expands the runs into the departures of every trip from every stop it serves, except its last stop
+        :return: tuple of arrays of the column of the stop, the time of the departure and the column of the last stop
+        of the trip
+        """
+        rows = np.repeat(np.arange(len(self.table)), self._count)
+        k = np.arange(len(rows)) - np.repeat(np.cumsum(self._count) - self._count, self._count)
+        departures = self._first[rows] + k * self._headway[rows]
+        offsets = self.offsets[self._profile[rows]]
+        served = offsets != MISSING
+        last = served.shape[1] - 1 - np.argmax(served[:, ::-1], axis=1)
+        served[np.arange(len(rows)), last] = False
+        trips, columns = np.nonzero(served)
+        return columns, departures[trips] + offsets[trips, columns], last[trips]
+
+    @property
+    def trip_count(self) -> int:
+        return int(self._count.sum())
+
+    def next_train(self, start: str, end: str, time: int):
+        """
+        Gets the train that leaves 'start' at or after 'time' and arrives at 'end' the earliest
+        :param start: schedule key of the starting station
+        :param end: schedule key of the ending station
+        :param time: the time in minutes
+        :return: tuple of the departure and arrival time in minutes, or None if there is no such train
+        """
+        if start not in self.stop_index or end not in self.stop_index:
+            return None
+        # The offsets of the two stops are gathered for every row of the table, rather than keeping a copy of the
+        # profile of every row
+        start_offsets = self.offsets[self._profile, self.stop_index[start]]
+        end_offsets = self.offsets[self._profile, self.stop_index[end]]
+        # The runs that serve both stops and reach 'end' after leaving 'start'
+        runs = np.flatnonzero((start_offsets != MISSING) & (end_offsets > start_offsets))
+        start_offsets = start_offsets[runs]
+        headway = self._headway[runs]
+
+        # The first trip of every run that leaves 'start' at or after 'time'
+        wait = np.maximum(time - start_offsets - self._first[runs], 0)
+        k = -(-wait // np.maximum(headway, 1))
+        valid = np.flatnonzero(k < self._count[runs])
+        if len(valid) == 0:
+            return None
+        departures = self._first[runs[valid]] + k[valid] * headway[valid]
+        arrivals = departures + end_offsets[runs[valid]]
+        # Ties on the arrival go to the train that leaves first
+        best = np.argmin(arrivals * (2 * MINUTES_PER_DAY) + departures)
+        return int(departures[best] + start_offsets[valid[best]]), int(arrivals[best])
+
+    def with_delays(self, delays: List[Tuple[dict, str, int]]) -> LineTimetable:
+        """
+        Applies delays to a copy of the timetable, leaving this one untouched. Every delayed trip is taken out of its
+        run, which is split around it, and added back as an exception with a profile of its own. A trip is delayed at
+        every stop after the one that the delay starts at.
+        :param delays: list of tuples of the {station: time} schedule of a delayed trip, the station that the delay
+        starts at and the delay in minutes
+        :return: LineTimetable
+        """
+        removed = {}
+        profiles = []
+        added = []
+        step = np.maximum(self._headway, 1)
+        for schedule, start, minutes in delays:
+            if start not in schedule or any(stop not in self.stop_index for stop in schedule):
+                continue
+            columns = [self.stop_index[stop] for stop in schedule]
+            times = np.array(list(schedule.values()))
+            departure = int(times.min())
+            row = np.full(len(self.stops), MISSING, dtype=self.offsets.dtype)
+            row[columns] = times - departure
+
+            # The rows of the table whose runs have a trip with these times
+            wait = departure - self._first
+            candidates = np.flatnonzero((wait >= 0) & (wait % step == 0) & (wait // step < self._count)
+                                        & np.all(self.offsets == row, axis=1)[self._profile])
+            candidates = [(r, int(wait[r] // step[r])) for r in candidates.tolist()]
+            # Identical trips are stored as separate exceptions, so each delay takes one that isn't taken yet
+            candidates = [(r, k) for r, k in candidates if k not in removed.get(r, set())]
+            if len(candidates) == 0:
+                continue
+            r, k = candidates[0]
+            removed.setdefault(r, set()).add(k)
+
+            times[list(schedule.keys()).index(start) + 1:] += minutes
+            departure = int(times.min())
+            row[columns] = times - departure
+            profiles.append(row)
+            added.append((len(self.offsets) + len(profiles) - 1, departure, 0, 1))
+
+        # Split the runs around the trips that were taken out of them
+        split_runs = []
+        split_exceptions = []
+        for r, ks in removed.items():
+            profile, first, headway, count = self.table[r].tolist()
+            begin = 0
+            for k in sorted(ks) + [count]:
+                if k - begin >= MIN_RUN:
+                    split_runs.append((profile, first + begin * headway, headway, k - begin))
+                else:
+                    split_exceptions.extend((profile, first + j * headway, 0, 1) for j in range(begin, k))
+                begin = k + 1
+
+        kept = np.ones(len(self.table), dtype=bool)
+        kept[list(removed.keys())] = False
+        runs = [self.runs[kept[:self.run_count]], np.array(split_runs, dtype=np.int32).reshape(-1, 4)]
+        exceptions = [self.table[self.run_count:][kept[self.run_count:]],
+                      np.array(split_exceptions + added, dtype=np.int32).reshape(-1, 4)]
+        return LineTimetable(self.line, self.direction, self.stops,
+                             np.vstack([self.offsets] + profiles) if len(profiles) > 0 else self.offsets,
+                             np.concatenate(runs + exceptions), sum(len(run) for run in runs))
+
+    def running_times(self) -> dict:
+        """
+        Gets the shortest scheduled running time between every pair of consecutive stops
+        :return: dictionary mapping sorted pairs of schedule keys to minutes
+        """
+        running_times = {}
+        for row in self.offsets:
+            served = np.flatnonzero(row != MISSING)
+            for a, b, minutes in zip(served[:-1].tolist(), served[1:].tolist(), np.diff(row[served]).tolist()):
+                pair = tuple(sorted((self.stops[a], self.stops[b])))
+                # Times are rounded to the minute, so consecutive stops can share a time
+                minutes = max(minutes, 1)
+                if pair not in running_times or minutes < running_times[pair]:
+                    running_times[pair] = minutes
+        return running_times
+
+    @property
+    def nbytes(self) -> int:
+        return self.offsets.nbytes + self.table.nbytes
+
+
+class Timetable:
+    """
+    Frequency-compressed copy of the Schedule collection, keyed by (Line, Direction)
+    """
+    def __init__(self, lines: Dict[Tuple[str, str], LineTimetable]):
+        self.lines = lines
+
+    @classmethod
+    def from_mongo(cls, documents) -> Timetable:
+        """
+        Builds the timetable from the documents of the compressed Timetable collection
+        :param documents: iterable of documents, one per line and direction
+        :return: Timetable
+        """
+        lines = [LineTimetable.from_mongo(document) for document in documents]
+        return cls({(line_timetable.line, line_timetable.direction): line_timetable for line_timetable in lines})
+
+    def to_mongo(self) -> List[dict]:
+        """
+        Converts the timetable to documents for the compressed Timetable collection
+        :return: list of documents, one per line and direction
+        """
+        return [line_timetable.to_mongo() for line_timetable in self.lines.values()]
+
+    @classmethod
+    def from_schedules(cls, schedules) -> Timetable:
+        """
+        Builds the timetable from Schedule documents
+        :param schedules: iterable of Schedule documents
+        :return: Timetable
+        """
+        grouped = {}
+        for schedule in schedules:
+            if len(schedule['Schedule']) == 0:
+                continue
+            grouped.setdefault((schedule['Line'], schedule['Direction']), []).append(schedule)
+        return cls({key: LineTimetable.from_schedules(key[0], key[1], value) for key, value in grouped.items()})
+
+    def with_delays(self, delays: Dict[Tuple[str, str], List[Tuple[dict, str, int]]]) -> Timetable:
+        """
+        Applies delays to a copy of the timetable. Lines without delays are shared with this timetable.
+        :param delays: dictionary mapping (Line, Direction) to the delays on it, as taken by LineTimetable.with_delays
+        :return: Timetable
+        """
+        lines = dict(self.lines)
+        for key, line_delays in delays.items():
+            if key in lines and len(line_delays) > 0:
+                lines[key] = lines[key].with_delays(line_delays)
+        return Timetable(lines)
+
+    def replace_line(self, line_timetable: LineTimetable):
+        """
+        Replaces the timetable for a single line and direction
+        :param line_timetable: the new LineTimetable
+        :return: None
+        """
+        self.lines[(line_timetable.line, line_timetable.direction)] = line_timetable
+
+    def next_train(self, start: str, end: str, line: str, time: int):
+        """
+        Gets the train on 'line' that leaves 'start' at or after 'time' and arrives at 'end' the earliest
+        :param start: schedule key of the starting station
+        :param end: schedule key of the ending station
+        :param line: the line
+        :param time: the time in minutes
+        :return: tuple of the departure and arrival time in minutes, or None if there is no such train
+        """
+        best = None
+        for (curr_line, direction), line_timetable in self.lines.items():
+            if curr_line != str(line).upper():
+                continue
+            result = line_timetable.next_train(start, end, time)
+            if result is not None and (best is None or result[1] < best[1]):
+                best = result
+        return best
+
+    def running_times(self) -> dict:
+        """
+        Gets the shortest scheduled running time between every pair of consecutive stops on any line
+        :return: dictionary mapping sorted pairs of schedule keys to minutes
+        """
+        running_times = {}
+        for line_timetable in self.lines.values():
+            for pair, minutes in line_timetable.running_times().items():
+                if pair not in running_times or minutes < running_times[pair]:
+                    running_times[pair] = minutes
+        return running_times
+
+    @property
+    def nbytes(self) -> int:
+        return sum(line_timetable.nbytes for line_timetable in self.lines.values())
+
+
+class DepartureBoard:
+    """
+    The departures of every line from every station, for departure boards. The departures of all of the stations are
+    kept in one array sorted by station and then by time, so the next departures from a station are found with a
+    binary search over its slice.
+    """
+    def __init__(self, bounds: Dict[str, Tuple[int, int]], times: np.ndarray, services: np.ndarray,
+                 service_names: List[Tuple[str, str, str]]):
+        """
+        :param bounds: dictionary mapping the schedule key of a station to the start and end of its slice
+        :param times: the times of the departures, in minutes since the start of the service day
+        :param services: the index in 'service_names' of every departure
+        :param service_names: list of the (line, direction, last stop) of the trips
+        """
+        self.bounds = bounds
+        self.times = times
+        self.services = services
+        self.service_names = service_names
+
+    @classmethod
+    def from_timetable(cls, timetable: Timetable) -> DepartureBoard:
+        """
+        Builds the departure board from a timetable, with the delays of the timetable applied
+        :param timetable: the Timetable
+        :return: DepartureBoard
+        """
+        station_ids = {}
+        service_ids = {}
+        stations = []
+        times = []
+        services = []
+        for line_timetable in timetable.lines.values():
+            columns, line_times, lasts = line_timetable.departures()
+            column_stations = np.array([station_ids.setdefault(stop, len(station_ids))
+                                        for stop in line_timetable.stops], dtype=np.int32)
+            column_services = np.array([service_ids.setdefault((line_timetable.line, line_timetable.direction, stop),
+                                                               len(service_ids))
+                                        for stop in line_timetable.stops], dtype=np.int32)
+            stations.append(column_stations[columns])
+            times.append(line_times)
+            services.append(column_services[lasts])
+
+        stations = np.concatenate(stations) if len(stations) > 0 else np.zeros(0, dtype=np.int32)
+        times = np.concatenate(times).astype(np.int32) if len(times) > 0 else np.zeros(0, dtype=np.int32)
+        services = np.concatenate(services) if len(services) > 0 else np.zeros(0, dtype=np.int32)
+        order = np.lexsort((times, stations))
+        stations = stations[order]
+        starts = np.searchsorted(stations, np.arange(len(station_ids) + 1)).tolist()
+        bounds = {station: (starts[i], starts[i + 1]) for station, i in station_ids.items()}
+        return cls(bounds, times[order], services[order], list(service_ids.keys()))
+
+    def next_departures(self, station: str, time: int, count: int = 10) -> List[Tuple[int, str, str, str]]:
+        """
+        Gets the next departures from a station. Trips of the previous service day that are still running after
+        midnight are included.
+        :param station: schedule key of the station
+        :param time: the time in minutes since midnight
+        :param count: the maximum number of departures
+        :return: list of tuples of the minutes since midnight of the departure, which go past MINUTES_PER_DAY for
+        departures after midnight, the line, the direction and the last stop of the trip, sorted by time
+        """
+        if station not in self.bounds:
+            return []
+        start, end = self.bounds[station]
+        times = self.times[start:end]
+        departures = []
+        # The departures of the current service day, and those of the previous one that are still to come
+        for shift in [0, MINUTES_PER_DAY]:
+            first = start + int(np.searchsorted(times, time + shift))
+            for i in range(first, min(first + count, end)):
+                departures.append((int(self.times[i]) - shift, int(self.services[i])))
+        departures.sort()
+        return [(departure,) + self.service_names[service] for departure, service in departures[:count]]
+
+    def __contains__(self, station: str) -> bool:
+        return station in self.bounds
+
+    @property
+    def nbytes(self) -> int:
+        return self.times.nbytes + self.services.nbytes